@@ -0,0 +1,118 @@
+"""Rollup counters for the Analytics Service, maintained at ingest time.
+
+Every tracked event bumps a handful of counters: the running total for
+its event_type and user_id, and one count per (bucket, event_type) at
+minute, hour and day granularity, plus a per-day count per user. Summary
+queries sum these counters, so their cost depends on the number of
+buckets in the requested range, not on how many events are stored.
+
+Fine-grained buckets are pruned after a retention window to keep memory
+bounded; queries over older ranges should use a coarser granularity.
+"""
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+MICROS = 1_000_000
+
+GRANULARITIES = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+}
+
+
+class RollupAggregator:
+    def __init__(self, retention: Dict[str, Optional[int]]):
+        # retention: granularity -> seconds to keep (None keeps forever)
+        self.retention = retention
+        self.totals_by_type = Counter()
+        self.totals_by_user = Counter()
+        self.buckets = {name: defaultdict(Counter) for name in GRANULARITIES}
+        self.user_days = defaultdict(Counter)
+
+    @staticmethod
+    def bucket_start(ts: int, granularity: str) -> int:
+        width = GRANULARITIES[granularity]
+        return ts - ts % width
+
+    def add(self, event_type: str, user_id: Optional[int], timestamp_us: int, count: int = 1):
+        ts = timestamp_us // MICROS
+        self.totals_by_type[event_type] += count
+        if user_id is not None:
+            self.totals_by_user[user_id] += count
+            self.user_days[self.bucket_start(ts, "day")][user_id] += count
+        new_bucket = False
+        for granularity, buckets in self.buckets.items():
+            start = self.bucket_start(ts, granularity)
+            new_bucket = new_bucket or start not in buckets
+            buckets[start][event_type] += count
+        if new_bucket:
+            self._prune()
+
+    def _prune(self):
+        for granularity, keep in self.retention.items():
+            if keep is None:
+                continue
+            # Wall clock, so a bogus future timestamp cannot prune everything
+            cutoff = time.time() - keep
+            buckets = self.buckets[granularity] if granularity != "user_day" else self.user_days
+            for start in [s for s in buckets if s < cutoff]:
+                del buckets[start]
+
+    def clear(self):
+        self.totals_by_type.clear()
+        self.totals_by_user.clear()
+        for buckets in self.buckets.values():
+            buckets.clear()
+        self.user_days.clear()
+
+    def _ranged(self, buckets: dict, granularity: str, since: Optional[int], until: Optional[int]):
+        """Yield (bucket_start, counter) for buckets overlapping [since, until]."""
+        low = self.bucket_start(since, granularity) if since is not None else None
+        for start, counts in buckets.items():
+            if low is not None and start < low:
+                continue
+            if until is not None and start > until:
+                continue
+            yield start, counts
+
+    def query(
+        self,
+        group_by: str,
+        granularity: str = "hour",
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        event_type: Optional[str] = None,
+    ) -> List[dict]:
+        """Sum rollups over a time range (epoch seconds, inclusive, widened
+        to whole buckets). group_by is one of event_type, user_id or time."""
+        if since is None and until is None and event_type is None:
+            if group_by == "event_type":
+                return [{"key": k, "count": v} for k, v in self.totals_by_type.items()]
+            if group_by == "user_id":
+                return [{"key": k, "count": v} for k, v in self.totals_by_user.items()]
+
+        if group_by == "user_id":
+            # Per-user counts are only kept per day, across all event types
+            result = Counter()
+            for _, counts in self._ranged(self.user_days, "day", since, until):
+                result.update(counts)
+            return [{"key": k, "count": v} for k, v in result.items()]
+
+        buckets = self.buckets[granularity]
+        if group_by == "time":
+            rows = []
+            for start, counts in sorted(self._ranged(buckets, granularity, since, until)):
+                count = counts[event_type] if event_type is not None else sum(counts.values())
+                if count:
+                    rows.append({"key": start, "count": count})
+            return rows
+
+        result = Counter()
+        for _, counts in self._ranged(buckets, granularity, since, until):
+            if event_type is not None:
+                result[event_type] += counts[event_type]
+            else:
+                result.update(counts)
+        return [{"key": k, "count": v} for k, v in result.items() if v]
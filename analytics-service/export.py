@@ -0,0 +1,135 @@
+"""Streaming bulk export for the Analytics Service.
+
+``GET /events/export`` reads matching events from the store oldest first
+(see ``EventStore.export``) and encodes them batch by batch, so only one
+batch is ever held in memory however many events are exported. Rows are
+``(timestamp_us, user_id, event_type, event_id, data)`` with data as the
+stored JSON bytes, which NDJSON output copies through without decoding.
+
+Two formats are offered:
+
+* NDJSON (``application/x-ndjson``), one event per line with the same
+  fields as ``GET /events`` plus ``id``;
+* an Arrow IPC stream (``application/vnd.apache.arrow.stream``), one record
+  batch per export batch, with event_data as JSON text. This needs the
+  ``pyarrow`` package.
+
+Shards exchange NDJSON; the shard answering an Arrow export parses the
+other shards' lines back into rows.
+"""
+import io
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from typing import AsyncIterator, Iterator, List
+
+import orjson
+from starlette.concurrency import iterate_in_threadpool
+
+from storage import from_micros, to_micros
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # NDJSON only
+    pyarrow = None
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def arrow_available() -> bool:
+    return pyarrow is not None
+
+
+def batched(rows: Iterator[tuple], size: int) -> Iterator[List[tuple]]:
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+async def local_batches(rows: Iterator[tuple], size: int) -> AsyncIterator[List[tuple]]:
+    # Storage reads run in a worker thread, one batch per hop
+    async for batch in iterate_in_threadpool(batched(rows, size)):
+        yield batch
+
+
+@lru_cache(maxsize=1024)
+def _json_string(value: str) -> bytes:
+    return orjson.dumps(value)
+
+
+def ndjson_lines(rows: List[tuple]) -> bytes:
+    lines = []
+    for ts, user_id, event_type, event_id, data in rows:
+        lines.append(b"".join((
+            b'{"id":"', event_id.encode(),
+            b'","user_id":', b"null" if user_id is None else str(user_id).encode(),
+            b',"event_type":', _json_string(event_type),
+            b',"event_data":', data,
+            b',"timestamp":', orjson.dumps(from_micros(ts)),
+            b"}\n",
+        )))
+    return b"".join(lines)
+
+
+async def ndjson_stream(batches: AsyncIterator[List[tuple]]) -> AsyncIterator[bytes]:
+    async for rows in batches:
+        yield ndjson_lines(rows)
+
+
+def _row(line: bytes) -> tuple:
+    event = orjson.loads(line)
+    return (
+        to_micros(datetime.fromisoformat(event["timestamp"])),
+        event["user_id"],
+        event["event_type"],
+        event["id"],
+        orjson.dumps(event["event_data"]),
+    )
+
+
+async def parse_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[tuple]]:
+    """Turn a streamed NDJSON export back into batches of rows."""
+    pending = b""
+    async for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        rows = [_row(line) for line in lines if line.strip()]
+        if rows:
+            yield rows
+    if pending.strip():
+        yield [_row(pending)]
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+async def arrow_stream(batches: AsyncIterator[List[tuple]]) -> AsyncIterator[bytes]:
+    schema = pyarrow.schema([
+        ("id", pyarrow.string()),
+        ("user_id", pyarrow.int64()),
+        ("event_type", pyarrow.string()),
+        ("event_data", pyarrow.string()),
+        ("timestamp", pyarrow.timestamp("us")),
+    ])
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    async for rows in batches:
+        timestamps, user_ids, event_types, event_ids, data = zip(*rows)
+        writer.write_batch(pyarrow.record_batch([
+            pyarrow.array(event_ids, pyarrow.string()),
+            pyarrow.array(user_ids, pyarrow.int64()),
+            pyarrow.array(event_types, pyarrow.string()),
+            pyarrow.array([value.decode() for value in data], pyarrow.string()),
+            pyarrow.array(timestamps, pyarrow.timestamp("us")),
+        ], schema=schema))
+        yield _drain(sink)
+    writer.close()
+    yield _drain(sink)
@@ -0,0 +1,114 @@
+"""Write-behind ingest buffer for the Analytics Service.
+
+Tracked events are queued in a bounded in-process buffer and written to
+storage in groups by a background task, so a request only pays for
+validation and an append to a deque. When the buffer is full, ``offer``
+refuses the whole batch and the endpoint answers 429 so clients back off
+instead of the service growing without bound.
+
+Queued events have already been acknowledged, so a batch the sink fails to
+write goes back to the front of the queue and is retried with exponential
+backoff. While the sink keeps failing, ``failing`` is set and the endpoints
+answer 503 rather than accepting events they cannot store.
+"""
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBuffer:
+    def __init__(
+        self,
+        sink: Callable[[List[tuple]], Awaitable[None]],
+        capacity: int,
+        batch_size: int,
+        flush_interval: float,
+        max_retry_interval: float = 5.0,
+    ):
+        self.sink = sink
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retry_interval = max_retry_interval
+        self.rejected = 0
+        self.write_failures = 0
+        self.failing = False
+        self._items = deque()
+        # Items taken off the queue by a write that has not finished yet
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def offer(self, items: List[tuple]) -> bool:
+        """Queue all items, or none of them if they do not fit."""
+        if len(self._items) + self._in_flight + len(items) > self.capacity:
+            self.rejected += len(items)
+            return False
+        self._items.extend(items)
+        if len(self._items) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def flush(self) -> bool:
+        """Write out everything queued. Returns False if the sink failed, in
+        which case the failed batch is back at the front of the queue."""
+        while self._items:
+            count = min(len(self._items), self.batch_size)
+            batch = [self._items.popleft() for _ in range(count)]
+            self._in_flight = count
+            try:
+                await self.sink(batch)
+            except Exception:
+                logger.exception("Failed to write %d analytics events, will retry", len(batch))
+                self._items.extendleft(reversed(batch))
+                self.write_failures += 1
+                self.failing = True
+                return False
+            finally:
+                self._in_flight = 0
+            self.failing = False
+        return True
+
+    async def _run(self):
+        interval = self.flush_interval
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if await self.flush():
+                interval = self.flush_interval
+            else:
+                interval = min(interval * 2, self.max_retry_interval)
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write out whatever is still queued."""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if not await self.flush():
+            logger.error("Dropping %d unwritten analytics events", len(self._items))
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._items),
+            "capacity": self.capacity,
+            "rejected": self.rejected,
+            "write_failures": self.write_failures,
+            "failing": int(self.failing),
+        }
@@ -1,20 +1,159 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from typing import List, Dict, Optional, Union
+import asyncio
 import logging
+import os
+import socket
+import threading
 from datetime import datetime
 import uuid
+from storage import EventStore, decode_cursor, to_micros
+from aggregates import RollupAggregator
+from sketches import DDSketch, HyperLogLog, SketchAggregator
+from export import (
+    ARROW_CONTENT_TYPE, NDJSON_CONTENT_TYPE, arrow_available, arrow_stream, local_batches, ndjson_stream, parse_ndjson,
+)
+from ingest import IngestBuffer
+from shards import ShardSet, merge_counts, merge_events, merge_sketches, shard_index
+from metrics import LATENCY_BUCKETS, instrument, register_stats
+from tracing import trace_app, tracer
+from logs import configure_logging, pipeline as log_pipeline
+from prometheus_client import Histogram
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # FastAPI app
-app = FastAPI(title="Analytics Service")
+app = FastAPI(title="Analytics Service", default_response_class=ORJSONResponse)
+instrument(app)
+trace_app(app, "analytics-service")
+configure_logging(app, "analytics-service")
 
-# In-memory data store for analytics events
-# For a production app, this would use a database
-analytics_events = []
+# Shards (see shards.py). ANALYTICS_SHARD_URLS lists every shard, this one
+# included, in the same order everywhere; unset means a single shard.
+SHARD_URLS = [url.strip().rstrip("/") for url in os.getenv("ANALYTICS_SHARD_URLS", "").split(",") if url.strip()]
+SHARD_TIMEOUT = float(os.getenv("ANALYTICS_SHARD_TIMEOUT", "5"))  # seconds
+# Signs shard-to-shard requests; must match on every shard
+INTERNAL_AUTH_SECRET = os.getenv("INTERNAL_AUTH_SECRET", "your_internal_secret")
+SHARD_AUTH_MAX_AGE = int(os.getenv("ANALYTICS_SHARD_AUTH_MAX_AGE", "60"))  # seconds
+shards = ShardSet(
+    SHARD_URLS,
+    shard_index(os.getenv("ANALYTICS_SHARD_INDEX"), socket.gethostname()),
+    SHARD_TIMEOUT,
+    INTERNAL_AUTH_SECRET,
+    SHARD_AUTH_MAX_AGE,
+)
+# Dependencies of every /shard/* endpoint
+SHARD_ONLY = [Depends(shards.authorize)]
+
+# Persistent, time-partitioned event store (see storage.py)
+DATA_DIR = os.getenv("ANALYTICS_DATA_DIR", "data")
+if shards.distributed:
+    DATA_DIR = os.path.join(DATA_DIR, f"shard-{shards.index}")
+SEGMENT_SPAN = int(os.getenv("ANALYTICS_SEGMENT_SPAN", "3600"))  # seconds
+SEGMENT_MAX_BYTES = int(os.getenv("ANALYTICS_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+
+event_store = EventStore(DATA_DIR, segment_span=SEGMENT_SPAN, segment_max_bytes=SEGMENT_MAX_BYTES)
+
+# Rollups maintained at ingest time (see aggregates.py)
+ROLLUP_RETENTION = {
+    "minute": int(os.getenv("ROLLUP_MINUTE_RETENTION", str(2 * 86400))),
+    "hour": int(os.getenv("ROLLUP_HOUR_RETENTION", str(90 * 86400))),
+    "day": None,
+    "user_day": int(os.getenv("ROLLUP_USER_DAY_RETENTION", str(90 * 86400))),
+}
+
+def new_rollups() -> RollupAggregator:
+    return RollupAggregator(ROLLUP_RETENTION)
+
+rollups = new_rollups()
+
+# Distinct-user and percentile sketches, also maintained at ingest time
+# (see sketches.py). Precision and accuracy must match on every shard.
+SKETCH_RETENTION = {
+    "hour": int(os.getenv("SKETCH_HOUR_RETENTION", str(7 * 86400))),
+    "day": int(os.getenv("SKETCH_DAY_RETENTION", str(365 * 86400))),
+}
+SKETCH_HLL_PRECISION = int(os.getenv("SKETCH_HLL_PRECISION", "12"))  # 2^p one-byte registers
+SKETCH_RELATIVE_ACCURACY = float(os.getenv("SKETCH_RELATIVE_ACCURACY", "0.01"))
+SKETCH_MAX_BINS = int(os.getenv("SKETCH_MAX_BINS", "2048"))
+# event_data fields to keep percentiles for; unset tracks every numeric
+# field, up to SKETCH_MAX_FIELDS per event type
+SKETCH_FIELDS = {field.strip() for field in os.getenv("SKETCH_FIELDS", "").split(",") if field.strip()} or None
+SKETCH_MAX_FIELDS = int(os.getenv("SKETCH_MAX_FIELDS", "16"))
+# Event types with their own sketches; later ones are folded into "other".
+# Each costs 2^SKETCH_HLL_PRECISION bytes per retained hour and day bucket,
+# about 2.2 MB at the default precision and retention, so the cap bounds
+# distinct-user sketches at about 24 MB
+SKETCH_MAX_EVENT_TYPES = int(os.getenv("SKETCH_MAX_EVENT_TYPES", "10"))
+
+def new_sketches() -> SketchAggregator:
+    return SketchAggregator(
+        SKETCH_RETENTION,
+        precision=SKETCH_HLL_PRECISION,
+        relative_accuracy=SKETCH_RELATIVE_ACCURACY,
+        max_bins=SKETCH_MAX_BINS,
+        fields=SKETCH_FIELDS,
+        max_fields=SKETCH_MAX_FIELDS,
+        max_event_types=SKETCH_MAX_EVENT_TYPES,
+    )
+
+sketches = new_sketches()
+
+# Write-behind buffer between /track and the event store (see ingest.py)
+INGEST_BUFFER_CAPACITY = int(os.getenv("INGEST_BUFFER_CAPACITY", "50000"))
+INGEST_FLUSH_BATCH = int(os.getenv("INGEST_FLUSH_BATCH", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.05"))  # seconds
+INGEST_RETRY_AFTER = os.getenv("INGEST_RETRY_AFTER", "1")  # seconds
+# Longest wait between attempts to write a batch the event store refused
+INGEST_MAX_RETRY_INTERVAL = float(os.getenv("INGEST_MAX_RETRY_INTERVAL", "5"))  # seconds
+TRACK_BATCH_MAX = int(os.getenv("TRACK_BATCH_MAX", "1000"))
+TRACK_BATCH_MAX_BYTES = int(os.getenv("TRACK_BATCH_MAX_BYTES", str(1024 * 1024)))
+
+# Events encoded per chunk of GET /events/export (see export.py)
+EXPORT_BATCH = int(os.getenv("ANALYTICS_EXPORT_BATCH", "1000"))
+
+# Rollups and sketches are rebuilt from the stored events in the background
+# at startup; until that finishes /ready and the endpoints that read them
+# answer 503, and tracked events wait in the ingest buffer
+REBUILD_RETRY_AFTER = os.getenv("ANALYTICS_REBUILD_RETRY_AFTER", "5")  # seconds
+aggregates_ready = False
+rebuild_task: Optional[asyncio.Task] = None
+rebuild_stopping = threading.Event()
+
+INGEST_FLUSH_DURATION = Histogram(
+    "analytics_ingest_flush_duration_seconds",
+    "Time to append one buffered batch to the event store",
+    buckets=LATENCY_BUCKETS,
+)
+
+async def persist_events(batch: List[tuple]):
+    with INGEST_FLUSH_DURATION.time():
+        await run_in_threadpool(event_store.append_batch, batch)
+    # Rollups and sketches are only touched from the event loop
+    for _, event_type, user_id, event_data, timestamp in batch:
+        timestamp_us = to_micros(timestamp)
+        rollups.add(event_type, user_id, timestamp_us)
+        sketches.add(event_type, user_id, event_data, timestamp_us)
+
+ingest_buffer = IngestBuffer(
+    persist_events,
+    capacity=INGEST_BUFFER_CAPACITY,
+    batch_size=INGEST_FLUSH_BATCH,
+    flush_interval=INGEST_FLUSH_INTERVAL,
+    max_retry_interval=INGEST_MAX_RETRY_INTERVAL,
+)
+
+register_stats("analytics_ingest", ingest_buffer.stats)
+register_stats("analytics_store", event_store.stats)
+register_stats("analytics_shards", shards.stats)
+# Looked up on every scrape, since the rebuild replaces the aggregator
+register_stats("analytics_sketches", lambda: sketches.stats())
+register_stats("tracing", tracer.stats)
+register_stats("logging", log_pipeline.stats)
 
 # Models
 class AnalyticsEvent(BaseModel):
@@ -28,15 +167,92 @@ class AnalyticsResponse(BaseModel):
     status: str
     message: str
 
+class BatchTrackResponse(BaseModel):
+    status: str
+    accepted: int
+    event_ids: List[str]
+
 class EventSummary(BaseModel):
     event_type: str
     count: int
 
+class RollupEntry(BaseModel):
+    key: Union[str, int, datetime]
+    count: int
+
+class PercentileEntry(BaseModel):
+    key: Union[str, datetime]
+    count: int
+    min: float
+    max: float
+    mean: float
+    percentiles: Dict[str, float]
+
+event_adapter = TypeAdapter(AnalyticsEvent)
+event_list_adapter = TypeAdapter(List[AnalyticsEvent])
+# Fields of a stored event that GET /events returns
+EVENT_FIELDS = tuple(AnalyticsEvent.model_fields)
+
+def enqueue(events: List[AnalyticsEvent]) -> List[str]:
+    """Queue validated events for the background writer and return their ids."""
+    if ingest_buffer.failing:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Event storage is failing, retry later",
+            headers={"Retry-After": INGEST_RETRY_AFTER},
+        )
+    now = datetime.utcnow()
+    items = [
+        (str(uuid.uuid4()), event.event_type, event.user_id, event.event_data, event.timestamp or now)
+        for event in events
+    ]
+    if not ingest_buffer.offer(items):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Ingest buffer is full, retry later",
+            headers={"Retry-After": INGEST_RETRY_AFTER},
+        )
+    return [item[0] for item in items]
+
+async def read_body(request: Request, limit: int) -> bytes:
+    """The request body, refused with 413 as soon as it is known to be
+    longer than ``limit`` bytes, without reading the rest."""
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"At most {limit} bytes per batch",
+    )
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise too_large
+    return bytes(body)
+
+def aggregates_rebuilt():
+    """Dependency of the endpoints that read rollups or sketches"""
+    if not aggregates_ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Rollups are being rebuilt, retry later",
+            headers={"Retry-After": REBUILD_RETRY_AFTER},
+        )
+
+AGGREGATES = [Depends(aggregates_rebuilt)]
+
 # API Endpoints
 @app.get("/")
 def read_root():
     return {"message": "Analytics Service Running"}
 
+@app.get("/ready")
+async def ready():
+    """Ready once rollups and sketches are rebuilt and ingest is running"""
+    aggregates_rebuilt()
+    return {"status": "ready"}
+
 @app.post("/track", response_model=AnalyticsResponse)
 async def track_event(event: AnalyticsEvent):
     """
@@ -48,61 +264,313 @@ async def track_event(event: AnalyticsEvent):
     - logout
     - etc.
     """
-    # Generate a unique ID for the event
-    event_id = str(uuid.uuid4())
+    event_id = enqueue([event])[0]
     
-    # Set timestamp if not provided
-    if not event.timestamp:
-        event.timestamp = datetime.utcnow()
-        
-    # Store the event
-    analytics_events.append({
-        "id": event_id,
-        **event.dict()
-    })
-    
-    logger.info(f"Tracked event: {event.event_type} for user {event.user_id}")
+    logger.debug("Tracked event", extra={"event_type": event.event_type, "user_id": event.user_id})
     
-    return {
+    return ORJSONResponse({
         "event_id": event_id,
         "status": "success",
         "message": "Event tracked successfully"
-    }
+    })
+
+@app.post("/track/batch", response_model=BatchTrackResponse)
+async def track_batch(request: Request):
+    """Track many events in one request, sent either as a JSON array or as
+    newline-delimited JSON (Content-Type: application/x-ndjson)."""
+    body = await read_body(request, TRACK_BATCH_MAX_BYTES)
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            events = [event_adapter.validate_json(line) for line in body.splitlines() if line.strip()]
+        else:
+            events = event_list_adapter.validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(), body=body)
+    if len(events) > TRACK_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {TRACK_BATCH_MAX} events per batch",
+        )
+
+    event_ids = enqueue(events)
+    logger.debug("Tracked batch", extra={"accepted": len(event_ids)})
+    return ORJSONResponse({"status": "success", "accepted": len(event_ids), "event_ids": event_ids})
+
+@app.get("/ingest/stats")
+async def ingest_stats():
+    """Depth and rejections of the write-behind ingest buffer"""
+    return ingest_buffer.stats()
+
+def epoch_seconds(value: Optional[datetime]) -> Optional[int]:
+    return to_micros(value) // 1_000_000 if value is not None else None
+
+async def query_events(event_type, user_id, since, until, limit, cursor):
+    try:
+        # Reads segment files, so it stays off the event loop
+        return await run_in_threadpool(event_store.query, event_type, user_id, since, until, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
 @app.get("/events", response_model=List[AnalyticsEvent])
-async def get_events(event_type: Optional[str] = None, limit: int = 100):
-    """Get most recent analytics events, optionally filtered by event_type"""
-    filtered_events = analytics_events
-    
-    if event_type:
-        filtered_events = [e for e in analytics_events if e["event_type"] == event_type]
-        
-    # Return most recent events first, limited to requested amount
-    return sorted(filtered_events, key=lambda x: x["timestamp"], reverse=True)[:limit]
+async def get_events(
+    event_type: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+):
+    """Get most recent analytics events, optionally filtered by event_type,
+    user_id and time range. When more results exist, the X-Next-Cursor
+    response header holds the cursor for the next page."""
+    if not shards.distributed:
+        events, next_cursor = await query_events(event_type, user_id, since, until, limit, cursor)
+    else:
+        try:
+            if cursor is not None:
+                decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+        async def local_page():
+            return (await query_events(event_type, user_id, since, until, limit, cursor))[0]
+
+        params = {"event_type": event_type, "user_id": user_id, "since": since,
+                  "until": until, "limit": limit, "cursor": cursor}
+        pages = await shards.gather("GET", "/shard/events", params, local_page)
+        events, next_cursor = merge_events(pages, limit)
+    # Stored events are already valid, so serialize them directly instead of
+    # validating every one again against the response model
+    return ORJSONResponse(
+        [{field: event[field] for field in EVENT_FIELDS} for event in events],
+        headers={"X-Next-Cursor": next_cursor} if next_cursor is not None else None,
+    )
+
+@app.get("/shard/events", include_in_schema=False, dependencies=SHARD_ONLY)
+async def shard_events(
+    event_type: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+):
+    """This shard's part of GET /events, with event ids for merging"""
+    events, _ = await query_events(event_type, user_id, since, until, limit, cursor)
+    return ORJSONResponse(events)
 
-@app.get("/summary", response_model=List[EventSummary])
+def local_export(event_type, user_id, since, until):
+    return local_batches(event_store.export(event_type, user_id, since, until), EXPORT_BATCH)
+
+@app.get("/events/export")
+async def export_events(
+    format: str = Query("ndjson", pattern="^(ndjson|arrow)$"),
+    event_type: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Stream every matching event, oldest first, as newline-delimited JSON
+    or as an Arrow IPC stream. Events are read and sent a batch at a time,
+    so exports of any size run in constant memory. With several shards,
+    each shard's events follow the previous shard's."""
+    if format == "arrow" and not arrow_available():
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Arrow export needs pyarrow")
+    params = {"event_type": event_type, "user_id": user_id, "since": since, "until": until}
+    local = lambda: local_export(event_type, user_id, since, until)
+    if format == "ndjson":
+        content = shards.stream("/shard/events/export", params, lambda: ndjson_stream(local()))
+        return StreamingResponse(content, media_type=NDJSON_CONTENT_TYPE)
+    content = arrow_stream(shards.stream("/shard/events/export", params, local, parse_ndjson))
+    return StreamingResponse(content, media_type=ARROW_CONTENT_TYPE)
+
+@app.get("/shard/events/export", include_in_schema=False, dependencies=SHARD_ONLY)
+async def shard_export(
+    event_type: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """This shard's part of GET /events/export, as NDJSON"""
+    content = ndjson_stream(local_export(event_type, user_id, since, until))
+    return StreamingResponse(content, media_type=NDJSON_CONTENT_TYPE)
+
+@app.get("/summary", response_model=List[EventSummary], dependencies=AGGREGATES)
 async def get_summary():
     """Get a summary count of events by type"""
-    event_counts = {}
-    
-    for event in analytics_events:
-        event_type = event["event_type"]
-        if event_type in event_counts:
-            event_counts[event_type] += 1
-        else:
-            event_counts[event_type] = 1
-    
-    return [{"event_type": k, "count": v} for k, v in event_counts.items()]
+    rows = merge_counts(await shards.gather(
+        "GET", "/shard/rollup", {"group_by": "event_type"}, lambda: shard_rollup("event_type", "hour", None, None, None)
+    ))
+    return [{"event_type": row["key"], "count": row["count"]} for row in rows]
+
+@app.get("/summary/rollup", response_model=List[RollupEntry], dependencies=AGGREGATES)
+async def get_rollup(
+    group_by: str = Query("event_type", pattern="^(event_type|user_id|time)$"),
+    bucket: str = Query("hour", pattern="^(minute|hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+):
+    """Count events over a time range from the pre-aggregated rollups.
+
+    The range is widened to whole buckets of the chosen granularity.
+    group_by=user_id always uses day buckets and ignores event_type.
+    """
+    params = {"group_by": group_by, "bucket": bucket, "since": since, "until": until, "event_type": event_type}
+    rows = merge_counts(await shards.gather(
+        "GET", "/shard/rollup", params, lambda: shard_rollup(group_by, bucket, since, until, event_type)
+    ), ordered=group_by == "time")
+    if group_by == "time":
+        rows = [{"key": datetime.utcfromtimestamp(r["key"]), "count": r["count"]} for r in rows]
+    return rows
+
+@app.get("/shard/rollup", include_in_schema=False, dependencies=SHARD_ONLY + AGGREGATES)
+async def shard_rollup(
+    group_by: str = Query("event_type", pattern="^(event_type|user_id|time)$"),
+    bucket: str = Query("hour", pattern="^(minute|hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+):
+    """This shard's rollup rows, with time buckets as epoch seconds"""
+    return rollups.query(group_by, bucket, epoch_seconds(since), epoch_seconds(until), event_type)
+
+@app.get("/summary/unique-users", response_model=List[RollupEntry], dependencies=AGGREGATES)
+async def get_unique_users(
+    group_by: str = Query("event_type", pattern="^(event_type|time|all)$"),
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+):
+    """Estimate distinct users over a time range from HyperLogLog sketches
+    (about 1.6% standard error at the default precision).
+
+    The range is widened to whole buckets; hour buckets are only kept for
+    SKETCH_HOUR_RETENTION. group_by=all counts users across event types.
+    """
+    params = {"group_by": group_by, "bucket": bucket, "since": since, "until": until, "event_type": event_type}
+    merged = merge_sketches(await shards.gather(
+        "GET", "/shard/sketch/users", params, lambda: shard_unique_users(group_by, bucket, since, until, event_type)
+    ), HyperLogLog.from_dict, ordered=group_by == "time")
+    return [
+        {"key": datetime.utcfromtimestamp(key) if group_by == "time" else key, "count": round(users.estimate())}
+        for key, users in merged
+    ]
 
-@app.delete("/events")
+@app.get("/shard/sketch/users", include_in_schema=False, dependencies=SHARD_ONLY + AGGREGATES)
+async def shard_unique_users(
+    group_by: str = Query("event_type", pattern="^(event_type|time|all)$"),
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+):
+    """This shard's merged distinct-user sketches, serialized"""
+    merged = sketches.unique_users(group_by, bucket, epoch_seconds(since), epoch_seconds(until), event_type)
+    return [{"key": key, "sketch": users.to_dict()} for key, users in merged.items()]
+
+@app.get("/summary/percentiles", response_model=List[PercentileEntry], dependencies=AGGREGATES)
+async def get_percentiles(
+    event_type: str,
+    field: str,
+    q: List[float] = Query([0.5, 0.9, 0.95, 0.99]),
+    group_by: str = Query("all", pattern="^(all|time)$"),
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Percentiles of a numeric event_data field of one event type over a
+    time range, from DDSketches (within SKETCH_RELATIVE_ACCURACY of the
+    true value). Percentiles are keyed like p50, p99.9."""
+    if not all(0 <= quantile <= 1 for quantile in q):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Quantiles must be between 0 and 1")
+    params = {"event_type": event_type, "field": field, "group_by": group_by,
+              "bucket": bucket, "since": since, "until": until}
+    merged = merge_sketches(await shards.gather(
+        "GET", "/shard/sketch/values", params, lambda: shard_values(event_type, field, group_by, bucket, since, until)
+    ), DDSketch.from_dict, ordered=group_by == "time")
+    return [
+        {
+            "key": datetime.utcfromtimestamp(key) if group_by == "time" else key,
+            "count": sketch.count,
+            "min": sketch.min,
+            "max": sketch.max,
+            "mean": sketch.sum / sketch.count,
+            "percentiles": {f"p{quantile * 100:g}": sketch.quantile(quantile) for quantile in q},
+        }
+        for key, sketch in merged
+    ]
+
+@app.get("/shard/sketch/values", include_in_schema=False, dependencies=SHARD_ONLY + AGGREGATES)
+async def shard_values(
+    event_type: str,
+    field: str,
+    group_by: str = Query("all", pattern="^(all|time)$"),
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """This shard's merged sketches of one event_data field, serialized"""
+    merged = sketches.values(event_type, field, group_by, bucket, epoch_seconds(since), epoch_seconds(until))
+    return [{"key": key, "sketch": sketch.to_dict()} for key, sketch in merged.items()]
+
+@app.delete("/events", dependencies=AGGREGATES)
 async def clear_events():
     """Clear all analytics events (for demo purposes)"""
-    analytics_events.clear()
+    await shards.gather("DELETE", "/shard/events", {}, clear_shard)
     return {"message": "All events cleared"}
 
-# Add some demo events on startup
-@app.on_event("startup")
-async def startup_event():
+@app.delete("/shard/events", include_in_schema=False, dependencies=SHARD_ONLY + AGGREGATES)
+async def clear_shard():
+    """Clear this shard's events"""
+    await ingest_buffer.flush()
+    event_store.clear()
+    rollups.clear()
+    sketches.clear()
+    return {"message": "Shard cleared"}
+
+def replay_events():
+    """Rollups and sketches of every stored event, built from scratch.
+
+    Runs in a worker thread, so it builds new aggregators instead of
+    touching the ones the event loop reads.
+    """
+    replayed_rollups, replayed_sketches = new_rollups(), new_sketches()
+    for timestamp_us, event_type, user_id, event_data in event_store.scan_meta(with_data=True):
+        if rebuild_stopping.is_set():
+            break
+        replayed_rollups.add(event_type, user_id, timestamp_us)
+        replayed_sketches.add(event_type, user_id, event_data, timestamp_us)
+    return replayed_rollups, replayed_sketches
+
+async def rebuild_aggregates():
+    """Rebuild rollups and sketches off the event loop, then start ingest.
+
+    The ingest writer is held back until the swap, so events tracked in the
+    meantime are neither missed by the replay nor counted twice.
+    """
+    global rollups, sketches, aggregates_ready
+    try:
+        replayed_rollups, replayed_sketches = await run_in_threadpool(replay_events)
+    except Exception:
+        # Stays unready, so the readiness probe keeps traffic away
+        logger.exception("Failed to rebuild rollups and sketches")
+        return
+    if rebuild_stopping.is_set():
+        return
+    rollups, sketches = replayed_rollups, replayed_sketches
+    ingest_buffer.start()
+    aggregates_ready = True
+    logger.info("Rebuilt rollups and sketches", extra={"event_types": len(rollups.totals_by_type)})
+    await add_demo_events()
+
+# Add some demo events on startup (only into an empty store)
+async def add_demo_events():
+    # Demo events go to the first shard only, so queries see them once
+    if rollups.totals_by_type or shards.index != 0:
+        return
+
     demo_events = [
         {"user_id": 1, "event_type": "login", "event_data": {"ip": "192.168.1.1"}},
         {"user_id": 2, "event_type": "page_view", "event_data": {"page": "home"}},
@@ -114,4 +582,19 @@ async def startup_event():
     for event in demo_events:
         await track_event(AnalyticsEvent(**event))
         
-    logger.info(f"Added {len(demo_events)} demo events") 
\ No newline at end of file
+    logger.info("Added %d demo events", len(demo_events))
+
+@app.on_event("startup")
+async def startup_event():
+    # Serve (and answer the liveness probe) while the rebuild runs
+    global rebuild_task
+    rebuild_task = asyncio.get_running_loop().create_task(rebuild_aggregates())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if rebuild_task is not None and not rebuild_task.done():
+        rebuild_stopping.set()
+        await asyncio.gather(rebuild_task, return_exceptions=True)
+    await ingest_buffer.stop()
+    await shards.close()
+    event_store.close()
@@ -0,0 +1,239 @@
+"""Shared-nothing sharding for the Analytics Service.
+
+A shard is one analytics process with its own event store and rollups.
+Shards are listed in ``ANALYTICS_SHARD_URLS``, in the same order on every
+shard, and each shard learns its own position from
+``ANALYTICS_SHARD_INDEX``. Without that variable the position comes from
+the ordinal suffix of a StatefulSet pod's hostname (``analytics-service-2``).
+
+Ingest never crosses shards: whichever shard receives a ``/track``
+request stores the events, so adding shards adds ingest capacity. Reads
+are scatter-gather. The shard that receives a query asks every shard,
+itself included, through the internal ``/shard/*`` endpoints, and merges
+the answers:
+
+* event pages are merged on the global (timestamp, event id) order that
+  cursors already encode, so a cursor from a merged page is valid on
+  every shard;
+* rollup counts are summed per key;
+* sketches (see sketches.py) are merged per key;
+* exports are streamed shard after shard, without buffering.
+
+With no shard URLs configured the service is a single shard, and queries
+never leave the process.
+
+The ``/shard/*`` endpoints trust whoever calls them, so every shard
+request is signed with ``INTERNAL_AUTH_SECRET`` (HMAC of the method, path
+and a timestamp) and the endpoints reject unsigned or stale requests. The
+API Gateway does not route to them either.
+"""
+import asyncio
+import hashlib
+import hmac
+import re
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+import httpx
+import orjson
+from fastapi import HTTPException, Request, status
+
+from storage import encode_cursor
+from tracing import tracer
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def shard_index(explicit: Optional[str], hostname: str) -> int:
+    if explicit:
+        return int(explicit)
+    match = re.search(r"-(\d+)$", hostname)
+    return int(match.group(1)) if match else 0
+
+
+def sign_shard_request(secret: str, method: str, path: str, timestamp: str) -> str:
+    message = f"{method}|{path}|{timestamp}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+class ShardSet:
+    def __init__(self, urls: List[str], index: int, timeout: float, secret: str, max_age: float = 60):
+        if urls and not 0 <= index < len(urls):
+            raise ValueError(f"Shard index {index} is outside ANALYTICS_SHARD_URLS ({len(urls)} shards)")
+        self.urls = urls
+        self.index = index if urls else 0
+        self.timeout = timeout
+        self.secret = secret
+        self.max_age = max_age
+        self.requests = 0
+        self.rejected = 0
+        self.failures = 0
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def distributed(self) -> bool:
+        return len(self.urls) > 1
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    def _headers(self, method: str, path: str) -> dict:
+        timestamp = str(int(time.time()))
+        return tracer.inject({
+            "X-Shard-Timestamp": timestamp,
+            "X-Shard-Signature": sign_shard_request(self.secret, method, path, timestamp),
+        })
+
+    def authorize(self, request: Request):
+        """FastAPI dependency for the /shard/* endpoints: only other shards,
+        signing with the shared secret, may call them."""
+        timestamp = request.headers.get("x-shard-timestamp", "")
+        signature = request.headers.get("x-shard-signature", "")
+        try:
+            fresh = abs(time.time() - int(timestamp)) <= self.max_age
+        except ValueError:
+            fresh = False
+        expected = sign_shard_request(self.secret, request.method, request.url.path, timestamp)
+        if not fresh or not hmac.compare_digest(expected, signature):
+            self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Shard endpoints are internal")
+
+    async def _remote(self, method: str, url: str, path: str, params: dict):
+        url += path
+        self.requests += 1
+        try:
+            response = await self._get_client().request(
+                method, url, params=params, headers=self._headers(method, path)
+            )
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Analytics shard {url} unavailable: {e}",
+            )
+        if response.status_code != 200:
+            self.failures += 1
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"Analytics shard {url} returned {response.status_code}",
+            )
+        return orjson.loads(response.content)
+
+    async def _remote_stream(self, url: str, path: str, params: dict) -> AsyncIterator[bytes]:
+        url += path
+        self.requests += 1
+        try:
+            headers = self._headers("GET", path)
+            async with self._get_client().stream("GET", url, params=params, headers=headers) as response:
+                if response.status_code != 200:
+                    self.failures += 1
+                    raise HTTPException(
+                        status_code=status.HTTP_502_BAD_GATEWAY,
+                        detail=f"Analytics shard {url} returned {response.status_code}",
+                    )
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Analytics shard {url} unavailable: {e}",
+            )
+
+    @staticmethod
+    def _query_params(params: dict) -> dict:
+        return {
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in params.items()
+            if value is not None
+        }
+
+    async def gather(self, method: str, path: str, params: dict, local: Callable[[], Awaitable]) -> list:
+        """Run a request on every shard, answering this shard's part with
+        ``local`` instead of a round-trip to itself."""
+        if not self.distributed:
+            return [await local()]
+        params = self._query_params(params)
+        return await asyncio.gather(*(
+            local() if i == self.index else self._remote(method, url, path, params)
+            for i, url in enumerate(self.urls)
+        ))
+
+    async def stream(
+        self,
+        path: str,
+        params: dict,
+        local: Callable[[], AsyncIterator],
+        remote: Callable[[AsyncIterator[bytes]], AsyncIterator] = lambda body: body,
+    ) -> AsyncIterator:
+        """Stream a GET from every shard in turn: ``local()`` for this shard,
+        and each other shard's body passed through ``remote``. A shard that
+        fails part way cuts the stream short."""
+        if not self.distributed:
+            async for part in local():
+                yield part
+            return
+        params = self._query_params(params)
+        for i, url in enumerate(self.urls):
+            parts = local() if i == self.index else remote(self._remote_stream(url, path, params))
+            async for part in parts:
+                yield part
+
+    def stats(self) -> dict:
+        return {
+            "shards": max(len(self.urls), 1),
+            "index": self.index,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def event_key(event: dict) -> Tuple[int, bytes]:
+    timestamp = event["timestamp"]
+    if isinstance(timestamp, str):
+        # Events from other shards arrive as JSON
+        timestamp = datetime.fromisoformat(timestamp)
+    # Exact integer microseconds, so keys match the ones the store encodes
+    return (timestamp - EPOCH) // MICROSECOND, uuid.UUID(event["id"]).bytes
+
+
+def merge_events(pages: List[List[dict]], limit: int) -> Tuple[List[dict], Optional[str]]:
+    """Merge newest-first pages from each shard into one page and its cursor."""
+    events = sorted((event for page in pages for event in page), key=event_key, reverse=True)[:limit]
+    next_cursor = encode_cursor(event_key(events[-1])) if len(events) == limit else None
+    return events, next_cursor
+
+
+def merge_counts(results: List[List[dict]], ordered: bool = False) -> List[dict]:
+    counts = Counter()
+    for rows in results:
+        for row in rows:
+            counts[row["key"]] += row["count"]
+    keys = sorted(counts) if ordered else counts
+    return [{"key": key, "count": counts[key]} for key in keys]
+
+
+def merge_sketches(results: List[List[dict]], decode: Callable[[dict], Any], ordered: bool = False) -> List[tuple]:
+    """Merge serialized sketch rows from each shard into (key, sketch) pairs."""
+    merged = {}
+    for rows in results:
+        for row in rows:
+            sketch = decode(row["sketch"])
+            if row["key"] in merged:
+                merged[row["key"]].merge(sketch)
+            else:
+                merged[row["key"]] = sketch
+    keys = sorted(merged) if ordered else merged
+    return [(key, merged[key]) for key in keys]
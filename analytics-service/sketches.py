@@ -0,0 +1,470 @@
+"""Mergeable sketches for approximate analytics, maintained at ingest time.
+
+Two kinds of sketch are kept per (bucket, event_type) at hour and day
+granularity:
+
+* a HyperLogLog of ``user_id`` for distinct-user counts. With the default
+  precision of 12 it is 4 KB of registers and estimates within about 1.6%
+  (one standard error), whatever the number of users;
+* a DDSketch for each numeric top-level ``event_data`` field, for
+  percentiles. Values are counted in logarithmic bins, so any quantile is
+  returned within the configured relative accuracy (1% by default). One
+  bin covers a factor of about 1.02, so a field spanning six orders of
+  magnitude needs about 700 bins, 8 bytes each, and the bin count is
+  capped (the lowest bins are collapsed beyond the cap).
+
+Both sketches merge losslessly: merging the sketches of two buckets, or of
+two shards, gives the sketch of the combined events. Queries over a range
+merge the buckets it covers, and shards send their merged sketches to the
+querying shard, which merges those. Sketches only merge when built with
+the same precision or accuracy, so every shard must be configured alike.
+
+Which ``event_data`` fields get a percentile sketch is configurable; by
+default every numeric field is tracked, up to a cap per event type so that
+a client sending arbitrary keys cannot grow memory without bound.
+
+Event types are capped the same way. Every tracked event type costs a
+dense HyperLogLog in every hour and day bucket, so the first
+``max_event_types`` types seen get their own sketches. Later types are
+folded into a single ``other`` series, and memory stays bounded by the cap
+times the number of retained buckets. As with fields, which types are
+tracked depends on arrival order, so shards can differ for types seen
+after the cap is reached.
+"""
+import base64
+import math
+import time
+import zlib
+from array import array
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Optional, Set
+
+MICROS = 1_000_000
+MASK64 = (1 << 64) - 1
+
+# Sketches of event types past the cap are kept under this name
+OTHER_EVENT_TYPES = "other"
+
+GRANULARITIES = {
+    "hour": 3600,
+    "day": 86400,
+}
+
+# Magnitudes below this count as zero
+MIN_VALUE = 1e-9
+
+
+def hash_user(user_id: int) -> int:
+    """splitmix64: spreads sequential ids over all 64 bits."""
+    z = (user_id + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def _sigma(x: float) -> float:
+    if x == 1:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous, z = z, z + x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x: float) -> float:
+    if x == 0 or x == 1:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        y *= 0.5
+        previous, z = z, z - (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+class HyperLogLog:
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = 12, registers: Optional[bytearray] = None):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add_hash(self, value: int):
+        """Add a 64-bit hash (see hash_user)."""
+        width = 64 - self.precision
+        index = value >> width
+        rank = width - (value & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> float:
+        """Ertl's improved estimator: unbiased from a handful of users up,
+        without the switch to linear counting of the original HyperLogLog."""
+        m = len(self.registers)
+        width = 64 - self.precision
+        histogram = [self.registers.count(rank) for rank in range(width + 2)]
+        z = m * _tau(1 - histogram[width + 1] / m)
+        for rank in range(width, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        z += m * _sigma(histogram[0] / m)
+        return m * m / (2 * math.log(2) * z)
+
+    def nbytes(self) -> int:
+        return len(self.registers)
+
+    def to_dict(self) -> dict:
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(zlib.compress(self.registers)).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HyperLogLog":
+        registers = bytearray(zlib.decompress(base64.b64decode(data["registers"])))
+        if len(registers) != 1 << data["precision"]:
+            raise ValueError("HyperLogLog registers do not match its precision")
+        return cls(data["precision"], registers)
+
+
+class _Bins:
+    """Contiguous bin counts starting at bin index ``offset``."""
+
+    __slots__ = ("offset", "counts")
+
+    def __init__(self, offset: int = 0, counts: Iterable[int] = ()):
+        self.offset = offset
+        self.counts = array("Q", counts)
+
+    def add(self, index: int, count: int, max_bins: int):
+        counts = self.counts
+        if not counts:
+            self.offset = index
+            counts.append(count)
+            return
+        top = self.offset + len(counts) - 1
+        if index > top:
+            counts.extend(array("Q", bytes(8 * (index - top))))
+            if len(counts) > max_bins:
+                # Fold the lowest bins into the lowest one that is kept
+                drop = len(counts) - max_bins
+                collapsed = sum(counts[:drop + 1])
+                del counts[:drop]
+                counts[0] = collapsed
+                self.offset += drop
+        elif index < self.offset:
+            low = max(index, top - max_bins + 1)
+            if low < self.offset:
+                self.counts = counts = array("Q", bytes(8 * (self.offset - low))) + counts
+                self.offset = low
+            index = low
+        counts[index - self.offset] += count
+
+    def merge(self, other: "_Bins", max_bins: int):
+        for i, count in enumerate(other.counts):
+            if count:
+                self.add(other.offset + i, count, max_bins)
+
+    def to_dict(self) -> dict:
+        return {"offset": self.offset, "counts": self.counts.tolist()}
+
+
+class DDSketch:
+    __slots__ = (
+        "relative_accuracy", "max_bins", "_gamma", "_log_gamma",
+        "positive", "negative", "zero_count", "count", "sum", "min", "max",
+    )
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("DDSketch relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        # Negative values are binned by magnitude
+        self.positive = _Bins()
+        self.negative = _Bins()
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, magnitude: float) -> int:
+        return math.ceil(math.log(magnitude) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        # Within relative_accuracy of both ends of the bin (gamma^(i-1), gamma^i]
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value: float):
+        if value > MIN_VALUE:
+            self.positive.add(self._index(value), 1, self.max_bins)
+        elif value < -MIN_VALUE:
+            self.negative.add(self._index(-value), 1, self.max_bins)
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "DDSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge DDSketches of different relative accuracy")
+        self.positive.merge(other.positive, self.max_bins)
+        self.negative.merge(other.negative, self.max_bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        value = None
+        negative = self.negative
+        for i in range(len(negative.counts) - 1, -1, -1):
+            seen += negative.counts[i]
+            if seen > rank:
+                value = -self._value(negative.offset + i)
+                break
+        else:
+            seen += self.zero_count
+            if seen > rank:
+                value = 0.0
+            else:
+                positive = self.positive
+                for i, count in enumerate(positive.counts):
+                    seen += count
+                    if seen > rank:
+                        value = self._value(positive.offset + i)
+                        break
+                else:
+                    value = self.max
+        return min(max(value, self.min), self.max)
+
+    def nbytes(self) -> int:
+        return 8 * (len(self.positive.counts) + len(self.negative.counts))
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "positive": self.positive.to_dict(),
+            "negative": self.negative.to_dict(),
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DDSketch":
+        sketch = cls(data["relative_accuracy"], data["max_bins"])
+        sketch.positive = _Bins(**data["positive"])
+        sketch.negative = _Bins(**data["negative"])
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+class _Bucket:
+    __slots__ = ("users", "values")
+
+    def __init__(self):
+        self.users: Dict[str, HyperLogLog] = {}
+        self.values: Dict[tuple, DDSketch] = {}
+
+
+class SketchAggregator:
+    def __init__(
+        self,
+        retention: Dict[str, Optional[int]],
+        precision: int = 12,
+        relative_accuracy: float = 0.01,
+        max_bins: int = 2048,
+        fields: Optional[Set[str]] = None,
+        max_fields: int = 16,
+        max_event_types: int = 10,
+    ):
+        # retention: granularity -> seconds to keep (None keeps forever)
+        self.retention = retention
+        self.precision = precision
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        # fields: event_data fields to sketch; None tracks every numeric
+        # field, up to max_fields per event type
+        self.fields = fields
+        self.max_fields = max_fields
+        self.fields_by_type: Dict[str, Set[str]] = defaultdict(set)
+        self.max_event_types = max_event_types
+        self.event_types: Set[str] = set()
+        self.folded = 0
+        self.buckets = {name: defaultdict(_Bucket) for name in GRANULARITIES}
+
+    def _numeric(self, event_type: str, data: dict) -> list:
+        values = []
+        for field, value in data.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                continue
+            if self.fields is not None:
+                if field not in self.fields:
+                    continue
+            else:
+                tracked = self.fields_by_type[event_type]
+                if field not in tracked:
+                    if len(tracked) >= self.max_fields:
+                        continue
+                    tracked.add(field)
+            values.append((field, value))
+        return values
+
+    def _tracked_type(self, event_type: str) -> str:
+        if event_type in self.event_types:
+            return event_type
+        if len(self.event_types) < self.max_event_types:
+            self.event_types.add(event_type)
+            return event_type
+        self.folded += 1
+        return OTHER_EVENT_TYPES
+
+    def add(self, event_type: str, user_id: Optional[int], data: Optional[dict], timestamp_us: int):
+        ts = timestamp_us // MICROS
+        user_hash = hash_user(user_id) if user_id is not None else None
+        if user_hash is None and not data:
+            return
+        event_type = self._tracked_type(event_type)
+        values = self._numeric(event_type, data) if data else ()
+        if user_hash is None and not values:
+            return
+        new_bucket = False
+        for granularity, buckets in self.buckets.items():
+            start = ts - ts % GRANULARITIES[granularity]
+            new_bucket = new_bucket or start not in buckets
+            bucket = buckets[start]
+            if user_hash is not None:
+                users = bucket.users.get(event_type)
+                if users is None:
+                    users = bucket.users[event_type] = HyperLogLog(self.precision)
+                users.add_hash(user_hash)
+            for field, value in values:
+                sketch = bucket.values.get((event_type, field))
+                if sketch is None:
+                    sketch = bucket.values[(event_type, field)] = DDSketch(self.relative_accuracy, self.max_bins)
+                sketch.add(value)
+        if new_bucket:
+            self._prune()
+
+    def _prune(self):
+        for granularity, keep in self.retention.items():
+            if keep is None:
+                continue
+            # Wall clock, so a bogus future timestamp cannot prune everything
+            cutoff = time.time() - keep
+            buckets = self.buckets[granularity]
+            for start in [s for s in buckets if s < cutoff]:
+                del buckets[start]
+
+    def clear(self):
+        self.fields_by_type.clear()
+        self.event_types.clear()
+        self.folded = 0
+        for buckets in self.buckets.values():
+            buckets.clear()
+
+    def _ranged(self, granularity: str, since: Optional[int], until: Optional[int]):
+        """Yield (bucket_start, bucket) for buckets overlapping [since, until]."""
+        width = GRANULARITIES[granularity]
+        low = since - since % width if since is not None else None
+        for start, bucket in self.buckets[granularity].items():
+            if low is not None and start < low:
+                continue
+            if until is not None and start > until:
+                continue
+            yield start, bucket
+
+    @staticmethod
+    def _merge_into(merged: dict, key, sketch, copy: Callable):
+        if key in merged:
+            merged[key].merge(sketch)
+        else:
+            # Copy, so merging never changes a stored sketch
+            merged[key] = copy(sketch)
+
+    def unique_users(
+        self,
+        group_by: str,
+        granularity: str = "hour",
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        event_type: Optional[str] = None,
+    ) -> Dict[object, HyperLogLog]:
+        """Merge distinct-user sketches over a time range (epoch seconds,
+        inclusive, widened to whole buckets). group_by is one of event_type,
+        time or all."""
+        copy = lambda users: HyperLogLog(users.precision, bytearray(users.registers))
+        merged = {}
+        for start, bucket in self._ranged(granularity, since, until):
+            for name, users in bucket.users.items():
+                if event_type is not None and name != event_type:
+                    continue
+                key = name if group_by == "event_type" else start if group_by == "time" else "all"
+                self._merge_into(merged, key, users, copy)
+        return merged
+
+    def values(
+        self,
+        event_type: str,
+        field: str,
+        group_by: str,
+        granularity: str = "hour",
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+    ) -> Dict[object, DDSketch]:
+        """Merge the sketches of one event_data field over a time range.
+        group_by is time or all."""
+        copy = lambda sketch: DDSketch.from_dict(sketch.to_dict())
+        merged = {}
+        for start, bucket in self._ranged(granularity, since, until):
+            sketch = bucket.values.get((event_type, field))
+            if sketch is not None:
+                self._merge_into(merged, start if group_by == "time" else "all", sketch, copy)
+        return merged
+
+    def stats(self) -> dict:
+        user_series = value_series = size = 0
+        for buckets in self.buckets.values():
+            for bucket in buckets.values():
+                user_series += len(bucket.users)
+                value_series += len(bucket.values)
+                size += sum(users.nbytes() for users in bucket.users.values())
+                size += sum(sketch.nbytes() for sketch in bucket.values.values())
+        return {
+            "user_series": user_series,
+            "value_series": value_series,
+            "bytes": size,
+            "event_types": len(self.event_types),
+            "folded_events": self.folded,
+        }
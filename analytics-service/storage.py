@@ -0,0 +1,836 @@
+"""Append-only, time-partitioned event storage for the Analytics Service.
+
+Events are written to the active segment as fixed-header binary records:
+
+    timestamp_us  int64    event time, microseconds since the epoch (UTC)
+    user_id       int64    -1 when the event has no user
+    type_id       uint32   index into the interned event type table
+    event_id      16 bytes UUID
+    data_len      uint32   length of the JSON encoded event_data
+    data          bytes
+
+The active segment is rolled over once its partition window (SEGMENT_SPAN
+seconds of ingest time) ends or it reaches SEGMENT_MAX_BYTES. Rolled
+segments are sealed by a background thread: records are sorted by
+(timestamp, event_id) and rewritten behind a header holding the record
+count and the min/max timestamp, so range queries can skip whole segments.
+All reads go through read-only memory maps, so resident memory does not
+grow with the amount of history on disk.
+
+Each sealed segment has an ``.idx`` sidecar with the record offsets in
+sort order and posting lists (record ordinals) per event type and per
+user. Unsealed segments keep the same index in memory. Queries walk the
+indexes newest-first and merge segments lazily, so fetching the latest N
+matching events reads about N records regardless of history size.
+Exports walk the same indexes oldest-first, merging segments as they go.
+"""
+import base64
+import binascii
+import bisect
+import fcntl
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<qqI16sI")
+SEGMENT_HEADER = struct.Struct("<4sHQqq")
+SEGMENT_MAGIC = b"AEVS"
+SEGMENT_VERSION = 1
+
+INDEX_HEADER = struct.Struct("<4sHQII")
+INDEX_MAGIC = b"AEVI"
+INDEX_VERSION = 1
+TYPE_ENTRY = struct.Struct("<IQI")  # type_id, postings position, length
+USER_ENTRY = struct.Struct("<qQI")  # user_id, postings position, length
+OFFSET = struct.Struct("<Q")
+ORDINAL = struct.Struct("<I")
+
+CURSOR = struct.Struct("<q16s")
+
+OPEN_SUFFIX = ".open"
+SEALED_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+TYPES_FILE = "event_types.log"
+LOCK_FILE = "LOCK"
+
+NO_USER = -1
+MAX_KEY = (2 ** 63 - 1, b"")
+
+
+def to_micros(timestamp: datetime) -> int:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1_000_000)
+
+
+def from_micros(micros: int) -> datetime:
+    # Naive UTC, matching the datetime.utcnow() timestamps set at ingest
+    return datetime.fromtimestamp(micros / 1_000_000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def encode_cursor(key: Tuple[int, bytes]) -> str:
+    return base64.urlsafe_b64encode(CURSOR.pack(*key)).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, bytes]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return CURSOR.unpack(raw)
+    except (binascii.Error, struct.error):
+        raise ValueError("Invalid cursor")
+
+
+def iter_records(path: str, start: int) -> Iterator[tuple]:
+    """Yield (offset, timestamp_us, user_id, type_id, event_id, data) for the
+    records in a segment file. A truncated trailing record is ignored."""
+    if os.path.getsize(path) <= start:
+        return
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offset = start
+            end = len(buf)
+            while offset + RECORD_HEADER.size <= end:
+                ts, user_id, type_id, event_id, data_len = RECORD_HEADER.unpack_from(buf, offset)
+                data_start = offset + RECORD_HEADER.size
+                if data_start + data_len > end:
+                    break
+                yield offset, ts, user_id, type_id, event_id, buf[data_start:data_start + data_len]
+                offset = data_start + data_len
+
+
+def read_record(buf, offset: int) -> tuple:
+    ts, user_id, type_id, event_id, data_len = RECORD_HEADER.unpack_from(buf, offset)
+    data_start = offset + RECORD_HEADER.size
+    return ts, user_id, type_id, event_id, buf[data_start:data_start + data_len]
+
+
+class PackedArray:
+    """Read-only view of fixed-size integers packed in a buffer."""
+
+    def __init__(self, buf, start: int, length: int, item: struct.Struct):
+        self.buf = buf
+        self.start = start
+        self.length = length
+        self.item = item
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i: int):
+        return self.item.unpack_from(self.buf, self.start + i * self.item.size)[0]
+
+    def entry(self, i: int) -> tuple:
+        return self.item.unpack_from(self.buf, self.start + i * self.item.size)
+
+
+class SegmentView:
+    """An open segment: maps ordinals (positions in key order) to records.
+
+    Subclasses provide ``candidates`` (ordinals for a filter, ascending by
+    key, plus a user_id still to check per record), ``key_at`` and
+    ``record_at``.
+    """
+
+    def __init__(self, path: str):
+        self._files = []
+        self._maps = []
+        self.buf = self._map(path)
+
+    def _map(self, path: str):
+        f = open(path, "rb")
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(buf)
+        return buf
+
+    def close(self):
+        for buf in self._maps:
+            buf.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_desc(self, type_id: Optional[int], user_id: Optional[int],
+                  before: Tuple[int, bytes], since_us: Optional[int]) -> Iterator[tuple]:
+        """Yield matching records with key < before, newest first, stopping
+        at since_us."""
+        ordinals, check_user = self.candidates(type_id, user_id)
+        lo, hi = 0, len(ordinals)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(ordinals[mid]) < before:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo - 1, -1, -1):
+            record = self.record_at(ordinals[i])
+            if since_us is not None and record[0] < since_us:
+                return
+            if check_user is not None and record[1] != check_user:
+                continue
+            yield record
+
+    def iter_asc(self, type_id: Optional[int], user_id: Optional[int],
+                 since_us: Optional[int], until_us: Optional[int]) -> Iterator[tuple]:
+        """Yield matching records from since_us on, oldest first, stopping
+        after until_us."""
+        ordinals, check_user = self.candidates(type_id, user_id)
+        lo, hi = 0, len(ordinals)
+        if since_us is not None:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.key_at(ordinals[mid])[0] < since_us:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        for i in range(lo, len(ordinals)):
+            record = self.record_at(ordinals[i])
+            if until_us is not None and record[0] > until_us:
+                return
+            if check_user is not None and record[1] != check_user:
+                continue
+            yield record
+
+
+class OpenSegment:
+    """A segment that has not been sealed yet (the active one, or one waiting
+    for the sealer). Records are in arrival order; the index lives in memory."""
+
+    sealed = False
+
+    def __init__(self, path: str, seq: int):
+        self.path = path
+        self.seq = seq
+        self.keys: List[Tuple[int, bytes]] = []
+        self.offsets: List[int] = []
+        self.order: List[int] = []
+        self.by_type = defaultdict(list)
+        self.by_user = defaultdict(list)
+        self.min_ts: Optional[int] = None
+        self.max_ts: Optional[int] = None
+
+    @classmethod
+    def load(cls, path: str, seq: int) -> "OpenSegment":
+        segment = cls(path, seq)
+        for offset, ts, user_id, type_id, event_id, _ in iter_records(path, 0):
+            segment.add(offset, ts, user_id, type_id, event_id)
+        return segment
+
+    @property
+    def count(self) -> int:
+        return len(self.keys)
+
+    def add(self, offset: int, ts: int, user_id: int, type_id: int, event_id: bytes):
+        ordinal = len(self.keys)
+        key = (ts, event_id)
+        self.keys.append(key)
+        self.offsets.append(offset)
+        self.order = self._insert(self.order, ordinal, key)
+        self.by_type[type_id] = self._insert(self.by_type[type_id], ordinal, key)
+        if user_id != NO_USER:
+            self.by_user[user_id] = self._insert(self.by_user[user_id], ordinal, key)
+        if self.min_ts is None or ts < self.min_ts:
+            self.min_ts = ts
+        if self.max_ts is None or ts > self.max_ts:
+            self.max_ts = ts
+
+    def _insert(self, ordinals: List[int], ordinal: int, key: Tuple[int, bytes]) -> List[int]:
+        """Add ``ordinal`` to a posting list kept in key order.
+
+        Readers copy posting lists without the store lock, so a list is only
+        ever appended to in place. An out-of-order event goes into a new list
+        instead of shifting the one a reader may be copying.
+        """
+        # Events mostly arrive in time order, so this is usually an append
+        if not ordinals or self.keys[ordinals[-1]] <= key:
+            ordinals.append(ordinal)
+            return ordinals
+        i = bisect.bisect_right(ordinals, key, key=self.keys.__getitem__)
+        return ordinals[:i] + [ordinal] + ordinals[i:]
+
+    def view(self, count: int) -> "OpenSegmentView":
+        return OpenSegmentView(self, count)
+
+
+class OpenSegmentView(SegmentView):
+    def __init__(self, segment: OpenSegment, count: int):
+        super().__init__(segment.path)
+        self.segment = segment
+        # Records appended after the snapshot may not be mapped yet
+        self.count = count
+
+    def _snapshot(self, ordinals: List[int]) -> List[int]:
+        # The writer may append past self.count at any moment, even mid-copy,
+        # but never moves an ordinal already in the list (see OpenSegment._insert)
+        return [o for o in ordinals if o < self.count]
+
+    def candidates(self, type_id, user_id):
+        if type_id is None and user_id is None:
+            return self._snapshot(self.segment.order), None
+        if user_id is None:
+            return self._snapshot(self.segment.by_type.get(type_id, [])), None
+        by_user = self.segment.by_user.get(user_id, [])
+        if type_id is None:
+            return self._snapshot(by_user), None
+        by_type = self.segment.by_type.get(type_id, [])
+        if len(by_user) <= len(by_type):
+            matching = set(by_type)
+            return [o for o in self._snapshot(by_user) if o in matching], None
+        return self._snapshot(by_type), user_id
+
+    def key_at(self, ordinal: int):
+        return self.segment.keys[ordinal]
+
+    def record_at(self, ordinal: int) -> tuple:
+        return read_record(self.buf, self.segment.offsets[ordinal])
+
+
+class SealedSegment:
+    """A sealed segment: records sorted by key, with an on-disk index."""
+
+    sealed = True
+
+    def __init__(self, path: str, seq: int):
+        self.path = path
+        self.seq = seq
+        self.index_path = os.path.splitext(path)[0] + INDEX_SUFFIX
+        with open(path, "rb") as f:
+            magic, version, self.count, self.min_ts, self.max_ts = SEGMENT_HEADER.unpack(
+                f.read(SEGMENT_HEADER.size)
+            )
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise ValueError(f"Unrecognised segment file {path}")
+
+    def view(self, count: int) -> "SealedSegmentView":
+        return SealedSegmentView(self)
+
+
+class SealedSegmentView(SegmentView):
+    def __init__(self, segment: SealedSegment):
+        super().__init__(segment.path)
+        self.index = self._map(segment.index_path)
+        magic, version, self.count, n_types, n_users = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"Unrecognised index file {segment.index_path}")
+        self.types = PackedArray(self.index, INDEX_HEADER.size, n_types, TYPE_ENTRY)
+        users_start = INDEX_HEADER.size + n_types * TYPE_ENTRY.size
+        self.users = PackedArray(self.index, users_start, n_users, USER_ENTRY)
+        offsets_start = users_start + n_users * USER_ENTRY.size
+        self.offsets = PackedArray(self.index, offsets_start, self.count, OFFSET)
+
+    def _postings(self, directory: PackedArray, key: int) -> PackedArray:
+        # Directory entries are sorted by type_id / user_id
+        lo, hi = 0, len(directory)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_key, position, length = directory.entry(mid)
+            if entry_key == key:
+                return PackedArray(self.index, position, length, ORDINAL)
+            if entry_key < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return PackedArray(self.index, 0, 0, ORDINAL)
+
+    def candidates(self, type_id, user_id):
+        if type_id is None and user_id is None:
+            return range(self.count), None
+        if type_id is None:
+            return self._postings(self.users, user_id), None
+        by_type = self._postings(self.types, type_id)
+        if user_id is None:
+            return by_type, None
+        by_user = self._postings(self.users, user_id)
+        if len(by_user) <= len(by_type):
+            matching = {by_type[i] for i in range(len(by_type))} if len(by_user) else set()
+            return [by_user[i] for i in range(len(by_user)) if by_user[i] in matching], None
+        return by_type, user_id
+
+    def key_at(self, ordinal: int):
+        ts, _, _, event_id, _ = RECORD_HEADER.unpack_from(self.buf, self.offsets[ordinal])
+        return ts, event_id
+
+    def record_at(self, ordinal: int) -> tuple:
+        return read_record(self.buf, self.offsets[ordinal])
+
+
+def write_index(path: str, offsets: List[int], by_type: Dict[int, List[int]], by_user: Dict[int, List[int]]):
+    type_ids = sorted(by_type)
+    user_ids = sorted(by_user)
+    position = (
+        INDEX_HEADER.size
+        + len(type_ids) * TYPE_ENTRY.size
+        + len(user_ids) * USER_ENTRY.size
+        + len(offsets) * OFFSET.size
+    )
+    postings = []
+    with open(path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(offsets), len(type_ids), len(user_ids)))
+        for entries, entry_struct, keys in ((by_type, TYPE_ENTRY, type_ids), (by_user, USER_ENTRY, user_ids)):
+            for key in keys:
+                ordinals = entries[key]
+                f.write(entry_struct.pack(key, position, len(ordinals)))
+                postings.append(ordinals)
+                position += len(ordinals) * ORDINAL.size
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        for ordinals in postings:
+            f.write(struct.pack(f"<{len(ordinals)}I", *ordinals))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class EventStore:
+    def __init__(
+        self,
+        data_dir: str,
+        segment_span: int = 3600,
+        segment_max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.data_dir = data_dir
+        self.segment_span = segment_span
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.RLock()
+        self._sealer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segment-sealer")
+        self._segments: list = []
+        self._type_ids: Dict[str, int] = {}
+        self._type_names: List[str] = []
+        self._types_file = None
+        self._active: Optional[OpenSegment] = None
+        self._writer = None
+        self._active_started = 0.0
+        self._active_bytes = 0
+        self._next_seq = 0
+        os.makedirs(data_dir, exist_ok=True)
+        # One process per directory: the active segment's index lives in
+        # the owner's memory, so other workers or replicas need their own
+        # directory (a shard, see shards.py)
+        self._lock_file = open(os.path.join(data_dir, LOCK_FILE), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Event store {data_dir} is in use by another process")
+        with self._lock:
+            self._load()
+
+    # Startup
+
+    def _path(self, seq: int, suffix: str) -> str:
+        return os.path.join(self.data_dir, f"{seq:012d}{suffix}")
+
+    def _load(self):
+        types_path = os.path.join(self.data_dir, TYPES_FILE)
+        if os.path.exists(types_path):
+            with open(types_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    name = line.rstrip("\n")
+                    if name:
+                        self._type_ids[name] = len(self._type_names)
+                        self._type_names.append(name)
+        self._types_file = open(types_path, "a", encoding="utf-8")
+
+        leftovers = []
+        for name in sorted(os.listdir(self.data_dir)):
+            stem, suffix = os.path.splitext(name)
+            if suffix not in (OPEN_SUFFIX, SEALED_SUFFIX) or not stem.isdigit():
+                continue
+            path = os.path.join(self.data_dir, name)
+            if suffix == SEALED_SUFFIX:
+                self._segments.append(SealedSegment(path, int(stem)))
+            else:
+                leftovers.append(OpenSegment.load(path, int(stem)))
+        # Segments left open by a previous process are sealed like any other
+        for segment in leftovers:
+            self._segments.append(segment)
+            self._sealer.submit(self._seal, segment)
+        self._segments.sort(key=lambda s: s.seq)
+        self._next_seq = self._segments[-1].seq + 1 if self._segments else 0
+        self._roll()
+
+    # Writes
+
+    def _intern(self, event_type: str) -> int:
+        type_id = self._type_ids.get(event_type)
+        if type_id is None:
+            type_id = len(self._type_names)
+            self._type_ids[event_type] = type_id
+            self._type_names.append(event_type)
+            self._types_file.write(event_type + "\n")
+            self._types_file.flush()
+        return type_id
+
+    def _roll(self):
+        """Start a new active segment, handing the previous one to the sealer."""
+        previous = self._active
+        if self._writer is not None:
+            self._writer.close()
+        seq = self._next_seq
+        self._next_seq += 1
+        path = self._path(seq, OPEN_SUFFIX)
+        self._writer = open(path, "ab")
+        self._active = OpenSegment(path, seq)
+        self._segments.append(self._active)
+        self._active_started = time.time()
+        self._active_bytes = 0
+        if previous is not None:
+            self._sealer.submit(self._seal, previous)
+
+    def append(self, event_id: str, event_type: str, user_id: Optional[int],
+               event_data: dict, timestamp: datetime):
+        self.append_batch([(event_id, event_type, user_id, event_data, timestamp)])
+
+    def append_batch(self, events: List[tuple]):
+        """Append (event_id, event_type, user_id, event_data, timestamp)
+        tuples under a single lock acquisition and flush."""
+        encoded = []
+        for event_id, event_type, user_id, event_data, timestamp in events:
+            data = json.dumps(event_data, separators=(",", ":"), default=str).encode()
+            user = NO_USER if user_id is None else user_id
+            encoded.append((to_micros(timestamp), user, event_type, uuid.UUID(event_id).bytes, data))
+        with self._lock:
+            for ts, user, event_type, event_uuid, data in encoded:
+                if (
+                    time.time() - self._active_started >= self.segment_span
+                    or self._active_bytes >= self.segment_max_bytes
+                ):
+                    self._roll()
+                type_id = self._intern(event_type)
+                self._writer.write(RECORD_HEADER.pack(ts, user, type_id, event_uuid, len(data)))
+                self._writer.write(data)
+                self._active.add(self._active_bytes, ts, user, type_id, event_uuid)
+                self._active_bytes += RECORD_HEADER.size + len(data)
+            self._writer.flush()
+
+    # Sealing
+
+    def _seal(self, segment: OpenSegment):
+        try:
+            if segment.count == 0:
+                with self._lock:
+                    if segment in self._segments:
+                        self._segments.remove(segment)
+                os.remove(segment.path)
+                return
+            sealed_path = self._path(segment.seq, SEALED_SUFFIX)
+            index_path = self._path(segment.seq, INDEX_SUFFIX)
+            offsets = []
+            by_type = defaultdict(list)
+            by_user = defaultdict(list)
+            with segment.view(segment.count) as view, open(sealed_path + ".tmp", "wb") as f:
+                f.write(SEGMENT_HEADER.pack(
+                    SEGMENT_MAGIC,
+                    SEGMENT_VERSION,
+                    segment.count,
+                    segment.keys[segment.order[0]][0],
+                    segment.keys[segment.order[-1]][0],
+                ))
+                position = SEGMENT_HEADER.size
+                for ordinal, source in enumerate(segment.order):
+                    ts, user_id, type_id, event_id, data = view.record_at(source)
+                    f.write(RECORD_HEADER.pack(ts, user_id, type_id, event_id, len(data)))
+                    f.write(data)
+                    offsets.append(position)
+                    by_type[type_id].append(ordinal)
+                    if user_id != NO_USER:
+                        by_user[user_id].append(ordinal)
+                    position += RECORD_HEADER.size + len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            write_index(index_path + ".tmp", offsets, by_type, by_user)
+            # The index goes first: a .seg file on disk always has its .idx
+            os.replace(index_path + ".tmp", index_path)
+            os.replace(sealed_path + ".tmp", sealed_path)
+            sealed = SealedSegment(sealed_path, segment.seq)
+            with self._lock:
+                if segment in self._segments:
+                    self._segments[self._segments.index(segment)] = sealed
+                    os.remove(segment.path)
+                else:
+                    # Store was cleared while sealing
+                    os.remove(sealed_path)
+                    os.remove(index_path)
+        except Exception:
+            logger.exception("Failed to seal segment %s", segment.path)
+
+    # Reads
+
+    def _decode(self, record: tuple) -> dict:
+        ts, user_id, type_id, event_id, data = record
+        return {
+            "id": str(uuid.UUID(bytes=event_id)),
+            "user_id": None if user_id == NO_USER else user_id,
+            "event_type": self._type_names[type_id],
+            "event_data": json.loads(data),
+            "timestamp": from_micros(ts),
+        }
+
+    def _snapshot(self) -> List[tuple]:
+        """(segment, record count) pairs for a consistent read."""
+        with self._lock:
+            self._writer.flush()
+            return [(segment, segment.count) for segment in self._segments]
+
+    def _sealed_replacement(self, seq: int) -> Optional[SealedSegment]:
+        with self._lock:
+            for segment in self._segments:
+                if segment.seq == seq and segment.sealed:
+                    return segment
+        return None
+
+    def _records(self, segment) -> Iterator[tuple]:
+        start = SEGMENT_HEADER.size if segment.sealed else 0
+        try:
+            for _, *record in iter_records(segment.path, start):
+                yield tuple(record)
+        except FileNotFoundError:
+            # Sealed (or cleared) between taking the snapshot and opening it
+            replacement = None if segment.sealed else self._sealed_replacement(segment.seq)
+            if replacement is not None:
+                yield from self._records(replacement)
+
+    def _scan_records(self, since_us: Optional[int], until_us: Optional[int]) -> Iterator[tuple]:
+        for segment, count in self._snapshot():
+            if count == 0:
+                continue
+            if since_us is not None and segment.max_ts < since_us:
+                continue
+            if until_us is not None and segment.min_ts > until_us:
+                continue
+            for record in self._records(segment):
+                ts = record[0]
+                if since_us is not None and ts < since_us:
+                    continue
+                if until_us is not None and ts > until_us:
+                    continue
+                yield record
+
+    def scan(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[dict]:
+        """Yield stored events, optionally limited to a time range, in
+        segment order. Segments outside the range are skipped entirely."""
+        since_us = to_micros(since) if since is not None else None
+        until_us = to_micros(until) if until is not None else None
+        for record in self._scan_records(since_us, until_us):
+            yield self._decode(record)
+
+    def scan_meta(self, with_data: bool = False) -> Iterator[tuple]:
+        """Yield (timestamp_us, event_type, user_id) for every stored event,
+        for rebuilding derived state. event_data is only decoded, and added
+        as a fourth item, when with_data is set."""
+        for ts, user_id, type_id, _, data in self._scan_records(None, None):
+            meta = (ts, self._type_names[type_id], None if user_id == NO_USER else user_id)
+            yield meta + (json.loads(data),) if with_data else meta
+
+    def _open_view(self, segment, count: int) -> Optional[SegmentView]:
+        try:
+            return segment.view(count)
+        except FileNotFoundError:
+            replacement = None if segment.sealed else self._sealed_replacement(segment.seq)
+            return replacement.view(replacement.count) if replacement is not None else None
+
+    def _iter_segment(self, segment, count, type_id, user_id, before, since_us) -> Iterator[tuple]:
+        view = self._open_view(segment, count)
+        if view is None:
+            return
+        with view:
+            yield from view.iter_desc(type_id, user_id, before, since_us)
+
+    def _iter_segment_asc(self, segment, count, type_id, user_id, since_us, until_us) -> Iterator[tuple]:
+        view = self._open_view(segment, count)
+        if view is None:
+            return
+        with view:
+            yield from view.iter_asc(type_id, user_id, since_us, until_us)
+
+    def query(
+        self,
+        event_type: Optional[str] = None,
+        user_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Return up to ``limit`` matching events, newest first, and a cursor
+        for the next page (None when there are no more results).
+
+        Segments are merged lazily: a segment is only opened once its newest
+        event could be the next result. Raises ValueError for a bad cursor.
+        """
+        type_id = None
+        if event_type is not None:
+            type_id = self._type_ids.get(event_type)
+            if type_id is None:
+                return [], None
+        since_us = to_micros(since) if since is not None else None
+        before = MAX_KEY
+        if until is not None:
+            before = (to_micros(until) + 1, b"")
+        if cursor is not None:
+            before = min(before, decode_cursor(cursor))
+
+        segments = [
+            (segment, count)
+            for segment, count in self._snapshot()
+            if count
+            and segment.min_ts <= before[0]
+            and (since_us is None or segment.max_ts >= since_us)
+        ]
+        segments.sort(key=lambda item: item[0].max_ts, reverse=True)
+
+        heap = []
+        results = []
+        iterators = []
+        next_segment = 0
+        try:
+            while len(results) < limit:
+                # Admit segments whose newest event may beat the current best
+                while next_segment < len(segments) and (
+                    not heap or segments[next_segment][0].max_ts >= -heap[0][0]
+                ):
+                    segment, count = segments[next_segment]
+                    next_segment += 1
+                    iterator = self._iter_segment(segment, count, type_id, user_id, before, since_us)
+                    iterators.append(iterator)
+                    self._push(heap, iterator)
+                if not heap:
+                    break
+                _, _, record, iterator = heapq.heappop(heap)
+                results.append(record)
+                self._push(heap, iterator)
+            events = [self._decode(record) for record in results]
+        finally:
+            for iterator in iterators:
+                iterator.close()
+
+        next_cursor = None
+        if results and len(results) == limit:
+            last = results[-1]
+            next_cursor = encode_cursor((last[0], last[3]))
+        return events, next_cursor
+
+    @staticmethod
+    def _push(heap: list, iterator: Iterator[tuple]):
+        record = next(iterator, None)
+        if record is not None:
+            # Max-heap on (timestamp, event_id)
+            heapq.heappush(heap, (-record[0], -int.from_bytes(record[3], "big"), record, iterator))
+
+    def export(
+        self,
+        event_type: Optional[str] = None,
+        user_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Iterator[tuple]:
+        """Yield every matching event, oldest first, as (timestamp_us,
+        user_id, event_type, event_id, data) with data still JSON encoded.
+
+        The merge only holds one record per open segment, and a segment is
+        opened once the merge reaches its oldest event, so memory does not
+        grow with the number of events exported.
+        """
+        type_id = None
+        if event_type is not None:
+            type_id = self._type_ids.get(event_type)
+            if type_id is None:
+                return
+        since_us = to_micros(since) if since is not None else None
+        until_us = to_micros(until) if until is not None else None
+
+        segments = [
+            (segment, count)
+            for segment, count in self._snapshot()
+            if count
+            and (since_us is None or segment.max_ts >= since_us)
+            and (until_us is None or segment.min_ts <= until_us)
+        ]
+        segments.sort(key=lambda item: item[0].min_ts)
+
+        heap = []
+        iterators = []
+        next_segment = 0
+        try:
+            while True:
+                while next_segment < len(segments) and (
+                    not heap or segments[next_segment][0].min_ts <= heap[0][0]
+                ):
+                    segment, count = segments[next_segment]
+                    next_segment += 1
+                    iterator = self._iter_segment_asc(segment, count, type_id, user_id, since_us, until_us)
+                    iterators.append(iterator)
+                    self._push_asc(heap, iterator)
+                if not heap:
+                    return
+                _, _, record, iterator = heapq.heappop(heap)
+                ts, record_user, record_type, event_id, data = record
+                yield (
+                    ts,
+                    None if record_user == NO_USER else record_user,
+                    self._type_names[record_type],
+                    str(uuid.UUID(bytes=event_id)),
+                    data,
+                )
+                self._push_asc(heap, iterator)
+        finally:
+            for iterator in iterators:
+                iterator.close()
+
+    @staticmethod
+    def _push_asc(heap: list, iterator: Iterator[tuple]):
+        record = next(iterator, None)
+        if record is not None:
+            heapq.heappush(heap, (record[0], int.from_bytes(record[3], "big"), record, iterator))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "sealed_segments": sum(1 for segment in self._segments if segment.sealed),
+                "active_bytes": self._active_bytes,
+                "event_types": len(self._type_names),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._writer.close()
+            self._writer = None
+            self._active = None
+            for segment in self._segments:
+                paths = [segment.path]
+                if segment.sealed:
+                    paths.append(segment.index_path)
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self._segments = []
+            self._roll()
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._types_file.close()
+        self._sealer.shutdown(wait=True)
+        self._lock_file.close()
@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+# Configuration is read at import time, so it is set before main is imported
+os.environ.setdefault("ANALYTICS_DATA_DIR", tempfile.mkdtemp(prefix="analytics-service-"))
+
+# The service modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import EventStore  # noqa: E402
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def make_events(count, start=START, step=timedelta(seconds=1)):
+    """(event_id, event_type, user_id, event_data, timestamp) tuples, as
+    EventStore.append_batch takes them."""
+    return [
+        (str(uuid.uuid4()), "click" if i % 2 else "view", i % 3 or None, {"i": i}, start + i * step)
+        for i in range(count)
+    ]
+
+
+def wait_for_sealer(store):
+    # The sealer has a single worker, so this returns once earlier seals ran
+    store._sealer.submit(lambda: None).result()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = EventStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def rolling_store(tmp_path):
+    # Every record starts a new segment
+    store = EventStore(str(tmp_path), segment_max_bytes=1)
+    yield store
+    store.close()
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        deadline = time.monotonic() + 10
+        while client.get("/ready").status_code != 200:
+            assert time.monotonic() < deadline, "rollups were not rebuilt"
+            time.sleep(0.05)
+        yield client
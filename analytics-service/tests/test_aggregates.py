@@ -0,0 +1,45 @@
+from aggregates import RollupAggregator
+
+HOUR_US = 3600 * 1_000_000
+KEEP_ALL = {"minute": None, "hour": None, "day": None, "user_day": None}
+
+
+def rows(result):
+    return {row["key"]: row["count"] for row in result}
+
+
+def make_aggregator():
+    aggregator = RollupAggregator(KEEP_ALL)
+    for hour in range(30):
+        aggregator.add("view", hour % 3, hour * HOUR_US)
+        aggregator.add("click", None, hour * HOUR_US + 1, count=2)
+    return aggregator
+
+
+def test_totals():
+    aggregator = make_aggregator()
+    assert rows(aggregator.query("event_type")) == {"view": 30, "click": 60}
+    assert rows(aggregator.query("user_id")) == {0: 10, 1: 10, 2: 10}
+
+
+def test_time_range_is_widened_to_buckets():
+    aggregator = make_aggregator()
+    since, until = 2 * 3600 + 1800, 4 * 3600 + 1
+
+    assert rows(aggregator.query("event_type", "hour", since, until)) == {"view": 3, "click": 6}
+    assert rows(aggregator.query("time", "hour", since, until, event_type="click")) == {
+        7200: 2, 10800: 2, 14400: 2,
+    }
+    assert rows(aggregator.query("time", "day")) == {0: 72, 86400: 18}
+
+
+def test_user_counts_are_per_day():
+    aggregator = make_aggregator()
+    assert rows(aggregator.query("user_id", since=86400)) == {0: 2, 1: 2, 2: 2}
+
+
+def test_clear():
+    aggregator = make_aggregator()
+    aggregator.clear()
+    assert aggregator.query("event_type") == []
+    assert aggregator.query("time", "hour") == []
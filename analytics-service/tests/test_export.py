@@ -0,0 +1,95 @@
+import asyncio
+from datetime import timedelta
+
+import orjson
+import pytest
+
+import export
+import main
+from conftest import START, make_events, wait_for_sealer
+from export import arrow_stream, batched, ndjson_lines, ndjson_stream, parse_ndjson
+from storage import to_micros
+
+ROWS = [
+    (to_micros(START), None, "view", "00000000-0000-0000-0000-000000000001", b'{"page":"home"}'),
+    (to_micros(START + timedelta(seconds=1)), 7, 'say "hi"', "00000000-0000-0000-0000-000000000002", b"{}"),
+]
+
+
+async def aiter(items):
+    for item in items:
+        yield item
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_export_is_oldest_first(rolling_store):
+    events = make_events(20)
+    rolling_store.append_batch(list(reversed(events[10:])) + events[:10])
+    wait_for_sealer(rolling_store)
+
+    rows = list(rolling_store.export())
+    assert [row[3] for row in rows] == [event[0] for event in events]
+    assert rows[0][1:3] == (None, "view")
+    assert rows[0][4] == b'{"i":0}'
+
+    ranged = list(rolling_store.export(
+        event_type="click", since=START + timedelta(seconds=4), until=START + timedelta(seconds=9),
+    ))
+    assert [row[3] for row in ranged] == [events[i][0] for i in (5, 7, 9)]
+
+
+def test_batched():
+    assert list(batched(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched(iter([]), 2)) == []
+
+
+def test_ndjson_lines():
+    first, second = ndjson_lines(ROWS).splitlines()
+    assert orjson.loads(first) == {
+        "id": ROWS[0][3], "user_id": None, "event_type": "view",
+        "event_data": {"page": "home"}, "timestamp": "2024-01-01T12:00:00",
+    }
+    assert orjson.loads(second)["event_type"] == 'say "hi"'
+
+
+def test_ndjson_round_trip_across_chunk_boundaries():
+    body = ndjson_lines(ROWS)
+    chunks = [body[:7], body[7:60], body[60:]]
+    batches = asyncio.run(collect(parse_ndjson(aiter(chunks))))
+    assert [row for rows in batches for row in rows] == ROWS
+    assert asyncio.run(collect(ndjson_stream(aiter([ROWS])))) == [body]
+
+
+def test_export_endpoint_streams_ndjson(client, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_BATCH", 2)
+    client.delete("/events")
+    main.event_store.append_batch(make_events(5))
+
+    response = client.get("/events/export", params={"event_type": "view"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == export.NDJSON_CONTENT_TYPE
+    events = [orjson.loads(line) for line in response.content.splitlines()]
+    assert [event["event_data"]["i"] for event in events] == [0, 2, 4]
+
+
+def test_arrow_export_needs_pyarrow(client, monkeypatch):
+    monkeypatch.setattr(export, "pyarrow", None)
+    assert client.get("/events/export", params={"format": "arrow"}).status_code == 501
+    assert client.get("/events/export", params={"format": "csv"}).status_code == 422
+
+
+def test_arrow_stream():
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+
+    body = b"".join(asyncio.run(collect(arrow_stream(aiter([ROWS[:1], ROWS[1:]])))))
+    table = pyarrow.ipc.open_stream(body).read_all()
+
+    assert table.num_rows == 2
+    assert table.column("user_id").to_pylist() == [None, 7]
+    assert table.column("event_data").to_pylist() == ['{"page":"home"}', "{}"]
+    assert table.column("timestamp").to_pylist() == [START, START + timedelta(seconds=1)]
@@ -0,0 +1,99 @@
+import asyncio
+
+import orjson
+
+import main
+from ingest import IngestBuffer
+
+
+class Sink:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+
+    async def __call__(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        self.batches.append(batch)
+
+
+def test_offer_is_all_or_nothing():
+    buffer = IngestBuffer(Sink(), capacity=5, batch_size=2, flush_interval=1)
+    assert buffer.offer([1, 2, 3])
+    assert not buffer.offer([4, 5, 6])
+    assert buffer.offer([4, 5])
+    assert len(buffer) == 5
+    assert buffer.stats()["rejected"] == 3
+
+
+def test_failed_batch_is_requeued_in_order():
+    async def scenario():
+        sink = Sink(failures=1)
+        buffer = IngestBuffer(sink, capacity=10, batch_size=2, flush_interval=1)
+        buffer.offer([1, 2, 3])
+
+        assert not await buffer.flush()
+        assert buffer.failing
+        assert list(buffer._items) == [1, 2, 3]
+
+        assert await buffer.flush()
+        assert not buffer.failing
+        assert sink.batches == [[1, 2], [3]]
+        assert buffer.stats()["write_failures"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_batch_being_written_counts_towards_capacity():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_sink(batch):
+            await release.wait()
+
+        buffer = IngestBuffer(slow_sink, capacity=3, batch_size=2, flush_interval=1)
+        buffer.offer([1, 2])
+        flushing = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0)
+
+        assert len(buffer) == 0
+        assert not buffer.offer([3, 4])
+        release.set()
+        await flushing
+
+    asyncio.run(scenario())
+
+
+def test_retries_back_off_until_the_sink_recovers():
+    async def scenario():
+        sink = Sink(failures=3)
+        buffer = IngestBuffer(sink, capacity=10, batch_size=10, flush_interval=0.01, max_retry_interval=0.02)
+        buffer.start()
+        buffer.offer([1])
+        await asyncio.sleep(0.2)
+        await buffer.stop()
+        assert sink.batches == [[1]]
+        assert buffer.stats()["write_failures"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_batch_size_limits(client, monkeypatch):
+    monkeypatch.setattr(main, "TRACK_BATCH_MAX", 2)
+    events = [{"event_type": "view"}] * 3
+    assert client.post("/track/batch", json=events).status_code == 413
+
+    monkeypatch.setattr(main, "TRACK_BATCH_MAX_BYTES", 64)
+    body = orjson.dumps([{"event_type": "view", "event_data": {"page": "x" * 100}}])
+    assert client.post("/track/batch", content=body).status_code == 413
+    # Without a Content-Length, the body is cut off while it is read
+    assert client.post("/track/batch", content=iter([body[:40], body[40:]])).status_code == 413
+    assert client.post("/track/batch", json=[{"event_type": "view"}]).status_code == 200
+
+
+def test_failing_storage_answers_503(client, monkeypatch):
+    monkeypatch.setattr(main.ingest_buffer, "failing", True)
+    response = client.post("/track", json={"event_type": "view"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == main.INGEST_RETRY_AFTER
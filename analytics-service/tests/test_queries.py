@@ -0,0 +1,101 @@
+import uuid
+from datetime import timedelta
+
+import pytest
+
+from conftest import START, make_events, wait_for_sealer
+
+import main
+
+
+def test_filters(store):
+    store.append_batch(make_events(12))
+
+    clicks, _ = store.query(event_type="click", limit=100)
+    assert len(clicks) == 6
+    assert all(e["event_type"] == "click" for e in clicks)
+
+    user_two, _ = store.query(user_id=2, limit=100)
+    assert [e["event_data"]["i"] for e in user_two] == [11, 8, 5, 2]
+
+    ranged, _ = store.query(since=START + timedelta(seconds=3), until=START + timedelta(seconds=5), limit=100)
+    assert [e["event_data"]["i"] for e in ranged] == [5, 4, 3]
+
+    assert store.query(event_type="unknown") == ([], None)
+
+
+def paginate(store, **filters):
+    pages, cursor = [], None
+    while True:
+        page, cursor = store.query(cursor=cursor, **filters)
+        pages.append(page)
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pagination_across_segments(rolling_store):
+    # Interleave timestamps so every page merges several segments
+    events = make_events(25, step=timedelta(seconds=2))
+    events += make_events(25, start=START + timedelta(seconds=1), step=timedelta(seconds=2))
+    rolling_store.append_batch(events)
+    wait_for_sealer(rolling_store)
+
+    pages = paginate(rolling_store, limit=7)
+
+    ids = [e["id"] for page in pages for e in page]
+    expected = sorted(events, key=lambda event: (event[4], uuid.UUID(event[0]).bytes), reverse=True)
+    assert ids == [event[0] for event in expected]
+    assert [len(page) for page in pages] == [7] * 7 + [1]
+
+
+def test_cursor_pagination_with_filter(rolling_store):
+    events = make_events(30)
+    rolling_store.append_batch(events)
+
+    pages = paginate(rolling_store, event_type="view", limit=4)
+
+    assert [e["event_data"]["i"] for page in pages for e in page] == list(range(28, -1, -2))
+
+
+def test_cursor_with_equal_timestamps(rolling_store):
+    events = make_events(9, step=timedelta(0))
+    rolling_store.append_batch(events)
+
+    pages = paginate(rolling_store, limit=2)
+
+    ids = [e["id"] for page in pages for e in page]
+    assert sorted(ids) == sorted(event[0] for event in events)
+    assert len(set(ids)) == len(ids)
+
+
+def test_invalid_cursor(store):
+    with pytest.raises(ValueError):
+        store.query(cursor="not a cursor!")
+
+
+def test_out_of_order_inserts_do_not_shift_posting_lists(store):
+    events = make_events(6)
+    store.append_batch(events[3:])
+    segment = store._segments[-1]
+    order = segment.order
+
+    store.append_batch(events[:3])
+
+    # A reader still copying the old list sees it unchanged
+    assert order == [0, 1, 2]
+    assert [segment.keys[o] for o in segment.order] == sorted(segment.keys)
+    results, _ = store.query(limit=10)
+    assert [e["id"] for e in results] == [event[0] for event in reversed(events)]
+
+
+def test_events_endpoint_pages_with_cursor(client):
+    client.delete("/events")
+    main.event_store.append_batch(make_events(5))
+
+    first = client.get("/events", params={"limit": 3})
+    assert len(first.json()) == 3
+    second = client.get("/events", params={"limit": 3, "cursor": first.headers["x-next-cursor"]})
+    assert [e["event_data"]["i"] for e in first.json() + second.json()] == [4, 3, 2, 1, 0]
+    assert "x-next-cursor" not in second.headers
+
+    assert client.get("/events", params={"cursor": "not a cursor!"}).status_code == 400
@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from conftest import make_events
+
+import main
+
+
+def test_replay_counts_every_stored_event(client):
+    assert client.delete("/events").status_code == 200
+    # Recent enough that the sketches keep them
+    main.event_store.append_batch(make_events(6, start=datetime.utcnow() - timedelta(minutes=5)))
+
+    replayed_rollups, replayed_sketches = main.replay_events()
+
+    assert {row["key"]: row["count"] for row in replayed_rollups.query("event_type")} == {"view": 3, "click": 3}
+    assert replayed_sketches.unique_users("event_type", "day", None, None, None).keys() == {"view", "click"}
+    # The live aggregators are left alone
+    assert main.rollups.query("event_type") == []
+
+
+def test_unready_until_rebuilt(client, monkeypatch):
+    monkeypatch.setattr(main, "aggregates_ready", False)
+
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == main.REBUILD_RETRY_AFTER
+    assert client.get("/summary").status_code == 503
+    assert client.get("/summary/unique-users").status_code == 503
+    assert client.delete("/events").status_code == 503
+    # Liveness and ingest are unaffected
+    assert client.get("/").status_code == 200
+    assert client.post("/track", json={"event_type": "view"}).status_code == 200
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+from shards import ShardSet, merge_counts, merge_events, shard_index, sign_shard_request
+
+
+def test_shard_index():
+    assert shard_index("2", "anything") == 2
+    assert shard_index(None, "analytics-service-3") == 3
+    assert shard_index(None, "laptop") == 0
+
+
+def test_shard_index_must_be_listed():
+    with pytest.raises(ValueError):
+        ShardSet(["http://a", "http://b"], 2, timeout=1, secret="secret")
+
+
+def signed(method, path, timestamp=None, secret=None):
+    timestamp = str(int(time.time())) if timestamp is None else timestamp
+    return {
+        "X-Shard-Timestamp": timestamp,
+        "X-Shard-Signature": sign_shard_request(secret or main.INTERNAL_AUTH_SECRET, method, path, timestamp),
+    }
+
+
+def test_signed_shard_requests_are_accepted(client):
+    assert client.get("/shard/rollup", headers=signed("GET", "/shard/rollup")).status_code == 200
+
+
+@pytest.mark.parametrize("headers", [
+    {},
+    signed("GET", "/shard/rollup", secret="another secret"),
+    signed("GET", "/shard/rollup", timestamp=str(int(time.time()) - 3600)),
+    signed("GET", "/shard/rollup", timestamp="now"),
+    signed("GET", "/shard/events"),
+    signed("DELETE", "/shard/rollup"),
+])
+def test_unsigned_shard_requests_are_refused(client, headers):
+    rejected = main.shards.rejected
+    assert client.get("/shard/rollup", headers=headers).status_code == 403
+    assert main.shards.rejected == rejected + 1
+
+
+def test_gather_signs_requests_to_other_shards():
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(200, json=[{"key": "view", "count": 2}])
+
+    async def scenario():
+        shards = ShardSet(["http://shard-0", "http://shard-1"], 0, timeout=1, secret="secret")
+        shards._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        async def local():
+            return [{"key": "view", "count": 1}, {"key": "click", "count": 1}]
+
+        results = await shards.gather("GET", "/shard/rollup", {"group_by": "event_type", "since": None}, local)
+        await shards.close()
+        return results
+
+    results = asyncio.run(scenario())
+
+    assert merge_counts(results) == [{"key": "view", "count": 3}, {"key": "click", "count": 1}]
+    request, = seen
+    assert str(request.url) == "http://shard-1/shard/rollup?group_by=event_type"
+    timestamp = request.headers["x-shard-timestamp"]
+    assert request.headers["x-shard-signature"] == sign_shard_request("secret", "GET", "/shard/rollup", timestamp)
+
+
+def test_merge_events_keeps_the_global_order():
+    def event(second, event_id):
+        return {"id": event_id, "timestamp": f"2024-01-01T00:00:{second:02d}"}
+
+    first = [event(5, "00000000-0000-0000-0000-000000000001"), event(1, "00000000-0000-0000-0000-000000000002")]
+    second = [event(3, "00000000-0000-0000-0000-000000000003")]
+
+    events, cursor = merge_events([first, second], limit=2)
+
+    assert [e["timestamp"][-2:] for e in events] == ["05", "03"]
+    assert cursor is not None
+    assert merge_events([first, second], limit=5)[1] is None
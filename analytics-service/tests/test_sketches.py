@@ -0,0 +1,210 @@
+import math
+import random
+
+import pytest
+
+from sketches import OTHER_EVENT_TYPES, DDSketch, HyperLogLog, SketchAggregator, hash_user
+
+HOUR_US = 3600 * 1_000_000
+
+
+def users_sketch(user_ids, precision=12):
+    sketch = HyperLogLog(precision)
+    for user_id in user_ids:
+        sketch.add_hash(hash_user(user_id))
+    return sketch
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def test_hll_empty_and_small():
+    assert users_sketch([]).estimate() == 0
+    assert round(users_sketch([7]).estimate()) == 1
+    assert round(users_sketch([7, 7, 7]).estimate()) == 1
+    assert abs(users_sketch(range(10)).estimate() - 10) <= 1
+
+
+@pytest.mark.parametrize("count", [1_000, 20_000, 200_000])
+def test_hll_error_bound(count):
+    sketch = users_sketch(range(count))
+    # 1.04 / sqrt(m) is the standard error; allow three of them
+    bound = 3 * 1.04 / math.sqrt(1 << sketch.precision)
+    assert abs(sketch.estimate() - count) / count < bound
+
+
+def test_hll_merge_is_union():
+    left = users_sketch(range(0, 30_000))
+    right = users_sketch(range(20_000, 50_000))
+    both = users_sketch(range(50_000))
+
+    left.merge(right)
+
+    assert left.registers == both.registers
+    assert abs(left.estimate() - 50_000) / 50_000 < 0.05
+
+
+def test_hll_merge_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(10))
+
+
+def test_hll_serialization():
+    sketch = users_sketch(range(5_000), precision=10)
+    restored = HyperLogLog.from_dict(sketch.to_dict())
+    assert restored.precision == 10
+    assert restored.registers == sketch.registers
+
+    data = sketch.to_dict()
+    data["precision"] = 11
+    with pytest.raises(ValueError):
+        HyperLogLog.from_dict(data)
+
+
+def test_hll_precision_bounds():
+    with pytest.raises(ValueError):
+        HyperLogLog(3)
+    with pytest.raises(ValueError):
+        HyperLogLog(17)
+
+
+def test_ddsketch_empty():
+    assert DDSketch().quantile(0.5) is None
+
+
+@pytest.mark.parametrize("accuracy", [0.01, 0.05])
+def test_ddsketch_relative_error(accuracy):
+    rng = random.Random(1)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(20_000)]
+    sketch = DDSketch(accuracy)
+    for value in values:
+        sketch.add(value)
+
+    for q in (0.0, 0.1, 0.5, 0.9, 0.99, 0.999, 1.0):
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= accuracy * expected + 1e-9
+    assert sketch.count == len(values)
+    assert sketch.sum == pytest.approx(sum(values))
+
+
+def test_ddsketch_negative_and_zero_values():
+    values = [-100.0, -10.0, -1.0, 0.0, 0.0, 1.0, 10.0, 100.0, 1000.0]
+    sketch = DDSketch(0.01)
+    for value in values:
+        sketch.add(value)
+
+    assert sketch.quantile(0) == -100.0
+    assert sketch.quantile(1) == 1000.0
+    for q, expected in ((0.125, -10.0), (0.25, -1.0), (0.375, 0.0), (0.625, 1.0), (0.75, 10.0)):
+        assert sketch.quantile(q) == pytest.approx(expected, rel=0.01)
+
+
+def test_ddsketch_merge_matches_single_sketch():
+    rng = random.Random(2)
+    values = [rng.expovariate(0.01) for _ in range(10_000)]
+    whole, left, right = DDSketch(), DDSketch(), DDSketch()
+    for i, value in enumerate(values):
+        whole.add(value)
+        (left if i % 2 else right).add(value)
+
+    left.merge(right)
+
+    for q in (0.5, 0.9, 0.99):
+        assert left.quantile(q) == pytest.approx(whole.quantile(q))
+    assert (left.count, left.min, left.max) == (whole.count, whole.min, whole.max)
+
+
+def test_ddsketch_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        DDSketch(0.01).merge(DDSketch(0.02))
+
+
+def test_ddsketch_bin_limit_keeps_upper_quantiles():
+    sketch = DDSketch(0.01, max_bins=64)
+    values = [1.5 ** i for i in range(200)]
+    for value in values:
+        sketch.add(value)
+
+    assert len(sketch.positive.counts) <= 64
+    # Collapsing folds the lowest bins, so high quantiles stay accurate
+    expected = exact_quantile(values, 0.99)
+    assert sketch.quantile(0.99) == pytest.approx(expected, rel=0.01)
+
+
+def test_ddsketch_serialization():
+    sketch = DDSketch(0.02)
+    for value in (-3.0, 0.0, 2.5, 40.0):
+        sketch.add(value)
+    restored = DDSketch.from_dict(sketch.to_dict())
+    for q in (0, 0.3, 0.6, 1):
+        assert restored.quantile(q) == sketch.quantile(q)
+    assert DDSketch.from_dict(DDSketch().to_dict()).quantile(0.5) is None
+
+
+def test_aggregator_unique_users_across_buckets():
+    aggregator = SketchAggregator({"minute": None, "hour": None, "day": None})
+    for hour in range(3):
+        for user_id in range(hour * 100, hour * 100 + 200):
+            aggregator.add("view", user_id, None, hour * HOUR_US)
+    aggregator.add("click", 1, None, 0)
+    aggregator.add("view", None, None, 0)
+
+    by_time = aggregator.unique_users("time", "hour", event_type="view")
+    assert sorted(by_time) == [0, 3600, 7200]
+    assert all(abs(sketch.estimate() - 200) <= 8 for sketch in by_time.values())
+
+    total = aggregator.unique_users("all", "hour", event_type="view")["all"]
+    assert abs(total.estimate() - 400) <= 16
+    # Merging a range never changes the stored sketches
+    again = aggregator.unique_users("time", "hour", event_type="view")
+    assert again[0].estimate() == by_time[0].estimate()
+
+    by_type = aggregator.unique_users("event_type", "day")
+    assert round(by_type["click"].estimate()) == 1
+
+
+def test_aggregator_values():
+    aggregator = SketchAggregator({"minute": None, "hour": None, "day": None}, fields={"ms"})
+    for i in range(1, 101):
+        aggregator.add("load", None, {"ms": i, "other": 5, "flag": True}, (i % 2) * HOUR_US)
+
+    merged = aggregator.values("load", "ms", "all", "hour")["all"]
+    assert merged.count == 100
+    assert merged.quantile(0.5) == pytest.approx(50, rel=0.02)
+    assert aggregator.values("load", "other", "all", "hour") == {}
+    assert set(aggregator.values("load", "ms", "time", "hour", since=3600)) == {3600}
+
+
+def test_aggregator_field_cap():
+    aggregator = SketchAggregator({"hour": None, "day": None}, max_fields=2)
+    aggregator.add("load", None, {"a": 1, "b": 2, "c": 3}, 0)
+    aggregator.add("load", None, {"c": 3, "b": 2}, 0)
+
+    assert aggregator.fields_by_type["load"] == {"a", "b"}
+    assert aggregator.values("load", "c", "all", "hour") == {}
+    assert aggregator.values("load", "b", "all", "hour")["all"].count == 2
+
+
+def test_aggregator_event_type_cap():
+    aggregator = SketchAggregator({"hour": None, "day": None}, max_event_types=2)
+    for i, event_type in enumerate(["view", "click", "view", "custom-1", "custom-2"]):
+        aggregator.add(event_type, i, {"ms": i}, 0)
+    # Events without users or fields never take a slot
+    aggregator.add("empty", None, None, 0)
+
+    by_type = aggregator.unique_users("event_type", "day")
+    assert set(by_type) == {"view", "click", OTHER_EVENT_TYPES}
+    assert round(by_type[OTHER_EVENT_TYPES].estimate()) == 2
+    assert aggregator.values(OTHER_EVENT_TYPES, "ms", "all", "day")["all"].count == 2
+    assert aggregator.unique_users("event_type", "day", event_type="custom-1") == {}
+
+    stats = aggregator.stats()
+    assert (stats["event_types"], stats["folded_events"]) == (2, 2)
+    # One HyperLogLog per tracked type (and other) per hour and day bucket
+    assert stats["user_series"] == 6
+
+    aggregator.clear()
+    aggregator.add("custom-1", 1, None, 0)
+    assert set(aggregator.unique_users("event_type", "day")) == {"custom-1"}
@@ -0,0 +1,90 @@
+import os
+from datetime import timedelta
+
+import pytest
+
+from conftest import START, make_events, wait_for_sealer
+from storage import OPEN_SUFFIX, SEALED_SUFFIX, EventStore
+
+
+def segment_files(data_dir, suffix):
+    return sorted(name for name in os.listdir(data_dir) if name.endswith(suffix))
+
+
+def test_round_trip(store):
+    events = make_events(5)
+    store.append_batch(events)
+
+    results, cursor = store.query(limit=10)
+
+    assert cursor is None
+    assert [(e["id"], e["event_type"], e["user_id"], e["event_data"], e["timestamp"]) for e in results] == [
+        event for event in reversed(events)
+    ]
+
+
+def test_rolled_segments_are_sealed(rolling_store, tmp_path):
+    events = make_events(6)
+    rolling_store.append_batch(events)
+    wait_for_sealer(rolling_store)
+
+    stats = rolling_store.stats()
+    assert stats["segments"] == 6
+    assert stats["sealed_segments"] == 5
+    assert len(segment_files(tmp_path, SEALED_SUFFIX)) == 5
+    assert len(segment_files(tmp_path, OPEN_SUFFIX)) == 1
+
+    results, _ = rolling_store.query(limit=10)
+    assert [e["id"] for e in results] == [event[0] for event in reversed(events)]
+
+
+def test_sealing_sorts_out_of_order_events(tmp_path):
+    store = EventStore(str(tmp_path))
+    events = make_events(10)
+    store.append_batch(list(reversed(events)))
+    store._roll()
+    wait_for_sealer(store)
+
+    assert store.stats()["sealed_segments"] == 1
+    results, _ = store.query(limit=20)
+    assert [e["id"] for e in results] == [event[0] for event in reversed(events)]
+    store.close()
+
+
+def test_reopen_seals_leftover_segments(tmp_path):
+    events = make_events(8)
+    store = EventStore(str(tmp_path))
+    store.append_batch(events)
+    store.close()
+    assert len(segment_files(tmp_path, OPEN_SUFFIX)) == 1
+
+    store = EventStore(str(tmp_path))
+    try:
+        wait_for_sealer(store)
+        assert len(segment_files(tmp_path, SEALED_SUFFIX)) == 1
+        results, _ = store.query(limit=20)
+        assert [e["id"] for e in results] == [event[0] for event in reversed(events)]
+
+        # Event types are interned again in the same order after a restart
+        store.append_batch(make_events(2, start=START + timedelta(hours=1)))
+        clicks, _ = store.query(event_type="click", limit=20)
+        assert len(clicks) == 5
+    finally:
+        store.close()
+
+
+def test_store_directory_is_locked(store, tmp_path):
+    with pytest.raises(RuntimeError):
+        EventStore(str(tmp_path))
+
+
+def test_clear(rolling_store, tmp_path):
+    rolling_store.append_batch(make_events(5))
+    wait_for_sealer(rolling_store)
+
+    rolling_store.clear()
+
+    assert rolling_store.query() == ([], None)
+    assert segment_files(tmp_path, SEALED_SUFFIX) == []
+    rolling_store.append_batch(make_events(1))
+    assert len(rolling_store.query()[0]) == 1
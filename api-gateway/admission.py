@@ -0,0 +1,197 @@
+"""Adaptive concurrency limiting and priority load shedding for upstreams.
+
+Each upstream service gets a ``ConcurrencyLimiter`` that caps the requests
+the gateway has in flight to it. The cap is not configured but learned
+from latency, in the style of a gradient limiter:
+
+* ``long_rtt`` is the latency the service shows when it is not
+  overloaded. It follows faster responses quickly, but only rises slowly,
+  and only with responses observed while the limiter was not saturated.
+  There is one per priority class, because classes are routes of very
+  different cost: auth's critical ``/verify`` answers in a millisecond,
+  its normal ``/token`` spends hundreds of milliseconds in bcrypt;
+* every response compares its own latency with its class's baseline.
+  While latency stays within ``tolerance`` times the baseline, the limit
+  grows by about sqrt(limit). Past that it shrinks in proportion (at most halving per
+  sample), smoothed so single slow responses barely move it;
+* a failed or shed response (connection error, timeout, 502/503/504) cuts
+  the limit multiplicatively;
+* the limit only grows while at least half of it is in use, so a quiet
+  service does not build up headroom it has never proven.
+
+Requests over the limit wait in a short, bounded queue ordered by
+priority (``critical`` before ``normal`` before ``low``, FIFO within a
+class). A request that cannot be admitted within ``queue_timeout``, or
+that finds the queue full with nothing of lower priority to displace, is
+rejected at once with ``Overloaded``. The gateway answers 503 with
+Retry-After, instead of letting the request time out against a saturated
+service. Under overload the upstream therefore keeps working at about
+its capacity, and low-priority traffic such as analytics tracking is shed
+before token verification or health checks.
+"""
+import asyncio
+import math
+from collections import deque
+from typing import Dict, Optional
+
+from prometheus_client import Counter
+
+CRITICAL = "critical"
+NORMAL = "normal"
+LOW = "low"
+# Highest first
+PRIORITIES = (CRITICAL, NORMAL, LOW)
+
+SHED_REQUESTS = Counter(
+    "gateway_shed_requests_total",
+    "Requests rejected by an upstream's concurrency limiter",
+    ["service", "priority"],
+)
+
+
+class Overloaded(Exception):
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"Service '{service}' is over its concurrency limit")
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = 20,
+        min_limit: int = 4,
+        max_limit: int = 500,
+        tolerance: float = 2.0,
+        max_queue: int = 500,
+        queue_timeout: float = 0.5,
+        retry_after: float = 1.0,
+        smoothing: float = 0.2,
+        backoff: float = 0.9,
+        long_window: int = 600,
+    ):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.long_window = long_window
+        # Per priority class, see the module docstring
+        self.long_rtt: Dict[str, float] = {}
+        self.in_flight = 0
+        self.queued = 0
+        self.shed: Dict[str, int] = {priority: 0 for priority in PRIORITIES}
+        self._waiters: Dict[str, deque] = {priority: deque() for priority in PRIORITIES}
+
+    def _has_room(self) -> bool:
+        return self.in_flight < max(int(self.limit), 1)
+
+    def _queued_ahead(self, priority: str) -> bool:
+        for level in PRIORITIES:
+            if self._waiters[level]:
+                return True
+            if level == priority:
+                return False
+        return False
+
+    def _reject(self, priority: str) -> Overloaded:
+        self.shed[priority] += 1
+        SHED_REQUESTS.labels(self.name, priority).inc()
+        return Overloaded(self.name, self.retry_after)
+
+    def _displace(self, priority: str) -> bool:
+        """Reject the newest waiter of the lowest class below priority."""
+        for level in reversed(PRIORITIES):
+            if level == priority:
+                return False
+            if self._waiters[level]:
+                waiter = self._waiters[level].pop()
+                self.queued -= 1
+                waiter.set_exception(self._reject(level))
+                return True
+        return False
+
+    async def acquire(self, priority: str = NORMAL):
+        """Take a slot, waiting briefly behind higher or equal priority
+        requests. Raises Overloaded when the request is shed."""
+        if self._has_room() and not self._queued_ahead(priority):
+            self.in_flight += 1
+            return
+        if self.queued >= self.max_queue and not self._displace(priority):
+            raise self._reject(priority)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(priority, waiter)
+            raise self._reject(priority)
+        except asyncio.CancelledError:
+            self._abandon(priority, waiter)
+            raise
+
+    def _abandon(self, priority: str, waiter: asyncio.Future):
+        try:
+            self._waiters[priority].remove(waiter)
+            self.queued -= 1
+        except ValueError:
+            # Granted a slot just as the wait ended; hand it on
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+
+    def _grant(self):
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters and self._has_room():
+                waiter = waiters.popleft()
+                self.queued -= 1
+                if not waiter.done():
+                    self.in_flight += 1
+                    waiter.set_result(None)
+
+    def release(self, rtt: Optional[float] = None, dropped: bool = False, priority: str = NORMAL):
+        """Free a slot. rtt is the request's latency, or None when the
+        request says nothing about the service's capacity; it is compared
+        with the baseline of the request's priority class."""
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if dropped:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif rtt is not None:
+            self._update(rtt, in_flight, priority)
+        self._grant()
+
+    def _update(self, rtt: float, in_flight: int, priority: str = NORMAL):
+        rtt = max(rtt, 1e-6)
+        congested = in_flight > max(self.min_limit, self.limit / 2)
+        long_rtt = self.long_rtt.get(priority)
+        if long_rtt is None:
+            long_rtt = rtt
+        elif rtt < long_rtt:
+            long_rtt += (rtt - long_rtt) * self.smoothing
+        elif not congested:
+            # Latency under overload is queueing, not the service getting
+            # slower, so only uncongested samples may raise the baseline
+            long_rtt += (rtt - long_rtt) / self.long_window
+        self.long_rtt[priority] = long_rtt
+        if in_flight < self.limit / 2:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * long_rtt / rtt))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "long_rtt": {priority: round(rtt, 6) for priority, rtt in self.long_rtt.items()},
+            **{f"shed_{priority}": count for priority, count in self.shed.items()},
+        }
@@ -0,0 +1,135 @@
+"""Request coalescing and a short-lived response cache for the API Gateway.
+
+Identical concurrent GETs (same route, path, query, content negotiation,
+conditional and range headers, and caller identity) share one upstream
+call: the first request leads the flight and the rest wait for its
+buffered response. Only a 200 is shared. For any other status, and for
+responses too large to buffer, the response goes to the leader only and
+the waiting requests fall back to their own upstream calls.
+
+The response cache keeps buffered 200 responses for at most the route's
+``cache_ttl``, shortened by ``max-age``/``s-maxage`` and skipped for
+``no-store``, ``no-cache`` and ``private``. Any unsafe request to a
+service drops that service's cached responses.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Union
+
+from fastapi import Response
+
+
+class BufferedResponse:
+    __slots__ = ("status_code", "headers", "body")
+
+    def __init__(self, status_code: int, headers: Dict[str, str], body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def to_response(self) -> Response:
+        return Response(content=self.body, status_code=self.status_code, headers=self.headers)
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in value.split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def cache_ttl(headers, default_ttl: float) -> float:
+    """Seconds a response may be cached: the route default, capped by the
+    upstream's Cache-Control. 0 means do not cache."""
+    if default_ttl <= 0 or "set-cookie" in headers or headers.get("vary", "").strip() == "*":
+        return 0.0
+    directives = parse_cache_control(headers.get("cache-control", ""))
+    if directives.keys() & {"no-store", "no-cache", "private"}:
+        return 0.0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name) is not None:
+            try:
+                return max(0.0, min(float(directives[name]), default_ttl))
+            except ValueError:
+                return 0.0
+    return default_ttl
+
+
+class ResponseCache:
+    def __init__(self, maxsize: int):
+        # Entries are grouped per service so invalidation is a single pop
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._services: Dict[str, OrderedDict] = {}
+
+    def get(self, service: str, key: Hashable) -> Optional[BufferedResponse]:
+        entries = self._services.get(service)
+        entry = entries.get(key) if entries is not None else None
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del entries[key]
+            self.misses += 1
+            return None
+        entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, service: str, key: Hashable, response: BufferedResponse, ttl: float):
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        entries = self._services.setdefault(service, OrderedDict())
+        entries[key] = (time.monotonic() + ttl, response)
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def invalidate(self, service: str):
+        self._services.pop(service, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": sum(len(entries) for entries in self._services.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class SingleFlight:
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+
+    def join(self, key: Hashable) -> Optional[asyncio.Future]:
+        """Return the in-flight call for key, if there is one."""
+        future = self._flights.get(key)
+        if future is not None:
+            self.followers += 1
+        return future
+
+    def lead(self, key: Hashable) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        self.leaders += 1
+        return future
+
+    def finish(self, key: Hashable, future: asyncio.Future, outcome: Union[BufferedResponse, Exception, None]):
+        """Hand the leader's outcome to the followers. None tells them to
+        make their own call, an exception is raised in each of them."""
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if future.done():
+            return
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+            # Mark it retrieved so a flight without followers does not warn
+            future.exception()
+        else:
+            future.set_result(outcome)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "followers": self.followers}
@@ -0,0 +1,197 @@
+"""Negotiated response compression for the API Gateway.
+
+Responses are compressed with the best coding the client accepts
+(``Accept-Encoding`` with q-values): brotli when the ``brotli`` package is
+installed, otherwise gzip. A response is left alone when it is smaller
+than the minimum size, already encoded, or not a text-like media type.
+
+Buffered responses are compressed in one go and keep a Content-Length.
+Streamed responses are compressed chunk by chunk and flushed after every
+chunk, so a client still sees each piece as soon as the upstream sends it.
+Strong ETags are weakened on compressed responses, since the bytes differ
+from the ones the upstream tagged (upstream If-None-Match comparison is
+weak, so revalidation keeps working).
+"""
+import zlib
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def parse_accept_encoding(value: str) -> Dict[str, float]:
+    codings = {}
+    for part in value.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, argument = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(argument)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+class GzipEncoder:
+    def __init__(self, level: int):
+        # wbits 31: zlib stream with a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ResponseCompression:
+    """Settings and counters shared by every request."""
+
+    def __init__(self, minimum_size: int, gzip_level: int, brotli_quality: int):
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        # Preference order when the client rates codings equally
+        self.codings = (["br"] if brotli is not None else []) + ["gzip"]
+        self.responses = {coding: 0 for coding in self.codings}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for coding in self.codings:
+            q = accepted.get(coding, accepted.get("*", 0.0))
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def encoder(self, coding: str):
+        if coding == "br":
+            return BrotliEncoder(self.brotli_quality)
+        return GzipEncoder(self.gzip_level)
+
+    def stats(self) -> dict:
+        return {
+            **{f"{coding}_responses": count for coding, count in self.responses.items()},
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+def compressible(headers: Headers) -> bool:
+    if "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    def __init__(self, app, compression: ResponseCompression):
+        self.app = app
+        self.compression = compression
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        coding = self.compression.negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        compression = self.compression
+        start = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, encoder, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows what to do
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                headers = MutableHeaders(raw=start["headers"])
+                # A streamed body's size is only known from Content-Length
+                length = headers.get("content-length")
+                size = len(body) if not more_body else int(length) if length and length.isdigit() else None
+                if (
+                    start["status"] < 200 or start["status"] in (204, 304)
+                    or not compressible(headers)
+                    or (size is not None and size < compression.minimum_size)
+                ):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                encoder = compression.encoder(coding)
+                compression.responses[coding] += 1
+                headers["content-encoding"] = coding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag is not None and not etag.startswith("W/"):
+                    headers["etag"] = "W/" + etag
+                if more_body:
+                    del headers["content-length"]
+                else:
+                    data = encoder.compress(body) + encoder.finish()
+                    headers["content-length"] = str(len(data))
+                    compression.bytes_in += len(body)
+                    compression.bytes_out += len(data)
+                    await send(start)
+                    await send({"type": "http.response.body", "body": data})
+                    return
+                await send(start)
+
+            data = encoder.compress(body) + (encoder.flush() if more_body else encoder.finish())
+            compression.bytes_in += len(body)
+            compression.bytes_out += len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
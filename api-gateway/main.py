@@ -1,32 +1,168 @@
 from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from collections import OrderedDict
+import asyncio
+import base64
+import hashlib
+import hmac
 import httpx
+import json
 import os
-from typing import Dict, Any
+import posixpath
+import time
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, List, Optional, Tuple
+from admission import CRITICAL, LOW, NORMAL, ConcurrencyLimiter, Overloaded
+from coalesce import BufferedResponse, ResponseCache, SingleFlight, cache_ttl, parse_cache_control
+from compression import CompressionMiddleware, ResponseCompression
+from resilience import CircuitBreaker, CircuitOpen, RetryBudget, Upstream
+from metrics import instrument, register_stats
+from tracing import trace_app, tracer
+from logs import configure_logging, pipeline as log_pipeline
 
 # Service URLs
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:3001")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:3002")
 ANALYTICS_SERVICE_URL = os.getenv("ANALYTICS_SERVICE_URL", "http://analytics-service:3004")
 
+def service_urls(name: str, default: str) -> List[str]:
+    """Comma-separated endpoint list, e.g. USER_SERVICE_URLS=http://a:3002,http://b:3002"""
+    urls = [url.strip() for url in os.getenv(name, "").split(",") if url.strip()]
+    return urls or [default]
+
+# Upstream connection pool settings (per service)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "2"))
+DEFAULT_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+
+# Retries, circuit breaking and outlier ejection (per service)
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+RETRY_BUDGET_RATIO = float(os.getenv("UPSTREAM_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("UPSTREAM_RETRY_BUDGET_MIN_PER_SECOND", "1"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_RECOVERY_TIMEOUT = float(os.getenv("UPSTREAM_BREAKER_RECOVERY", "10"))  # seconds
+OUTLIER_CONSECUTIVE_ERRORS = int(os.getenv("UPSTREAM_OUTLIER_ERRORS", "5"))
+# 0 disables latency-based ejection
+OUTLIER_LATENCY_FACTOR = float(os.getenv("UPSTREAM_OUTLIER_LATENCY_FACTOR", "3"))
+OUTLIER_EJECTION_TIME = float(os.getenv("UPSTREAM_OUTLIER_EJECTION_TIME", "30"))  # seconds
+
+# Adaptive concurrency limit and priority shedding (per service, see admission.py)
+ADAPTIVE_LIMIT = os.getenv("UPSTREAM_ADAPTIVE_LIMIT", "true").lower() == "true"
+LIMIT_INITIAL = int(os.getenv("UPSTREAM_LIMIT_INITIAL", "20"))
+LIMIT_MIN = int(os.getenv("UPSTREAM_LIMIT_MIN", "4"))
+LIMIT_MAX = int(os.getenv("UPSTREAM_LIMIT_MAX", "500"))
+# Latency growth over the baseline tolerated before the limit shrinks
+LIMIT_TOLERANCE = float(os.getenv("UPSTREAM_LIMIT_TOLERANCE", "2"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("UPSTREAM_ADMISSION_QUEUE_SIZE", "500"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_ADMISSION_QUEUE_TIMEOUT", "0.5"))  # seconds
+SHED_RETRY_AFTER = float(os.getenv("UPSTREAM_SHED_RETRY_AFTER", "1"))  # seconds
+# Deadline and read timeout for auth's POST /register/batch, which hashes
+# up to REGISTER_BATCH_MAX passwords; size it to that x one hash / HASH_WORKERS
+REGISTER_BATCH_DEADLINE = float(os.getenv("GATEWAY_REGISTER_BATCH_DEADLINE", "60"))  # seconds
+
+# Edge authentication settings
+INTERNAL_AUTH_SECRET = os.getenv("INTERNAL_AUTH_SECRET", "your_internal_secret")
+AUTH_CACHE_SIZE = int(os.getenv("GATEWAY_AUTH_CACHE_SIZE", "10000"))
+# Upper bound on how long a revoked token can keep passing the gateway
+AUTH_CACHE_MAX_TTL = float(os.getenv("GATEWAY_AUTH_CACHE_MAX_TTL", "300"))
+
+# Request coalescing and response caching for idempotent routes
+COALESCE_MAX_BODY = int(os.getenv("GATEWAY_COALESCE_MAX_BODY", str(1024 * 1024)))  # bytes
+RESPONSE_CACHE_SIZE = int(os.getenv("GATEWAY_RESPONSE_CACHE_SIZE", "1000"))  # per service
+# 0 disables the response cache; upstream Cache-Control can only shorten it
+RESPONSE_CACHE_TTL = float(os.getenv("GATEWAY_RESPONSE_CACHE_TTL", "0"))  # seconds
+
+# Negotiated gzip/br compression of responses to clients
+COMPRESSION_ENABLED = os.getenv("GATEWAY_COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("GATEWAY_COMPRESSION_MIN_SIZE", "1024"))  # bytes
+GZIP_LEVEL = int(os.getenv("GATEWAY_GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("GATEWAY_BROTLI_QUALITY", "4"))
+
 # Service routes configuration
 SERVICE_ROUTES = {
     "auth": {
         "prefix": "/auth",
         "target": AUTH_SERVICE_URL,
+        "targets": service_urls("AUTH_SERVICE_URLS", AUTH_SERVICE_URL),
+        "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+        "read_timeout": 10.0,
+        # Total time for a request across all attempts
+        "deadline": 10.0,
+        # Admission priority by "METHOD /path"; anything else is "normal"
+        "priorities": {"POST /verify": CRITICAL, "POST /register/batch": LOW},
+        # Per-route deadline and read timeout by "METHOD /path"
+        "deadlines": {"POST /register/batch": REGISTER_BATCH_DEADLINE},
     },
     "users": {
         "prefix": "/users",
         "target": USER_SERVICE_URL,
+        "targets": service_urls("USER_SERVICE_URLS", USER_SERVICE_URL),
+        # Bearer tokens are verified here and replaced by identity headers
+        "protected": True,
+        # Concurrent identical GETs share one upstream call
+        "coalesce": True,
+        "cache_ttl": RESPONSE_CACHE_TTL,
+        "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+        "read_timeout": 10.0,
+        "deadline": 10.0,
     },
     "analytics": {
         "prefix": "/analytics",
         "target": ANALYTICS_SERVICE_URL,
+        "targets": service_urls("ANALYTICS_SERVICE_URLS", ANALYTICS_SERVICE_URL),
+        "coalesce": True,
+        "cache_ttl": RESPONSE_CACHE_TTL,
+        "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+        "read_timeout": DEFAULT_READ_TIMEOUT,
+        "deadline": DEFAULT_READ_TIMEOUT,
+        # Ingest is shed first; a client can resend it later
+        "priorities": {"POST /track": LOW, "POST /track/batch": LOW},
+        # Bulk exports go straight through; coalescing would buffer them
+        "streamed": {"/events/export"},
+        # Shard-to-shard endpoints, never reachable through the gateway
+        "internal": ("/shard",),
     }
 }
 
+# Health checks are never shed ahead of regular traffic
+HEALTH_PATHS = {"", "/", "/ready", "/health"}
+
+# Headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Identity headers set by the gateway for protected routes
+IDENTITY_HEADERS = ("x-user-id", "x-user-email", "x-identity-timestamp", "x-identity-signature")
+
 app = FastAPI(title="API Gateway")
 
+def metrics_route(scope) -> str:
+    """Label proxied requests by service; every one of them matches the
+    same catch-all route."""
+    service_name = scope.get("path_params", {}).get("service_name")
+    if service_name in SERVICE_ROUTES:
+        return f"/{service_name}"
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+instrument(app, route_label=metrics_route)
+trace_app(app, "api-gateway", route_label=metrics_route)
+configure_logging(app, "api-gateway")
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -34,10 +170,315 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# Create HTTP client
-http_client = httpx.AsyncClient()
+compression = ResponseCompression(COMPRESSION_MIN_SIZE, GZIP_LEVEL, BROTLI_QUALITY)
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware, compression=compression)
+
+# One pooled keep-alive client per upstream endpoint
+def create_upstream_client(service_config: Dict[str, Any], base_url: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=base_url,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            service_config.get("read_timeout", DEFAULT_READ_TIMEOUT),
+            connect=service_config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+        ),
+        http2=UPSTREAM_HTTP2,
+    )
+
+def create_limiter(name: str) -> Optional[ConcurrencyLimiter]:
+    if not ADAPTIVE_LIMIT:
+        return None
+    return ConcurrencyLimiter(
+        name,
+        initial_limit=LIMIT_INITIAL,
+        min_limit=LIMIT_MIN,
+        max_limit=LIMIT_MAX,
+        tolerance=LIMIT_TOLERANCE,
+        max_queue=ADMISSION_QUEUE_SIZE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        retry_after=SHED_RETRY_AFTER,
+    )
+
+def create_upstream(name: str, service_config: Dict[str, Any]) -> Upstream:
+    return Upstream(
+        name,
+        service_config["targets"],
+        partial(create_upstream_client, service_config),
+        deadline=service_config.get("deadline", DEFAULT_READ_TIMEOUT),
+        max_retries=UPSTREAM_MAX_RETRIES,
+        retry_budget=RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND),
+        breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_TIMEOUT),
+        outlier_errors=OUTLIER_CONSECUTIVE_ERRORS,
+        outlier_latency_factor=OUTLIER_LATENCY_FACTOR,
+        ejection_time=OUTLIER_EJECTION_TIME,
+        limiter=create_limiter(name),
+    )
+
+upstreams = {name: create_upstream(name, config) for name, config in SERVICE_ROUTES.items()}
+
+def filter_headers(headers) -> Dict[str, str]:
+    """Drop hop-by-hop headers, including any named in the Connection header."""
+    connection_tokens = {
+        token.strip().lower()
+        for token in headers.get("connection", "").split(",")
+        if token.strip()
+    }
+    return {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in connection_tokens
+    }
+
+# Edge authentication
+class TokenCache:
+    """LRU of verified tokens keyed by token hash, expiring at the token's
+    exp (capped at AUTH_CACHE_MAX_TTL)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, expires_at: float, user: dict):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (expires_at, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+token_cache = TokenCache(AUTH_CACHE_SIZE)
+
+def token_expiry(token: str) -> Optional[float]:
+    """Read exp from the JWT payload. The signature is checked by the Auth
+    Service, this only bounds how long the result is cached."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError):
+        return None
+
+def sign_identity(user_id: str, email: str, timestamp: str) -> str:
+    message = f"{user_id}|{email}|{timestamp}".encode()
+    return hmac.new(INTERNAL_AUTH_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+async def authenticate(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).hexdigest()
+    user = token_cache.get(key)
+    if user is not None:
+        return user
+
+    response = await send_upstream(
+        "auth", partial(upstreams["auth"].request, "POST", "/verify", priority=CRITICAL, json={"token": token})
+    )
+    if response.status_code == 429 or response.status_code >= 500:
+        # The Auth Service could not answer; the token may well be valid
+        retry_after = response.headers.get("retry-after", "")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Service 'auth' unavailable: HTTP {response.status_code}",
+            headers={"Retry-After": retry_after if retry_after.isdigit() else str(max(1, round(SHED_RETRY_AFTER)))},
+        )
+    if response.status_code not in (200, 401):
+        raise HTTPException(status_code=502, detail=f"Service 'auth' returned HTTP {response.status_code} from /verify")
+    result = response.json() if response.status_code == 200 else {}
+    if not result.get("valid", False):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    user = result["user"]
+    expires_at = time.time() + AUTH_CACHE_MAX_TTL
+    exp = token_expiry(token)
+    if exp is not None:
+        expires_at = min(expires_at, exp)
+    token_cache.put(key, expires_at, user)
+    return user
+
+async def identity_headers(request: Request) -> Dict[str, str]:
+    """Verify the bearer token (if any) and return signed identity headers.
+    Requests without a token pass through so public routes keep working."""
+    authorization = request.headers.get("authorization", "")
+    if not authorization.startswith("Bearer "):
+        return {}
+    user = await authenticate(authorization[len("Bearer "):])
+    user_id, email = str(user["id"]), user["email"]
+    timestamp = str(int(time.time()))
+    return {
+        "x-user-id": user_id,
+        "x-user-email": email,
+        "x-identity-timestamp": timestamp,
+        "x-identity-signature": sign_identity(user_id, email, timestamp),
+    }
+
+# Request coalescing
+single_flight = SingleFlight()
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+# Request headers that can turn the same GET into a 304, 412 or 206
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since", "if-match", "if-unmodified-since", "if-range", "range")
+
+def coalesce_key(service_name: str, path: str, request: Request) -> Tuple:
+    """Requests with equal keys must get byte-identical responses."""
+    identity = "\n".join(request.headers.get(name, "") for name in ("authorization", "cookie"))
+    return (
+        service_name,
+        path,
+        tuple(sorted(request.query_params.multi_items())),
+        hashlib.sha256(identity.encode()).hexdigest() if identity.strip() else None,
+        request.headers.get("accept", ""),
+        request.headers.get("accept-encoding", ""),
+        tuple(request.headers.get(name, "") for name in CONDITIONAL_HEADERS),
+    )
+
+async def send_upstream(service_name: str, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+    """Run an upstream call, mapping transport failures to gateway errors."""
+    try:
+        return await send()
+    except (CircuitOpen, Overloaded) as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Service '{service_name}' unavailable: {str(e)}",
+            headers={"Retry-After": str(max(1, round(e.retry_after)))},
+        )
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"Service '{service_name}' timed out: {str(e)}")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=503, detail=f"Service '{service_name}' unavailable: {str(e)}")
+
+async def read_limited(response: httpx.Response, limit: int) -> Tuple[bytes, bool]:
+    """Read up to limit bytes of the raw body; the flag says whether that
+    was all of it."""
+    length = response.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        return b"", False
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_raw():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return b"".join(chunks), False
+    return b"".join(chunks), True
+
+async def prepend(prefix: bytes, rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if prefix:
+        yield prefix
+    async for chunk in rest:
+        yield chunk
+
+def stream_response(response: httpx.Response, prefix: bytes = b"") -> StreamingResponse:
+    # Stream the response back, releasing the connection once it is sent
+    return StreamingResponse(
+        prepend(prefix, response.aiter_raw()),
+        status_code=response.status_code,
+        headers=filter_headers(response.headers),
+        background=BackgroundTask(response.aclose),
+    )
+
+def mark_coalesced(role: str):
+    # Tells a trace with no upstream span where its response came from
+    span = tracer.current()
+    if span is not None:
+        span.set_attribute("gateway.coalesced", role)
+
+async def coalesced_request(
+    service_name: str, path: str, request: Request, send: Callable[[], Awaitable[httpx.Response]]
+) -> Response:
+    route = SERVICE_ROUTES[service_name]
+    key = coalesce_key(service_name, path, request)
+    request_directives = parse_cache_control(request.headers.get("cache-control", ""))
+    use_cache = not request_directives.keys() & {"no-cache", "no-store"}
+    if use_cache:
+        cached = response_cache.get(service_name, key)
+        if cached is not None:
+            mark_coalesced("cached")
+            return cached.to_response()
+
+    waiting = single_flight.join(key)
+    if waiting is not None:
+        mark_coalesced("follower")
+        buffered = await asyncio.shield(waiting)
+        if buffered is not None:
+            return buffered.to_response()
+        # The leader could not share its response, so make our own call
+        return stream_response(await send_upstream(service_name, send))
+
+    future = single_flight.lead(key)
+    outcome = None
+    try:
+        response = await send_upstream(service_name, send)
+        try:
+            body, complete = await read_limited(response, COALESCE_MAX_BODY)
+        except httpx.RequestError as e:
+            await response.aclose()
+            raise HTTPException(status_code=502, detail=f"Service '{service_name}' failed mid-response: {str(e)}")
+        if not complete:
+            return stream_response(response, body)
+        await response.aclose()
+        buffered = BufferedResponse(response.status_code, filter_headers(response.headers), body)
+        # Errors and other statuses go to the leader only; followers retry
+        if response.status_code == 200:
+            outcome = buffered
+            if use_cache:
+                response_cache.put(service_name, key, buffered, cache_ttl(response.headers, route.get("cache_ttl", 0)))
+        return buffered.to_response()
+    except HTTPException as e:
+        outcome = e
+        raise
+    finally:
+        single_flight.finish(key, future, outcome)
+
+register_stats("gateway_auth_cache", token_cache.stats)
+register_stats("gateway_single_flight", single_flight.stats)
+register_stats("gateway_response_cache", response_cache.stats)
+register_stats("gateway_compression", compression.stats)
+register_stats("tracing", tracer.stats)
+register_stats("logging", log_pipeline.stats)
+register_stats(
+    "gateway_upstream",
+    lambda: {
+        name: {
+            "breaker": u.breaker.stats(),
+            "retry_budget": u.retry_budget.stats(),
+            "limiter": u.limiter.stats() if u.limiter is not None else {},
+        }
+        for name, u in upstreams.items()
+    },
+    label="service",
+)
+register_stats(
+    "gateway_endpoint",
+    lambda: {e.url: e.stats() for u in upstreams.values() for e in u.endpoints},
+    label="endpoint",
+)
 
 @app.get("/")
 async def read_root():
@@ -50,43 +491,69 @@ async def read_root():
         }
     }
 
+@app.get("/gateway/stats")
+async def gateway_stats():
+    return {
+        "auth_cache": token_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "response_cache": response_cache.stats(),
+        "compression": compression.stats(),
+        "upstreams": {name: upstream.stats() for name, upstream in upstreams.items()},
+    }
+
 @app.api_route("/{service_name}{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
 async def proxy_request(service_name: str, path: str, request: Request):
     # Check if service exists
     if service_name not in SERVICE_ROUTES:
         raise HTTPException(status_code=404, detail=f"Service '{service_name}' not found")
 
-    service_config = SERVICE_ROUTES[service_name]
-    target_url = f"{service_config['target']}{path}"
-    
-    # Get request method
-    method = request.method.lower()
+    upstream = upstreams[service_name]
+    route = SERVICE_ROUTES[service_name]
+    # Normalized, so "//shard" or "/x/../shard" cannot slip past the check
+    normalized = posixpath.normpath("/" + path.lstrip("/"))
+    if any(normalized == prefix or normalized.startswith(prefix + "/") for prefix in route.get("internal", ())):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if path in HEALTH_PATHS:
+        priority = CRITICAL
+    else:
+        priority = route.get("priorities", {}).get(f"{request.method} {path}", NORMAL)
+    deadline = route.get("deadlines", {}).get(f"{request.method} {path}")
     
     # Get request headers
-    headers = dict(request.headers)
+    headers = filter_headers(request.headers)
     headers.pop("host", None)
+
+    # Never trust identity headers supplied by the client
+    for header in IDENTITY_HEADERS:
+        headers.pop(header, None)
+    if route.get("protected"):
+        headers.update(await identity_headers(request))
     
-    # Get request body if it exists
-    body = await request.body()
+    # Stream the request body through instead of buffering it
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+    if request.method not in ("GET", "HEAD"):
+        response_cache.invalidate(service_name)
+    send = partial(
+        upstream.send,
+        request.method,
+        path,
+        # A streamed body cannot be replayed, so only bodiless requests retry
+        replayable=not has_body and request.method in ("GET", "HEAD", "DELETE"),
+        priority=priority,
+        deadline=deadline,
+        params=request.query_params,
+        headers=headers,
+        content=request.stream() if has_body else None,
+    )
     
+    if request.method == "GET" and not has_body and route.get("coalesce") and path not in route.get("streamed", ()):
+        return await coalesced_request(service_name, path, request, send)
+
     # Forward the request to the appropriate service
-    try:
-        response = await http_client.request(
-            method=method,
-            url=target_url,
-            headers=headers,
-            content=body or None
-        )
-        
-        # Return the response from the service
-        return Response(
-            content=response.content,
-            status_code=response.status_code,
-            headers=dict(response.headers)
-        )
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=503, detail=f"Service '{service_name}' unavailable: {str(e)}")
+    response = await send_upstream(service_name, send)
+    return stream_response(response)
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await http_client.aclose()
\ No newline at end of file
+    for upstream in upstreams.values():
+        await upstream.aclose()
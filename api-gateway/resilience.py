@@ -0,0 +1,391 @@
+"""Resilience layer between the API Gateway and its upstream services.
+
+Each service is an ``Upstream`` with one or more endpoints. Each endpoint
+has its own pooled client. A request goes through these parts:
+
+* admission through the service's adaptive concurrency limiter (see
+  admission.py), which sheds requests by priority once the service is
+  at capacity;
+* a per-request deadline shared by all attempts, so a degraded service
+  can never hold a gateway coroutine longer than the route allows;
+* power-of-two-choices load balancing weighted by in-flight requests and
+  an EWMA of response latency;
+* outlier ejection, which takes an endpoint out of rotation after
+  repeated errors or when it is much slower than its peers, never
+  ejecting more than half of them;
+* bounded retries on another endpoint, only for requests without a body,
+  only on connection failures or 502/503/504, and only while the retry
+  budget allows it so retries cannot multiply an outage;
+* a circuit breaker per service that fails fast while the service keeps
+  failing, then lets single probe requests through to detect recovery.
+
+Only 5xx responses count as endpoint and breaker failures, and a 503 with
+Retry-After does not: that is a healthy upstream shedding load on
+purpose, like a 429, and ejecting it or opening the breaker would only
+move its load elsewhere or turn a short backoff into an outage.
+
+Every attempt is a client span of the gateway request, and its context
+replaces any ``traceparent`` the client sent.
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+import httpx
+from prometheus_client import Counter, Histogram
+
+from admission import NORMAL, ConcurrencyLimiter
+from metrics import LATENCY_BUCKETS
+from tracing import CLIENT, tracer
+
+UPSTREAM_ATTEMPT_DURATION = Histogram(
+    "gateway_upstream_attempt_duration_seconds",
+    "Time to response headers for one attempt against an upstream endpoint",
+    ["service", "endpoint", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_RETRIES = Counter(
+    "gateway_upstream_retries_total",
+    "Attempts repeated against another endpoint",
+    ["service"],
+)
+
+RETRYABLE_STATUS = {502, 503, 504}
+
+
+def is_shed(response: httpx.Response) -> bool:
+    """Whether the upstream refused the request on purpose to shed load."""
+    return response.status_code == 429 or (response.status_code == 503 and "retry-after" in response.headers)
+
+
+class CircuitOpen(Exception):
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"Circuit for '{service}' is open")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    def __init__(self, service: str):
+        super().__init__(f"Deadline for '{service}' exceeded")
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release(self):
+        """End a probe that finished with neither success nor failure."""
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "open": self.state != "closed",
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class RetryBudget:
+    """Allows retries up to ``ratio`` of the requests seen in the last
+    ``window`` seconds, plus ``min_per_second`` so quiet services can
+    still retry."""
+
+    def __init__(self, ratio: float, min_per_second: float, window: int = 10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self.exhausted = 0
+        self._requests = deque()
+        self._retries = deque()
+
+    def _trim(self, events: deque, now: float):
+        while events and events[0] <= now - self.window:
+            events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_retry(self) -> bool:
+        now = time.monotonic()
+        self._trim(self._requests, now)
+        self._trim(self._retries, now)
+        allowed = self.min_per_second * self.window + self.ratio * len(self._requests)
+        if len(self._retries) >= allowed:
+            self.exhausted += 1
+            return False
+        self._retries.append(now)
+        return True
+
+    def stats(self) -> dict:
+        return {"retries_in_window": len(self._retries), "exhausted": self.exhausted}
+
+
+class Endpoint:
+    def __init__(self, url: str, client: httpx.AsyncClient):
+        self.url = url
+        self.client = client
+        self.in_flight = 0
+        self.latency: Optional[float] = None  # EWMA, seconds
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    def score(self) -> float:
+        return (self.in_flight + 1) * (self.latency if self.latency is not None else 0.0)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "available": self.available,
+            "in_flight": self.in_flight,
+            "latency_ewma": round(self.latency, 6) if self.latency is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+        }
+
+
+class Upstream:
+    def __init__(
+        self,
+        name: str,
+        urls: List[str],
+        client_factory: Callable[[str], httpx.AsyncClient],
+        deadline: float,
+        max_retries: int,
+        retry_budget: RetryBudget,
+        breaker: CircuitBreaker,
+        outlier_errors: int = 5,
+        outlier_latency_factor: float = 3.0,
+        outlier_min_latency: float = 0.05,
+        ejection_time: float = 30.0,
+        latency_alpha: float = 0.3,
+        limiter: Optional[ConcurrencyLimiter] = None,
+    ):
+        self.name = name
+        self.endpoints = [Endpoint(url, client_factory(url)) for url in urls]
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.breaker = breaker
+        self.outlier_errors = outlier_errors
+        self.outlier_latency_factor = outlier_latency_factor
+        self.outlier_min_latency = outlier_min_latency
+        self.ejection_time = ejection_time
+        self.latency_alpha = latency_alpha
+        self.limiter = limiter
+
+    def pick(self, exclude: List[Endpoint]) -> Endpoint:
+        candidates = [e for e in self.endpoints if e.available and e not in exclude]
+        if not candidates:
+            candidates = [e for e in self.endpoints if e.available] or self.endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if first.score() <= second.score() else second
+
+    def _eject(self, endpoint: Endpoint):
+        ejected = sum(not e.available for e in self.endpoints)
+        if (ejected + 1) * 2 > len(self.endpoints):
+            return
+        endpoint.ejections += 1
+        endpoint.ejected_until = time.monotonic() + self.ejection_time * min(endpoint.ejections, 10)
+        # Start over once it is back in rotation
+        endpoint.latency = None
+        endpoint.consecutive_failures = 0
+
+    def _observe(self, endpoint: Endpoint, sample: float):
+        if endpoint.latency is None:
+            endpoint.latency = sample
+        else:
+            endpoint.latency += self.latency_alpha * (sample - endpoint.latency)
+
+    def _record_success(self, endpoint: Endpoint, elapsed: float):
+        endpoint.consecutive_failures = 0
+        self._observe(endpoint, elapsed)
+        peers = [e.latency for e in self.endpoints if e is not endpoint and e.available and e.latency is not None]
+        if (
+            self.outlier_latency_factor > 0
+            and peers
+            and endpoint.latency > self.outlier_min_latency
+            and endpoint.latency > self.outlier_latency_factor * min(peers)
+        ):
+            self._eject(endpoint)
+
+    def _record_failure(self, endpoint: Endpoint):
+        endpoint.consecutive_failures += 1
+        # Count a failure as a full deadline so an endpoint that fails fast
+        # does not look like the quickest one to the balancer
+        self._observe(endpoint, self.deadline)
+        if endpoint.consecutive_failures >= self.outlier_errors:
+            self._eject(endpoint)
+
+    async def send(self, method: str, url: str, replayable: bool, priority: str = NORMAL,
+                   deadline: Optional[float] = None, **kwargs) -> httpx.Response:
+        """Send a streamed request, retrying on another endpoint when that
+        is safe. The caller must close the returned response. Raises
+        Overloaded when the limiter sheds the request.
+
+        ``deadline`` replaces both the upstream's deadline and its read
+        timeout, for routes that are known to take longer to answer."""
+        if self.limiter is None:
+            return await self._send(method, url, replayable, deadline, **kwargs)
+        await self.limiter.acquire(priority)
+        started = time.monotonic()
+        rtt = None
+        dropped = False
+        try:
+            response = await self._send(method, url, replayable, deadline, **kwargs)
+            dropped = response.status_code in RETRYABLE_STATUS
+            rtt = time.monotonic() - started
+            return response
+        except httpx.RequestError:
+            dropped = True
+            raise
+        finally:
+            # The slot is held until response headers, like an attempt span
+            self.limiter.release(rtt, dropped, priority)
+
+    async def _send(self, method: str, url: str, replayable: bool, deadline: Optional[float] = None,
+                    **kwargs) -> httpx.Response:
+        if not self.breaker.allow():
+            raise CircuitOpen(self.name, self.breaker.retry_after())
+        self.retry_budget.record_request()
+        expires = time.monotonic() + (self.deadline if deadline is None else deadline)
+        tried: List[Endpoint] = []
+        attempts = 1 + (self.max_retries if replayable else 0)
+        outcome_recorded = False
+        try:
+            for attempt in range(attempts):
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(self.name)
+                endpoint = self.pick(tried)
+                tried.append(endpoint)
+                client = endpoint.client
+                timeout = httpx.Timeout(
+                    min(client.timeout.read if deadline is None else deadline, remaining),
+                    connect=min(client.timeout.connect, remaining),
+                )
+                request = client.build_request(method, url, timeout=timeout, **kwargs)
+                span = tracer.start_span(f"{method} {self.name}", CLIENT, attributes={
+                    "peer.service": self.name,
+                    "http.method": method,
+                    "http.url": str(request.url),
+                    "retry.attempt": attempt,
+                })
+                tracer.inject(request.headers, span)
+                endpoint.in_flight += 1
+                started = time.monotonic()
+                try:
+                    response = await asyncio.wait_for(client.send(request, stream=True), timeout=remaining)
+                except (httpx.RequestError, asyncio.TimeoutError) as e:
+                    UPSTREAM_ATTEMPT_DURATION.labels(self.name, endpoint.url, type(e).__name__).observe(
+                        time.monotonic() - started
+                    )
+                    span.set_error(type(e).__name__)
+                    self._record_failure(endpoint)
+                    error = e if isinstance(e, httpx.RequestError) else DeadlineExceeded(self.name)
+                    # A read timeout may mean the request was processed
+                    retry_safe = not isinstance(e, (httpx.ReadTimeout, asyncio.TimeoutError))
+                    if attempt + 1 < attempts and retry_safe and self.retry_budget.try_retry():
+                        UPSTREAM_RETRIES.labels(self.name).inc()
+                        continue
+                    self.breaker.record_failure()
+                    outcome_recorded = True
+                    raise error
+                else:
+                    span.set_attribute("http.status_code", response.status_code)
+                    if response.status_code >= 500:
+                        span.set_error(f"HTTP {response.status_code}")
+                finally:
+                    endpoint.in_flight -= 1
+                    # Ends at response headers, like the attempt histogram
+                    span.end()
+
+                elapsed = time.monotonic() - started
+                UPSTREAM_ATTEMPT_DURATION.labels(self.name, endpoint.url, str(response.status_code)).observe(elapsed)
+                shed = is_shed(response)
+                failed = response.status_code >= 500 and not shed
+                if failed:
+                    self._record_failure(endpoint)
+                elif not shed:
+                    # A fast refusal would make a shedding endpoint look quickest
+                    self._record_success(endpoint, elapsed)
+                if (
+                    response.status_code in RETRYABLE_STATUS
+                    and attempt + 1 < attempts
+                    and self.retry_budget.try_retry()
+                ):
+                    UPSTREAM_RETRIES.labels(self.name).inc()
+                    await response.aclose()
+                    continue
+                if failed:
+                    self.breaker.record_failure()
+                elif not shed:
+                    self.breaker.record_success()
+                # A shed response says nothing either way, so a probe is released
+                outcome_recorded = not shed
+                return response
+        finally:
+            if not outcome_recorded:
+                self.breaker.release()
+
+    async def request(self, method: str, url: str, priority: str = NORMAL, **kwargs) -> httpx.Response:
+        """Like send, but with the body read and the connection released."""
+        response = await self.send(method, url, replayable=False, priority=priority, **kwargs)
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        return response
+
+    async def aclose(self):
+        for endpoint in self.endpoints:
+            await endpoint.client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.stats(),
+            "retry_budget": self.retry_budget.stats(),
+            "limiter": self.limiter.stats() if self.limiter is not None else None,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+        }
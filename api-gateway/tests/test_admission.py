@@ -0,0 +1,189 @@
+import asyncio
+
+import pytest
+
+from admission import CRITICAL, LOW, NORMAL, ConcurrencyLimiter, Overloaded
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def limiter(**kwargs) -> ConcurrencyLimiter:
+    options = {"initial_limit": 1, "min_limit": 1, "max_queue": 10, "queue_timeout": 5.0}
+    options.update(kwargs)
+    return ConcurrencyLimiter("test", **options)
+
+
+async def queue(limiter: ConcurrencyLimiter, priority: str, admitted: list) -> asyncio.Task:
+    async def waiter():
+        await limiter.acquire(priority)
+        admitted.append(priority)
+
+    task = asyncio.create_task(waiter())
+    # Let it reach the queue
+    await asyncio.sleep(0)
+    return task
+
+
+def test_admits_up_to_the_limit():
+    async def scenario():
+        lim = limiter(initial_limit=2)
+        await lim.acquire()
+        await lim.acquire()
+        admitted = []
+        task = await queue(lim, NORMAL, admitted)
+        assert (lim.in_flight, lim.queued) == (2, 1)
+
+        lim.release()
+        await task
+        assert admitted == [NORMAL]
+        assert (lim.in_flight, lim.queued) == (2, 0)
+
+    run(scenario())
+
+
+def test_grants_by_priority_then_fifo():
+    async def scenario():
+        lim = limiter()
+        await lim.acquire()
+        admitted = []
+        tasks = [
+            await queue(lim, LOW, admitted),
+            await queue(lim, NORMAL, admitted),
+            await queue(lim, CRITICAL, admitted),
+            await queue(lim, NORMAL, admitted),
+        ]
+        for _ in tasks:
+            lim.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert admitted == [CRITICAL, NORMAL, NORMAL, LOW]
+
+    run(scenario())
+
+
+def test_does_not_overtake_queued_requests():
+    async def scenario():
+        lim = limiter(initial_limit=2)
+        await lim.acquire()
+        await lim.acquire()
+        admitted = []
+        queued = await queue(lim, NORMAL, admitted)
+        lim.limit = 3
+        # Room again, but a normal request is already waiting
+        late = await queue(lim, LOW, admitted)
+        assert lim.queued == 2
+
+        lim.release()
+        await asyncio.gather(queued, late)
+        assert admitted == [NORMAL, LOW]
+
+    run(scenario())
+
+
+def test_full_queue_displaces_newest_lower_priority():
+    async def scenario():
+        lim = limiter(max_queue=2)
+        await lim.acquire()
+        admitted = []
+        oldest_low = await queue(lim, LOW, admitted)
+        newest_low = await queue(lim, LOW, admitted)
+
+        critical = await queue(lim, CRITICAL, admitted)
+
+        with pytest.raises(Overloaded):
+            await newest_low
+        assert lim.queued == 2
+        assert lim.shed == {CRITICAL: 0, NORMAL: 0, LOW: 1}
+
+        lim.release()
+        await critical
+        lim.release()
+        await oldest_low
+        assert admitted == [CRITICAL, LOW]
+
+    run(scenario())
+
+
+def test_full_queue_rejects_without_lower_priority():
+    async def scenario():
+        lim = limiter(max_queue=2)
+        await lim.acquire()
+        admitted = []
+        waiting = [await queue(lim, NORMAL, admitted), await queue(lim, NORMAL, admitted)]
+
+        with pytest.raises(Overloaded) as excinfo:
+            await lim.acquire(NORMAL)
+        assert excinfo.value.retry_after == lim.retry_after
+        with pytest.raises(Overloaded):
+            await lim.acquire(LOW)
+        assert lim.shed == {CRITICAL: 0, NORMAL: 1, LOW: 1}
+        assert lim.queued == 2
+
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        assert lim.queued == 0
+
+    run(scenario())
+
+
+def test_queue_timeout_sheds():
+    async def scenario():
+        lim = limiter(queue_timeout=0.01)
+        await lim.acquire()
+        with pytest.raises(Overloaded):
+            await lim.acquire(CRITICAL)
+        assert lim.queued == 0
+        assert lim.shed[CRITICAL] == 1
+
+    run(scenario())
+
+
+def test_dropped_response_backs_off():
+    lim = ConcurrencyLimiter("test", initial_limit=20, min_limit=4, backoff=0.5)
+    for expected in (10, 5, 4, 4):
+        lim.in_flight = 1
+        lim.release(dropped=True)
+        assert lim.limit == expected
+
+
+def test_limit_follows_latency():
+    lim = ConcurrencyLimiter("test", initial_limit=20, max_limit=100)
+    for _ in range(50):
+        lim.in_flight = 20
+        lim.release(rtt=0.01)
+    grown = lim.limit
+    assert grown > 20
+    assert lim.long_rtt[NORMAL] == pytest.approx(0.01)
+
+    for _ in range(20):
+        lim.in_flight = int(lim.limit)
+        lim.release(rtt=0.2)
+    assert lim.limit < grown / 2
+    # Latency observed under load does not become the new baseline
+    assert lim.long_rtt[NORMAL] == pytest.approx(0.01)
+
+
+def test_limit_does_not_grow_while_idle():
+    lim = ConcurrencyLimiter("test", initial_limit=20)
+    for _ in range(50):
+        lim.in_flight = 2
+        lim.release(rtt=0.01)
+    assert lim.limit == 20
+
+
+def test_baseline_is_kept_per_priority_class():
+    # Fast critical checks and slow normal requests (auth's /verify and its
+    # bcrypt routes), all served well within their own usual latency
+    lim = ConcurrencyLimiter("test", initial_limit=20, max_limit=100)
+    for _ in range(50):
+        for priority, rtt in ((CRITICAL, 0.001), (NORMAL, 0.25)):
+            lim.in_flight = 20
+            lim.release(rtt=rtt, priority=priority)
+
+    assert lim.limit > 20
+    assert lim.long_rtt[CRITICAL] == pytest.approx(0.001)
+    assert lim.long_rtt[NORMAL] == pytest.approx(0.25)
+    assert lim.stats()["long_rtt"] == {CRITICAL: 0.001, NORMAL: 0.25}
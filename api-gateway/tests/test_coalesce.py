@@ -0,0 +1,154 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.requests import Request
+
+import coalesce
+import main
+from coalesce import BufferedResponse, ResponseCache, SingleFlight, cache_ttl
+
+
+def response(body: bytes = b"{}") -> BufferedResponse:
+    return BufferedResponse(200, {"content-type": "application/json"}, body)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({}, 5.0),
+    ({"cache-control": "max-age=2"}, 2.0),
+    ({"cache-control": "public, s-maxage=1, max-age=3"}, 1.0),
+    ({"cache-control": "max-age=60"}, 5.0),
+    ({"cache-control": "max-age=soon"}, 0.0),
+    ({"cache-control": "no-store"}, 0.0),
+    ({"cache-control": "Private"}, 0.0),
+    ({"set-cookie": "session=1"}, 0.0),
+    ({"vary": "*"}, 0.0),
+])
+def test_cache_ttl(headers, expected):
+    assert cache_ttl(headers, 5.0) == expected
+
+
+def test_cache_ttl_disabled_route():
+    assert cache_ttl({"cache-control": "max-age=60"}, 0) == 0
+
+
+def test_response_cache_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(coalesce.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(maxsize=10)
+    cache.put("users", "a", response(), ttl=1.0)
+
+    assert cache.get("users", "a") is not None
+    now[0] += 1.0
+    assert cache.get("users", "a") is None
+    assert cache.stats() == {"size": 0, "hits": 1, "misses": 1}
+
+
+def test_response_cache_lru_and_invalidation():
+    cache = ResponseCache(maxsize=2)
+    for key in ("a", "b"):
+        cache.put("users", key, response(), ttl=10)
+    cache.get("users", "a")
+    cache.put("users", "c", response(), ttl=10)
+    cache.put("analytics", "a", response(), ttl=10)
+
+    assert cache.get("users", "b") is None
+    assert cache.get("users", "a") is not None
+
+    cache.invalidate("users")
+
+    assert cache.get("users", "a") is None
+    assert cache.get("analytics", "a") is not None
+
+
+def test_response_cache_skips_zero_ttl():
+    cache = ResponseCache(maxsize=10)
+    cache.put("users", "a", response(), ttl=0)
+    assert cache.stats()["size"] == 0
+
+
+def test_single_flight_shares_the_result():
+    async def scenario():
+        flights = SingleFlight()
+        assert flights.join("key") is None
+        leader = flights.lead("key")
+        followers = [flights.join("key") for _ in range(3)]
+        assert all(follower is leader for follower in followers)
+
+        result = response(b"shared")
+        flights.finish("key", leader, result)
+
+        assert [await follower for follower in followers] == [result] * 3
+        assert flights.join("key") is None
+        assert flights.stats() == {"in_flight": 0, "leaders": 1, "followers": 3}
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_propagates_errors():
+    async def scenario():
+        flights = SingleFlight()
+        leader = flights.lead("key")
+        follower = flights.join("key")
+        flights.finish("key", leader, RuntimeError("upstream failed"))
+        with pytest.raises(RuntimeError):
+            await follower
+
+        # Without followers the exception is not reported as unretrieved
+        lonely = flights.lead("other")
+        flights.finish("other", lonely, RuntimeError("upstream failed"))
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_finish_keeps_a_newer_flight():
+    async def scenario():
+        flights = SingleFlight()
+        old = flights.lead("key")
+        new = flights.lead("key")
+        flights.finish("key", old, None)
+        assert await old is None
+        assert flights.join("key") is new
+
+    asyncio.run(scenario())
+
+
+def gateway_request(headers=None):
+    raw = [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "path": "/users/profiles/1", "query_string": b"", "headers": raw})
+
+
+def test_conditional_requests_do_not_share_a_key():
+    plain = main.coalesce_key("users", "/profiles/1", gateway_request())
+    conditional = main.coalesce_key("users", "/profiles/1", gateway_request({"If-None-Match": '"abc"'}))
+    ranged = main.coalesce_key("users", "/profiles/1", gateway_request({"Range": "bytes=0-9"}))
+    assert len({plain, conditional, ranged}) == 3
+    assert main.coalesce_key("users", "/profiles/1", gateway_request({"If-None-Match": '"abc"'})) == conditional
+
+
+@pytest.mark.parametrize("status_code, shared", [(200, True), (304, False), (404, False), (500, False)])
+def test_only_200_responses_are_shared(monkeypatch, status_code, shared):
+    monkeypatch.setattr(main, "single_flight", SingleFlight())
+    monkeypatch.setattr(main, "response_cache", ResponseCache(maxsize=0))
+
+    async def scenario():
+        release = asyncio.Event()
+        calls = []
+
+        async def send():
+            calls.append(status_code)
+            if len(calls) == 1:
+                await release.wait()
+            return httpx.Response(status_code, stream=httpx.ByteStream(b"body"))
+
+        requests = [
+            asyncio.ensure_future(main.coalesced_request("users", "/profiles/1", gateway_request(), send))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        responses = await asyncio.gather(*requests)
+        assert [response.status_code for response in responses] == [status_code] * 3
+        return len(calls)
+
+    assert asyncio.run(scenario()) == (1 if shared else 3)
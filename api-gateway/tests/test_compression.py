@@ -0,0 +1,120 @@
+import gzip
+import zlib
+
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import compression
+from compression import CompressionMiddleware, ResponseCompression, parse_accept_encoding
+
+BODY = b'{"items": [' + b", ".join(b'{"name": "item"}' for _ in range(100)) + b"]}"
+
+
+@pytest.fixture
+def gzip_only(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+    return ResponseCompression(minimum_size=500, gzip_level=6, brotli_quality=4)
+
+
+def make_client(settings):
+    app = FastAPI()
+
+    @app.get("/json")
+    def json_body():
+        return Response(BODY, media_type="application/json", headers={"ETag": '"v1"'})
+
+    @app.get("/small")
+    def small():
+        return Response(b"{}", media_type="application/json")
+
+    @app.get("/image")
+    def image():
+        return Response(BODY, media_type="image/png")
+
+    @app.get("/encoded")
+    def encoded():
+        return Response(BODY, media_type="application/json", headers={"Content-Encoding": "identity"})
+
+    @app.get("/not-modified")
+    def not_modified():
+        return Response(status_code=304, headers={"ETag": '"v1"'})
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse(iter([BODY[:300], BODY[300:]]), media_type="application/x-ndjson")
+
+    app.add_middleware(CompressionMiddleware, compression=settings)
+    return TestClient(app)
+
+
+def raw_get(client, path, accept_encoding="gzip"):
+    # httpx would decode the body, so read it untouched
+    with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip, br;q=0.5, *;q=0") == {"gzip": 1.0, "br": 0.5, "*": 0.0}
+    assert parse_accept_encoding("gzip;q=high") == {"gzip": 0.0}
+
+
+def test_negotiate(gzip_only):
+    assert gzip_only.negotiate("gzip, deflate") == "gzip"
+    assert gzip_only.negotiate("*") == "gzip"
+    assert gzip_only.negotiate("gzip;q=0, *") is None
+    assert gzip_only.negotiate("br") is None
+    assert gzip_only.negotiate("") is None
+
+
+def test_buffered_response_is_gzipped(gzip_only):
+    response, body = raw_get(make_client(gzip_only), "/json")
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-length"] == str(len(body))
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["etag"] == 'W/"v1"'
+    assert gzip.decompress(body) == BODY
+    assert gzip_only.stats()["gzip_responses"] == 1
+    assert gzip_only.stats()["bytes_out"] == len(body) < len(BODY)
+
+
+def test_streamed_response_is_gzipped_chunk_by_chunk(gzip_only):
+    response, body = raw_get(make_client(gzip_only), "/stream")
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert gzip.decompress(body) == BODY
+
+
+@pytest.mark.parametrize("path, accept_encoding", [
+    ("/small", "gzip"),
+    ("/image", "gzip"),
+    ("/encoded", "gzip"),
+    ("/not-modified", "gzip"),
+    ("/json", "identity"),
+])
+def test_left_uncompressed(gzip_only, path, accept_encoding):
+    response, body = raw_get(make_client(gzip_only), path, accept_encoding)
+    assert response.headers.get("content-encoding") in (None, "identity")
+    assert response.headers.get("etag") in (None, '"v1"')
+    assert gzip_only.stats()["gzip_responses"] == 0
+
+
+def test_gzip_flushes_every_chunk():
+    encoder = compression.GzipEncoder(6)
+    decoder = zlib.decompressobj(31)
+    assert decoder.decompress(encoder.compress(b"first") + encoder.flush()) == b"first"
+    assert decoder.decompress(encoder.compress(b"second") + encoder.finish()) == b"second"
+
+
+def test_brotli_is_preferred_when_installed():
+    brotli = pytest.importorskip("brotli")
+    settings = ResponseCompression(minimum_size=500, gzip_level=6, brotli_quality=4)
+    assert settings.negotiate("gzip, br") == "br"
+    assert settings.negotiate("gzip, br;q=0.5") == "gzip"
+
+    response, body = raw_get(make_client(settings), "/json", "br")
+    assert response.headers["content-encoding"] == "br"
+    assert brotli.decompress(body) == BODY
@@ -0,0 +1,114 @@
+import asyncio
+import base64
+import json
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+
+USER = {"id": 7, "email": "ada@example.com"}
+
+
+def make_token(exp=None) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"sub": USER["email"], "exp": exp}).encode()).decode()
+    return f"header.{payload.rstrip('=')}.signature"
+
+
+@pytest.fixture
+def verify(monkeypatch):
+    """Answer auth /verify with the given response and count the calls."""
+    calls = []
+
+    def answer(status_code, body=None, headers=None):
+        async def request(method, url, **kwargs):
+            calls.append(f"{method} {url}")
+            return httpx.Response(status_code, json=body, headers=headers)
+
+        monkeypatch.setattr(main.upstreams["auth"], "request", request)
+        monkeypatch.setattr(main, "token_cache", main.TokenCache(100))
+        return calls
+
+    return answer
+
+
+def authenticate(token="token"):
+    return asyncio.run(main.authenticate(token))
+
+
+def test_valid_token_is_cached(verify):
+    calls = verify(200, {"valid": True, "user": USER})
+    token = make_token(exp=time.time() + 60)
+    assert authenticate(token) == USER
+    assert authenticate(token) == USER
+    assert calls == ["POST /verify"]
+
+
+def test_cache_ends_at_token_exp(verify):
+    calls = verify(200, {"valid": True, "user": USER})
+    token = make_token(exp=time.time() - 1)
+    authenticate(token)
+    authenticate(token)
+    assert calls == ["POST /verify"] * 2
+
+
+@pytest.mark.parametrize("status_code, body", [(200, {"valid": False}), (401, {"detail": "Unauthorized"})])
+def test_rejected_token(verify, status_code, body):
+    verify(status_code, body)
+    with pytest.raises(HTTPException) as excinfo:
+        authenticate()
+    assert excinfo.value.status_code == 401
+    assert excinfo.value.headers == {"WWW-Authenticate": "Bearer"}
+
+
+@pytest.mark.parametrize("status_code, headers, retry_after", [
+    (500, None, "1"),
+    (503, {"Retry-After": "7"}, "7"),
+    (429, None, "1"),
+])
+def test_auth_outage_is_not_a_401(verify, monkeypatch, status_code, headers, retry_after):
+    monkeypatch.setattr(main, "SHED_RETRY_AFTER", 1.0)
+    verify(status_code, {}, headers)
+    with pytest.raises(HTTPException) as excinfo:
+        authenticate()
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.headers == {"Retry-After": retry_after}
+
+
+def test_unexpected_status_is_a_bad_gateway(verify):
+    verify(422, {})
+    with pytest.raises(HTTPException) as excinfo:
+        authenticate()
+    assert excinfo.value.status_code == 502
+
+
+def test_token_expiry():
+    assert main.token_expiry(make_token(exp=1700000000)) == 1700000000.0
+    assert main.token_expiry(make_token()) is None
+    assert main.token_expiry("garbage") is None
+
+
+def test_protected_routes_get_signed_identity(verify, monkeypatch):
+    verify(200, {"valid": True, "user": USER})
+    forwarded = []
+
+    async def send(method, url, replayable, priority, **kwargs):
+        forwarded.append(kwargs["headers"])
+        # A streamed response, like the ones Upstream.send returns
+        return httpx.Response(200, stream=httpx.ByteStream(b"{}"))
+
+    monkeypatch.setattr(main.upstreams["users"], "send", send)
+    client = TestClient(main.app)
+
+    spoofed = {"X-User-Id": "1", "X-User-Email": "mallory@example.com", "X-Identity-Signature": "forged"}
+    client.get("/users/profiles/me", headers={**spoofed, "Authorization": f"Bearer {make_token()}"})
+    client.get("/users/profiles/1", headers=spoofed)
+
+    with_token, without_token = forwarded
+    timestamp = with_token["x-identity-timestamp"]
+    assert (with_token["x-user-id"], with_token["x-user-email"]) == ("7", USER["email"])
+    assert with_token["x-identity-signature"] == main.sign_identity("7", USER["email"], timestamp)
+    assert not any(header in without_token for header in main.IDENTITY_HEADERS)
@@ -0,0 +1,44 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.mark.parametrize("path", [
+    "/analytics/shard/events",
+    "/analytics/shard",
+    "/analytics//shard/rollup",
+    "/analytics/summary/%2E%2E/shard/events",
+])
+def test_shard_endpoints_are_not_routed(monkeypatch, path):
+    forwarded = []
+
+    async def send(method, url, replayable, priority, **kwargs):
+        forwarded.append(url)
+        return httpx.Response(200, stream=httpx.ByteStream(b"[]"))
+
+    monkeypatch.setattr(main.upstreams["analytics"], "send", send)
+    client = TestClient(main.app)
+
+    assert client.get(path).status_code == 404
+    assert forwarded == []
+    # Other analytics paths still go through, including look-alikes
+    assert client.get("/analytics/shardless").status_code == 200
+    assert forwarded == ["/shardless"]
+
+
+def test_batch_registration_gets_its_own_deadline(monkeypatch):
+    deadlines = {}
+
+    async def send(method, url, replayable, priority, deadline=None, **kwargs):
+        deadlines[f"{method} {url}"] = deadline
+        return httpx.Response(200, stream=httpx.ByteStream(b"{}"))
+
+    monkeypatch.setattr(main.upstreams["auth"], "send", send)
+    client = TestClient(main.app)
+
+    client.post("/auth/register/batch", json=[])
+    client.post("/auth/register", json={})
+
+    assert deadlines == {"POST /register/batch": main.REGISTER_BATCH_DEADLINE, "POST /register": None}
@@ -0,0 +1,224 @@
+import asyncio
+
+import httpx
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, RetryBudget, Upstream
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    return clock
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=10)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+    clock.now += 4
+    assert breaker.retry_after() == pytest.approx(6)
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_admits_a_single_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10)
+    open_breaker(breaker)
+
+    clock.now += 9.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # Everyone else waits for the probe
+    assert not breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10)
+    open_breaker(breaker)
+    clock.now += 10
+    assert breaker.allow()
+
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+    assert all(breaker.allow() for _ in range(5))
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=5, recovery_timeout=10)
+    open_breaker(breaker)
+    clock.now += 10
+    assert breaker.allow()
+
+    # One failure is enough while half open
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.opened_at == clock.now
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+
+
+def test_released_probe_lets_the_next_one_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10)
+    open_breaker(breaker)
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.release()
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_breaker_stats(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10)
+    assert breaker.stats() == {"state": "closed", "open": False, "failures": 0, "rejected": 0}
+    open_breaker(breaker)
+    breaker.allow()
+    assert breaker.stats() == {"state": "open", "open": True, "failures": 1, "rejected": 1}
+
+
+def test_retry_budget_floor(clock):
+    budget = RetryBudget(ratio=0.1, min_per_second=0.5, window=10)
+    assert sum(budget.try_retry() for _ in range(10)) == 5
+    assert budget.exhausted == 5
+
+
+def test_retry_budget_scales_with_requests(clock):
+    budget = RetryBudget(ratio=0.2, min_per_second=0, window=10)
+    for _ in range(50):
+        budget.record_request()
+    assert sum(budget.try_retry() for _ in range(20)) == 10
+
+    # Requests and retries leave the window together
+    clock.now += 10
+    assert not budget.try_retry()
+    for _ in range(5):
+        budget.record_request()
+    assert budget.try_retry()
+
+
+def upstream_answering(status_code, headers=None):
+    def handler(request):
+        return httpx.Response(status_code, headers=headers)
+
+    return Upstream(
+        "auth",
+        ["http://auth"],
+        lambda url: httpx.AsyncClient(base_url=url, transport=httpx.MockTransport(handler)),
+        deadline=1.0,
+        max_retries=0,
+        retry_budget=RetryBudget(ratio=0.1, min_per_second=1),
+        breaker=CircuitBreaker(failure_threshold=2, recovery_timeout=10),
+        outlier_errors=2,
+    )
+
+
+def send_all(upstream, count):
+    async def scenario():
+        for _ in range(count):
+            response = await upstream.send("POST", "/token", replayable=False)
+            await response.aclose()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("status_code, headers", [(503, {"Retry-After": "1"}), (429, None)])
+def test_shed_responses_are_not_failures(status_code, headers):
+    upstream = upstream_answering(status_code, headers)
+    send_all(upstream, 5)
+
+    endpoint, = upstream.endpoints
+    assert upstream.breaker.state == "closed"
+    assert endpoint.consecutive_failures == 0
+    assert endpoint.ejections == 0
+    # Nor do they count as fast successes for the balancer
+    assert endpoint.latency is None
+
+
+@pytest.mark.parametrize("status_code", [500, 503])
+def test_server_errors_open_the_breaker(status_code):
+    upstream = upstream_answering(status_code)
+    send_all(upstream, 2)
+    assert upstream.breaker.state == "open"
+
+
+def test_shed_probe_is_released(clock):
+    upstream = upstream_answering(503, {"Retry-After": "1"})
+    open_breaker(upstream.breaker)
+    clock.now += 10
+
+    send_all(upstream, 1)
+
+    assert upstream.breaker.state == "half_open"
+    assert upstream.breaker.allow()
+
+
+def test_route_deadline_replaces_deadline_and_read_timeout():
+    timeouts = []
+
+    async def handler(request):
+        timeouts.append(request.extensions["timeout"]["read"])
+        await asyncio.sleep(0.2)
+        return httpx.Response(200)
+
+    upstream = Upstream(
+        "auth",
+        ["http://auth"],
+        lambda url: httpx.AsyncClient(base_url=url, timeout=0.1, transport=httpx.MockTransport(handler)),
+        deadline=0.1,
+        max_retries=0,
+        retry_budget=RetryBudget(ratio=0.1, min_per_second=1),
+        breaker=CircuitBreaker(failure_threshold=5, recovery_timeout=10),
+    )
+
+    async def scenario():
+        with pytest.raises(resilience.DeadlineExceeded):
+            await upstream.send("POST", "/register", replayable=False)
+        response = await upstream.send("POST", "/register/batch", replayable=False, deadline=5.0)
+        await response.aclose()
+        return response.status_code
+
+    assert asyncio.run(scenario()) == 200
+    assert timeouts[0] <= 0.1
+    assert 0.1 < timeouts[1] <= 5.0
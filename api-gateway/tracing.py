@@ -0,0 +1,428 @@
+"""Distributed tracing with W3C Trace Context propagation.
+
+``trace_app(app, service_name)`` adds an ASGI middleware that continues
+the trace named by an incoming ``traceparent`` header, or starts a new
+one, and records a server span for each request. Work done while handling
+it (SQL statements, password hashing, calls to other services) is
+recorded as child spans through ``tracer.span`` and ``tracer.start_span``,
+and outgoing calls carry the context on with ``tracer.inject``.
+
+Spans are batched on a background thread and exported as OTLP/JSON:
+
+* ``TRACE_EXPORTER=otlp`` posts them to an OTLP/HTTP collector at
+  ``TRACE_OTLP_ENDPOINT``
+* ``TRACE_EXPORTER=file`` appends one export request per line to
+  ``TRACE_FILE``, the format read by the collector's ``otlpjsonfile``
+  receiver
+* ``TRACE_EXPORTER=none`` (default) records nothing, but trace context is
+  still propagated so downstream services can record their part
+
+New traces are sampled at ``TRACE_SAMPLE_RATIO``; continued traces follow
+the caller's sampled flag.
+
+The Auth Service's password hashing workers import this module, so it
+must stay free of FastAPI imports and start no threads on import. Each
+service carries a copy of it since they are built from separate Docker
+contexts.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/traces/{service}.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "4096"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "2"))  # seconds
+TRACE_EXPORT_TIMEOUT = float(os.getenv("TRACE_EXPORT_TIMEOUT", "5"))  # seconds
+
+INTERNAL = "internal"
+SERVER = "server"
+CLIENT = "client"
+# OTLP SpanKind values
+SPAN_KINDS = {INTERNAL: 1, SERVER: 2, CLIENT: 3}
+
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+INVALID_TRACE_ID = "0" * 32
+INVALID_SPAN_ID = "0" * 16
+
+
+class SpanContext:
+    __slots__ = ("trace_id", "span_id", "sampled", "state")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool, state: Optional[str] = None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+        self.state = state
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: Optional[str], state: Optional[str] = None) -> Optional[SpanContext]:
+    """Parse a ``traceparent`` header; None if it is missing or invalid,
+    in which case the receiver starts a new trace."""
+    match = TRACEPARENT.match(value.strip()) if value else None
+    if match is None:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    # Version 00 has exactly four fields; later versions may append more
+    if version == "ff" or (version == "00" and rest):
+        return None
+    if trace_id == INVALID_TRACE_ID or span_id == INVALID_SPAN_ID:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1), state)
+
+
+def new_id(bits: int) -> str:
+    value = 0
+    while not value:
+        value = random.getrandbits(bits)
+    return format(value, f"0{bits // 4}x")
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes: dict) -> List[dict]:
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    __slots__ = (
+        "tracer", "name", "kind", "context", "parent_id", "attributes",
+        "start_ns", "end_ns", "error", "_started",
+    )
+
+    def __init__(self, tracer: "Tracer", name: str, kind: str, context: SpanContext,
+                 parent_id: Optional[str], attributes: Optional[dict]):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+        # Durations come from the monotonic clock, only the start is wall time
+        self._started = time.perf_counter_ns()
+
+    @property
+    def recording(self) -> bool:
+        return self.context.sampled and self.tracer.exporter is not None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.error = message
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = self.start_ns + time.perf_counter_ns() - self._started
+        if self.recording:
+            self.tracer.exporter.submit(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": otlp_attributes(self.attributes),
+            # STATUS_CODE_UNSET / STATUS_CODE_ERROR
+            "status": {"code": 2, "message": self.error} if self.error is not None else {"code": 0},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.context.state:
+            span["traceState"] = self.context.state
+        return span
+
+
+class FileSink:
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, payload: bytes):
+        with open(self.path, "ab") as f:
+            f.write(payload + b"\n")
+
+
+class OTLPSink:
+    def __init__(self, endpoint: str, timeout: float):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def write(self, payload: bytes):
+        request = urllib.request.Request(
+            self.endpoint, data=payload, headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class BatchExporter:
+    """Queues finished spans and writes them in batches from a daemon
+    thread, so request handling never waits on the sink. Spans are dropped
+    rather than queued without bound when the sink falls behind."""
+
+    def __init__(self, service_name: str, sink, queue_size: int, batch_size: int, interval: float):
+        self.service_name = service_name
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, span: Span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    stop = True
+                    break
+                batch.append(span)
+            if batch:
+                self._export(batch)
+            if stop:
+                return
+
+    def encode(self, spans: List[Span]) -> bytes:
+        return json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [span.to_otlp() for span in spans]}],
+            }]
+        }, separators=(",", ":")).encode()
+
+    def _export(self, spans: List[Span]):
+        try:
+            self.sink.write(self.encode(spans))
+            self.exported += len(spans)
+        except Exception as e:
+            self.failed += len(spans)
+            logger.warning("Exporting %d span(s) failed: %s", len(spans), e)
+
+    def shutdown(self, timeout: float = 5.0):
+        if self._thread is None:
+            return
+        # Everything queued before the sentinel is still exported
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+def create_exporter(name: str, service_name: str) -> Optional[BatchExporter]:
+    if name == "none":
+        return None
+    if name == "file":
+        sink = FileSink(TRACE_FILE.format(service=service_name))
+    elif name == "otlp":
+        sink = OTLPSink(TRACE_OTLP_ENDPOINT, TRACE_EXPORT_TIMEOUT)
+    else:
+        raise ValueError(f"Unknown trace exporter: {name}")
+    return BatchExporter(service_name, sink, TRACE_QUEUE_SIZE, TRACE_BATCH_SIZE, TRACE_EXPORT_INTERVAL)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    def __init__(self, sample_ratio: float):
+        self.service_name = "unknown"
+        self.sample_ratio = sample_ratio
+        self.exporter: Optional[BatchExporter] = None
+
+    def configure(self, service_name: str, exporter: Optional[BatchExporter]):
+        self.service_name = service_name
+        self.exporter = exporter
+
+    def current(self) -> Optional[Span]:
+        return _current_span.get()
+
+    def start_span(self, name: str, kind: str = INTERNAL, parent: Optional[SpanContext] = None,
+                   attributes: Optional[dict] = None, root: bool = False) -> Span:
+        """Start a span under ``parent``, or under the current span. Without
+        either, a new trace is only started for ``root`` spans; otherwise
+        the span is a no-op, so work outside any request is not traced."""
+        if parent is None:
+            current = _current_span.get()
+            parent = current.context if current is not None else None
+        if parent is not None:
+            context = SpanContext(parent.trace_id, new_id(64), parent.sampled, parent.state)
+            parent_id = parent.span_id
+        elif root:
+            context = SpanContext(new_id(128), new_id(64), random.random() < self.sample_ratio)
+            parent_id = None
+        else:
+            context = SpanContext(INVALID_TRACE_ID, INVALID_SPAN_ID, False)
+            parent_id = None
+        return Span(self, name, kind, context, parent_id, attributes)
+
+    @contextmanager
+    def activate(self, span: Span):
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, kind: str = INTERNAL, attributes: Optional[dict] = None):
+        """Record a child span of the current one around a block."""
+        span = self.start_span(name, kind, attributes=attributes)
+        try:
+            with self.activate(span):
+                yield span
+        except BaseException as e:
+            if span.error is None:
+                span.set_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end()
+
+    def inject(self, headers, span: Optional[Span] = None):
+        """Set ``traceparent`` (and ``tracestate``) on outgoing headers for
+        ``span``, or for the current span."""
+        span = span if span is not None else _current_span.get()
+        if span is not None and span.context.trace_id != INVALID_TRACE_ID:
+            headers["traceparent"] = span.context.traceparent
+            if span.context.state:
+                headers["tracestate"] = span.context.state
+        return headers
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+    def stats(self) -> dict:
+        return {
+            "exporter": TRACE_EXPORTER,
+            "sample_ratio": self.sample_ratio,
+            **(self.exporter.stats() if self.exporter is not None else {}),
+        }
+
+
+tracer = Tracer(TRACE_SAMPLE_RATIO)
+
+
+def default_route(scope) -> str:
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+class TracingMiddleware:
+    def __init__(self, app, route_label: Callable[[dict], str] = default_route):
+        self.app = app
+        self.route_label = route_label
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers: Dict[bytes, bytes] = dict(scope["headers"])
+        state = headers.get(b"tracestate")
+        parent = parse_traceparent(
+            headers.get(b"traceparent", b"").decode("latin-1"),
+            state.decode("latin-1") if state else None,
+        )
+        method = scope["method"]
+        span = tracer.start_span(method, SERVER, parent, {
+            "http.method": method,
+            "http.target": scope["path"],
+        }, root=True)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            with tracer.activate(span):
+                await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            span.set_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            route = self.route_label(scope)
+            # The route is only known once the router has matched it
+            span.name = f"{method} {route}"
+            span.set_attribute("http.route", route)
+            span.set_attribute("http.status_code", status)
+            if status >= 500 and span.error is None:
+                span.set_error(f"HTTP {status}")
+            span.end()
+
+
+def trace_app(app, service_name: str, route_label: Callable[[dict], str] = default_route):
+    tracer.configure(service_name, create_exporter(TRACE_EXPORTER, service_name))
+    app.add_middleware(TracingMiddleware, route_label=route_label)
+    app.add_event_handler("shutdown", tracer.shutdown)
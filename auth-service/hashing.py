@@ -0,0 +1,127 @@
+"""Password hashing for the Auth Service.
+
+bcrypt is CPU-bound, so hashing and verification run in a dedicated
+process pool instead of the request threadpool. The pool admits a bounded
+number of pending jobs; callers get ``PoolSaturated`` once it is full so
+the endpoint can shed load instead of queueing indefinitely.
+
+Bulk registration hashes passwords in chunks, one job per chunk, with at
+most one chunk per worker in flight. That keeps every core busy while
+leaving the rest of the pending budget to interactive logins.
+
+This module is imported by the pool workers, so it must stay free of
+database or FastAPI setup.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from passlib.context import CryptContext
+from prometheus_client import Histogram
+
+from tracing import tracer
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds",
+    "Time to hash or verify a password, including time queued for a worker",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    return [pwd_context.hash(password) for password in passwords]
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    return pwd_context.needs_update(hashed_password)
+
+
+class PoolSaturated(Exception):
+    """Raised when the hashing pool already has ``max_pending`` jobs."""
+
+
+class PasswordHasherPool:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn keeps workers from inheriting the parent's DB connections
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def _submit(self, operation: str, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PoolSaturated()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # workers=0 falls back to the default thread executor
+            executor = self._get_executor() if self.workers > 0 else None
+            with tracer.span(f"password {operation}", attributes={"pool.pending": self.pending}), \
+                    PASSWORD_HASH_DURATION.labels(operation).time():
+                return await loop.run_in_executor(executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash", hash_password, password)
+
+    async def hash_many(self, passwords: List[str], chunk_size: int = 16) -> List[str]:
+        """Hash passwords in order, spread over every worker."""
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+        hashed: List[Optional[List[str]]] = [None] * len(chunks)
+        queue = iter(range(len(chunks)))
+
+        async def run():
+            for i in queue:
+                hashed[i] = await self._submit("hash_batch", hash_passwords, chunks[i])
+
+        runners = [asyncio.ensure_future(run()) for _ in range(min(max(self.workers, 1), len(chunks)))]
+        try:
+            await asyncio.gather(*runners)
+        except BaseException:
+            # Stop handing out chunks once one of them failed
+            for runner in runners:
+                runner.cancel()
+            raise
+        return [password_hash for chunk in hashed for password_hash in chunk]
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit("verify", verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
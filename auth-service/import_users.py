@@ -0,0 +1,130 @@
+"""Offline bulk import of users into the Auth Service database.
+
+    python import_users.py users.csv
+    python import_users.py users.ndjson --batch-size 2000 --report report.ndjson
+
+Users are read from a CSV file with ``email`` and ``password`` columns, or
+from NDJSON (one ``{"email": ..., "password": ...}`` object per line), and
+written straight to the database configured by DATABASE_URL through the
+same code as ``POST /register/batch``: one IN query per batch for taken
+emails, passwords hashed on every core (HASH_WORKERS), and bulk inserts of
+REGISTER_INSERT_CHUNK users per transaction. Nothing goes through the
+gateway, so there is no request deadline however large the import.
+
+Every row that was not created (already registered, repeated, or invalid)
+is written to the report as one JSON object per line, with its line number
+in the input. Registered emails are skipped as conflicts, so an interrupted
+import can simply be run again.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import sys
+import time
+from itertools import islice
+from typing import Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+logger = logging.getLogger("import_users")
+
+
+def read_rows(path: str) -> Iterator[Tuple[int, dict]]:
+    """Yield (line number, row) from a CSV or NDJSON file."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        row = None
+                    yield line_num, row if isinstance(row, dict) else {}
+
+
+def batched(rows: Iterator[Tuple[int, dict]], size: int) -> Iterator[List[Tuple[int, dict]]]:
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+async def wait_for_database(database, timeout: float) -> bool:
+    database.start()
+    deadline = time.monotonic() + timeout
+    while not database.ready:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.2)
+    return True
+
+
+async def run(args) -> int:
+    # Imported here so the spawned hashing workers, which re-import this
+    # script, do not build the whole app
+    import main as auth
+
+    if not await wait_for_database(auth.database, args.connect_timeout):
+        logger.error("Database not ready after %.0fs: %s", args.connect_timeout, auth.database.last_error)
+        return 1
+
+    report = open(args.report, "w", encoding="utf-8") if args.report else sys.stderr
+    totals = {"created": 0, "conflict": 0, "invalid": 0}
+    started = time.monotonic()
+    try:
+        for batch in batched(read_rows(args.path), args.batch_size):
+            users, lines = [], []
+            for line_num, row in batch:
+                try:
+                    users.append(auth.UserCreate.model_validate(row))
+                    lines.append(line_num)
+                except ValidationError as e:
+                    totals["invalid"] += 1
+                    report.write(json.dumps({
+                        "line": line_num, "email": row.get("email"), "status": "invalid",
+                        "detail": "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()),
+                    }) + "\n")
+            if users:
+                results = await auth.create_users(users)
+                for line_num, result in zip(lines, results):
+                    totals[result["status"]] += 1
+                    if result["status"] != "created":
+                        report.write(json.dumps({"line": line_num, **result}) + "\n")
+            elapsed = time.monotonic() - started
+            logger.info(
+                "Imported %d users (%d conflicts, %d invalid) in %.0fs",
+                totals["created"], totals["conflict"], totals["invalid"], elapsed,
+                extra={
+                    "imported": totals["created"],
+                    "conflicts": totals["conflict"],
+                    "invalid": totals["invalid"],
+                    "users_per_second": round(totals["created"] / elapsed, 1) if elapsed else None,
+                },
+            )
+    finally:
+        if report is not sys.stderr:
+            report.close()
+        auth.password_pool.shutdown()
+        await auth.database.close()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import users into the Auth Service database")
+    parser.add_argument("path", help="CSV (email,password columns) or NDJSON file of users")
+    parser.add_argument("--batch-size", type=int, default=1000, help="users per existence check and hashing round")
+    parser.add_argument("--report", help="write rows that were not created here instead of stderr")
+    parser.add_argument("--connect-timeout", type=float, default=60.0, help="seconds to wait for the database")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
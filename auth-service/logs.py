@@ -0,0 +1,265 @@
+"""Structured, non-blocking logging shared by the services.
+
+``configure_logging(app, service_name)`` replaces the default stdout
+handler with the pipeline below:
+
+* calls stay lazy (``logger.info("... %s", value)``): nothing is formatted
+  on the event loop, and records that are filtered out are never formatted
+  at all;
+* a filter on the root logger applies per-route levels and sampling, and
+  stamps each record with its route and the current trace and span ids;
+* kept records go onto a bounded queue and are dropped when it is full,
+  so a slow stdout can never stall a request;
+* a listener thread formats them as one JSON object per line (or plain
+  text with ``LOG_FORMAT=text``), redacting bearer tokens, JWTs and
+  credential fields first.
+
+``LOG_LOGGER_LEVELS`` sets levels per logger name (``httpx=WARNING``).
+``LOG_ROUTE_LEVELS`` and ``LOG_SAMPLE_RATES`` take comma-separated
+``"<METHOD> <route template>=<value>"`` pairs, for example
+``LOG_SAMPLE_RATES="POST /track=0.01,GET /profiles/me=0.1"``. Sampling
+only applies below WARNING and is decided once per request from its trace
+id, so every service keeps or drops the same requests, each with all of
+its lines.
+
+Each service carries a copy of this module since they are built from
+separate Docker contexts.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from tracing import INVALID_TRACE_ID, tracer
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+
+def parse_route_settings(value: str, convert) -> Dict[str, object]:
+    settings = {}
+    for item in value.split(","):
+        route, sep, setting = item.rpartition("=")
+        if sep and route.strip():
+            settings[route.strip()] = convert(setting.strip())
+    return settings
+
+
+LOG_ROUTE_LEVELS = parse_route_settings(
+    os.getenv("LOG_ROUTE_LEVELS", ""), lambda level: logging.getLevelName(level.upper())
+)
+LOG_SAMPLE_RATES = parse_route_settings(os.getenv("LOG_SAMPLE_RATES", ""), float)
+# Per-logger levels; client libraries log every request (httpx at INFO)
+LOG_LOGGER_LEVELS = parse_route_settings(
+    os.getenv("LOG_LOGGER_LEVELS", "httpx=WARNING,httpcore=WARNING,aiosqlite=WARNING,urllib3=WARNING"),
+    str.upper,
+)
+
+# Attributes every LogRecord has; anything else was passed with extra=
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {
+    "message", "asctime", "route", "trace_id", "span_id",
+    # Set by uvicorn for its console output
+    "color_message",
+}
+REDACTED = "[REDACTED]"
+SECRET_FIELDS = {"authorization", "token", "access_token", "password", "secret", "cookie"}
+SECRET_PATTERNS = [
+    (re.compile(r"(?i)\b(bearer)\s+[A-Za-z0-9._~+/=-]+"), r"\1 " + REDACTED),
+    (re.compile(r"\beyJ[A-Za-z0-9_-]*\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*"), REDACTED),
+]
+
+
+def redact(text: str) -> str:
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_value(key: str, value):
+    if key.lower() in SECRET_FIELDS:
+        return REDACTED
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, dict):
+        return {k: redact_value(str(k), v) for k, v in value.items()}
+    return value
+
+
+class RequestLog:
+    """Per-request logging state, shared by every record the request emits."""
+    __slots__ = ("scope", "sampled")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.sampled: Optional[bool] = None
+
+    @property
+    def route(self) -> str:
+        # Read late: the router fills in scope["route"] after the middleware ran
+        route = self.scope.get("route")
+        return f"{self.scope['method']} {route.path if route is not None else self.scope['path']}"
+
+
+_request_log: contextvars.ContextVar[Optional[RequestLog]] = contextvars.ContextVar("request_log", default=None)
+
+
+class LogContextMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request_log.set(RequestLog(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_log.reset(token)
+
+
+class RequestFilter(logging.Filter):
+    """Applies route levels and sampling and captures the request context,
+    all in the calling thread since contextvars do not cross the queue."""
+
+    def __init__(self):
+        super().__init__()
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request = _request_log.get()
+        span = tracer.current()
+        context = span.context if span is not None and span.context.trace_id != INVALID_TRACE_ID else None
+        record.trace_id = context.trace_id if context is not None else None
+        record.span_id = context.span_id if context is not None else None
+        record.route = None
+        if request is None:
+            return True
+        record.route = route = request.route
+        level = LOG_ROUTE_LEVELS.get(route)
+        if level is not None and record.levelno < level:
+            return False
+        if record.levelno >= logging.WARNING:
+            return True
+        if request.sampled is None:
+            rate = LOG_SAMPLE_RATES.get(route, LOG_SAMPLE_RATE)
+            if rate >= 1:
+                request.sampled = True
+            elif record.trace_id is not None:
+                request.sampled = int(record.trace_id[-8:], 16) < rate * 0x100000000
+            else:
+                request.sampled = random.random() < rate
+        if not request.sampled:
+            self.sampled_out += 1
+        return request.sampled
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike the base class, leave formatting to the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, service_name: str):
+        super().__init__(f"%(asctime)s %(levelname)s {service_name} %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service_name: str):
+        super().__init__()
+        self.service_name = service_name
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "service": self.service_name,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        for key in ("route", "trace_id", "span_id"):
+            if getattr(record, key, None) is not None:
+                entry[key] = getattr(record, key)
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = redact_value(key, value)
+        if record.exc_info:
+            entry["exception"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class LogPipeline:
+    def __init__(self):
+        self.filter = RequestFilter()
+        self.handler: Optional[DroppingQueueHandler] = None
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def configure(self, service_name: str):
+        if self.listener is not None:
+            return
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter((TextFormatter if LOG_FORMAT == "text" else JsonFormatter)(service_name))
+        self.handler = DroppingQueueHandler(log_queue)
+        self.handler.addFilter(self.filter)
+        self.listener = logging.handlers.QueueListener(log_queue, output)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in LOG_LOGGER_LEVELS.items():
+            logging.getLogger(name).setLevel(level)
+        # Send uvicorn's own loggers through the same pipeline
+        for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+            uvicorn_logger = logging.getLogger(name)
+            uvicorn_logger.handlers = []
+            uvicorn_logger.propagate = True
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None:
+            # Writes out whatever is still queued
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.handler.queue.qsize() if self.handler is not None else 0,
+            "dropped": self.handler.dropped if self.handler is not None else 0,
+            "sampled_out": self.filter.sampled_out,
+        }
+
+
+pipeline = LogPipeline()
+
+
+def configure_logging(app, service_name: str):
+    pipeline.configure(service_name)
+    app.add_middleware(LogContextMiddleware)
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# Configuration is read at import time, so it is set before main is imported
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='auth-service-')}/auth.db")
+# Cheap hashes, computed in threads instead of spawned worker processes
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("HASH_WORKERS", "0")
+
+# The service modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        deadline = time.monotonic() + 10
+        while client.get("/ready").status_code != 200:
+            assert time.monotonic() < deadline, "database did not become ready"
+            time.sleep(0.05)
+        yield client
+
+
+@pytest.fixture
+def run_db(client):
+    """Run ``operation(db)`` in a session on the app's event loop."""
+    import main
+
+    def run(operation):
+        async def scoped():
+            async with main.database.scope() as db:
+                return await operation(db)
+
+        return client.portal.call(scoped)
+
+    return run
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import uuid
+
+import pytest
+
+import main
+from hashing import PasswordHasherPool, PoolSaturated, hash_password, needs_rehash, verify_password
+
+
+def test_hash_and_verify():
+    async def scenario():
+        pool = PasswordHasherPool(workers=0, max_pending=4)
+        hashed = await pool.hash("secret")
+        assert await pool.verify("secret", hashed)
+        assert not await pool.verify("wrong", hashed)
+        assert pool.pending == 0
+
+    asyncio.run(scenario())
+
+
+def test_pool_rejects_past_max_pending():
+    async def scenario():
+        pool = PasswordHasherPool(workers=0, max_pending=2)
+        release = threading.Event()
+        blocked = [asyncio.ensure_future(pool._submit("hash", release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert pool.pending == 2
+
+        with pytest.raises(PoolSaturated):
+            await pool.hash("secret")
+        assert pool.stats()["rejected"] == 1
+
+        release.set()
+        await asyncio.gather(*blocked)
+        assert pool.pending == 0
+        assert verify_password("secret", await pool.hash("secret"))
+
+    asyncio.run(scenario())
+
+
+def test_pending_is_released_when_a_job_fails():
+    def fail():
+        raise RuntimeError("worker died")
+
+    async def scenario():
+        pool = PasswordHasherPool(workers=0, max_pending=1)
+        with pytest.raises(RuntimeError):
+            await pool._submit("hash", fail)
+        assert pool.pending == 0
+
+    asyncio.run(scenario())
+
+
+def register(client, password="secret"):
+    email = f"{uuid.uuid4().hex}@example.com"
+    assert client.post("/register", json={"email": email, "password": password}).status_code == 201
+    return email
+
+
+def test_saturated_pool_answers_503(client, monkeypatch):
+    async def saturated(*args):
+        raise PoolSaturated()
+
+    email = register(client)
+    monkeypatch.setattr(main.password_pool, "_submit", saturated)
+
+    response = client.post("/register", json={"email": f"new-{email}", "password": "secret"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == main.HASH_RETRY_AFTER
+    response = client.post("/token", data={"username": email, "password": "secret"})
+    assert response.status_code == 503
+
+
+def test_login_succeeds_when_the_rehash_is_shed(client, run_db, monkeypatch):
+    email = register(client)
+    old_hash = hash_password("secret")
+
+    async def set_hash(db):
+        await main.update_password_hash(db, await main.get_user(db, email), old_hash)
+
+    async def stored_hash(db):
+        return (await main.get_user(db, email)).hashed_password
+
+    async def saturated(password):
+        raise PoolSaturated()
+
+    run_db(set_hash)
+    monkeypatch.setattr(main, "needs_rehash", lambda hashed: True)
+    monkeypatch.setattr(main.password_pool, "hash", saturated)
+
+    response = client.post("/token", data={"username": email, "password": "secret"})
+    assert response.status_code == 200
+    assert response.json()["access_token"]
+    assert run_db(stored_hash) == old_hash
+
+
+def test_outdated_hashes_are_upgraded_on_login(client, monkeypatch):
+    email = register(client)
+    rehashed = []
+    original = main.update_password_hash
+
+    async def update_password_hash(db, user, hashed_password):
+        rehashed.append(hashed_password)
+        await original(db, user, hashed_password)
+
+    monkeypatch.setattr(main, "needs_rehash", lambda hashed: hashed not in rehashed)
+    monkeypatch.setattr(main, "update_password_hash", update_password_hash)
+
+    assert client.post("/token", data={"username": email, "password": "secret"}).status_code == 200
+    assert len(rehashed) == 1
+    assert verify_password("secret", rehashed[0])
+    assert not needs_rehash(rehashed[0])
@@ -0,0 +1,92 @@
+import asyncio
+import uuid
+
+import main
+from hashing import PasswordHasherPool, verify_password
+
+
+def new_email():
+    return f"{uuid.uuid4().hex}@example.com"
+
+
+def register_batch(client, users):
+    response = client.post("/register/batch", json=users)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_hash_many_keeps_order():
+    passwords = [f"secret-{i}" for i in range(5)]
+
+    async def scenario():
+        pool = PasswordHasherPool(workers=0, max_pending=4)
+        hashed = await pool.hash_many(passwords, chunk_size=2)
+        assert pool.pending == 0
+        return hashed
+
+    hashed = asyncio.run(scenario())
+    assert len(hashed) == len(passwords)
+    assert all(verify_password(password, h) for password, h in zip(passwords, hashed))
+    assert asyncio.run(PasswordHasherPool(workers=0, max_pending=4).hash_many([])) == []
+
+
+def test_batch_reports_conflicts_per_user(client):
+    taken = new_email()
+    assert client.post("/register", json={"email": taken, "password": "secret"}).status_code == 201
+    fresh = new_email()
+
+    body = register_batch(client, [
+        {"email": fresh, "password": "secret"},
+        {"email": taken, "password": "secret"},
+        {"email": fresh.upper(), "password": "secret"},
+    ])
+
+    assert (body["created"], body["conflicts"]) == (1, 2)
+    created, existing, repeated = body["results"]
+    assert created["status"] == "created" and created["id"]
+    assert (existing["status"], existing["detail"], existing["id"]) == ("conflict", "Email already registered", None)
+    # Compared case-insensitively within the batch
+    assert repeated["detail"] == "Duplicate email in batch"
+    token = client.post("/token", data={"username": fresh, "password": "secret"})
+    assert token.status_code == 200
+
+
+def test_batch_is_limited(client, monkeypatch):
+    monkeypatch.setattr(main, "REGISTER_BATCH_MAX", 2)
+    users = [{"email": new_email(), "password": "secret"} for _ in range(3)]
+    assert client.post("/register/batch", json=users).status_code == 413
+
+
+def test_no_session_is_held_while_hashing(client, monkeypatch):
+    checked_out = []
+    hash_many = main.password_pool.hash_many
+
+    async def hash_and_check(passwords):
+        checked_out.append(main.database.stats()["pool"]["checked_out"])
+        return await hash_many(passwords)
+
+    monkeypatch.setattr(main.password_pool, "hash_many", hash_and_check)
+    assert register_batch(client, [{"email": new_email(), "password": "secret"}])["created"] == 1
+    assert checked_out in ([0], [None])
+
+
+def test_users_registered_during_hashing_become_conflicts(client, monkeypatch):
+    racing = new_email()
+    hash_many = main.password_pool.hash_many
+
+    async def hash_while_someone_registers(passwords):
+        hashed = await hash_many(passwords)
+        async with main.database.scope() as db:
+            await main.create_user(db, main.UserCreate(email=racing, password="secret"), hashed[0])
+        return hashed
+
+    monkeypatch.setattr(main.password_pool, "hash_many", hash_while_someone_registers)
+    other = new_email()
+
+    body = register_batch(client, [
+        {"email": racing, "password": "secret"},
+        {"email": other, "password": "secret"},
+    ])
+
+    assert [result["status"] for result in body["results"]] == ["conflict", "created"]
+    assert body["results"][0]["detail"] == "Email already registered"
@@ -0,0 +1,109 @@
+import time
+import uuid
+
+import pytest
+
+import main
+from hashing import hash_password
+from main import TokenVerificationCache
+
+
+def test_cache_hits_until_exp(monkeypatch):
+    cache = TokenVerificationCache(10)
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    cache.put("token", 1060.0, {"id": 1, "email": "ada@example.com"})
+
+    assert cache.get("token") == {"id": 1, "email": "ada@example.com"}
+    now[0] = 1060.0
+    assert cache.get("token") is None
+    assert cache.stats()["size"] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_is_a_bounded_lru():
+    cache = TokenVerificationCache(2)
+    exp = time.time() + 60
+    cache.put("a", exp, {"id": 1, "email": "a@example.com"})
+    cache.put("b", exp, {"id": 2, "email": "b@example.com"})
+    cache.get("a")
+    cache.put("c", exp, {"id": 3, "email": "c@example.com"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.stats()["evictions"] == 1
+    # The evicted token no longer counts towards its user
+    assert "b@example.com" not in cache._by_email
+
+
+def test_invalidate_user_drops_all_their_tokens():
+    cache = TokenVerificationCache(10)
+    exp = time.time() + 60
+    cache.put("first", exp, {"id": 1, "email": "ada@example.com"})
+    cache.put("second", exp, {"id": 1, "email": "ada@example.com"})
+    cache.put("other", exp, {"id": 2, "email": "bob@example.com"})
+
+    cache.invalidate_user("ada@example.com")
+
+    assert cache.get("first") is None
+    assert cache.get("second") is None
+    assert cache.get("other") is not None
+
+
+def test_disabled_cache():
+    cache = TokenVerificationCache(0)
+    cache.put("token", time.time() + 60, {"id": 1, "email": "ada@example.com"})
+    assert cache.get("token") is None
+
+
+@pytest.fixture
+def user(client):
+    email = f"{uuid.uuid4().hex}@example.com"
+    assert client.post("/register", json={"email": email, "password": "secret"}).status_code == 201
+    token = client.post("/token", data={"username": email, "password": "secret"}).json()["access_token"]
+    return email, token
+
+
+def verify(client, token):
+    return client.post("/verify", json={"token": token}).json()
+
+
+def test_repeat_verifications_are_cached(client, user):
+    email, token = user
+    hits = main.verify_cache.hits
+
+    assert verify(client, token)["user"]["email"] == email
+    assert verify(client, token)["valid"]
+    assert main.verify_cache.hits == hits + 1
+
+
+def test_password_change_evicts_tokens(client, run_db, user):
+    email, token = user
+    verify(client, token)
+    assert main.verify_cache.get(token) is not None
+
+    async def change_password(db):
+        await main.update_password_hash(db, await main.get_user(db, email), hash_password("new"))
+
+    run_db(change_password)
+
+    assert main.verify_cache.get(token) is None
+
+
+def test_deleted_user_is_no_longer_valid(client, run_db, user):
+    email, token = user
+    assert verify(client, token)["valid"]
+
+    async def delete(db):
+        await db.delete(await main.get_user(db, email))
+        await db.commit()
+
+    run_db(delete)
+
+    assert verify(client, token) == {"valid": False}
+
+
+def test_invalid_tokens_are_not_cached(client):
+    size = main.verify_cache.stats()["size"]
+    assert verify(client, "not.a.token") == {"valid": False}
+    assert main.verify_cache.stats()["size"] == size
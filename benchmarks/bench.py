@@ -0,0 +1,273 @@
+"""Load-test the services end to end and compare against a baseline.
+
+    python benchmarks/bench.py                        # all scenarios, local cluster
+    python benchmarks/bench.py login track --duration 30
+    python benchmarks/bench.py --gateway http://localhost:3000   # running stack
+    python benchmarks/bench.py --baseline baseline.json --save-baseline
+    python benchmarks/bench.py --baseline baseline.json    # compare
+
+Without ``--gateway`` the four services are started on localhost (see
+``cluster.py``), with SQLite unless ``--database-url`` points at a
+MySQL-compatible server. Each scenario runs a warmup, then measures for
+``--duration`` seconds. By default the load is closed-loop, with
+``--concurrency`` clients each sending a request as soon as the last one
+returns. ``--rate`` switches to an open-loop arrival rate, where latency
+counts from the intended send time, so a stalled server cannot hide its
+queueing delay by slowing the load generator down.
+
+The report gives throughput and p50/p95/p99 per scenario and per
+operation. With ``--baseline``, the run fails (exit status 1) when
+throughput drops or a latency percentile grows by more than
+``--tolerance``. Latency changes smaller than ``--min-delta-ms`` are
+ignored, so sub-millisecond jitter does not fail a build. Baselines only
+compare meaningfully on the machine that recorded them, so none is kept in
+the repository; CI records its own on the agent.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from cluster import REPO_ROOT, LocalCluster
+from scenarios import SCENARIOS, Scenario
+
+# Closed-loop clients per scenario unless --concurrency is given. The
+# bcrypt-bound scenarios stay within the Auth Service's default hashing
+# queue (HASH_MAX_PENDING, 4 per CPU) so they measure hashing, not shedding.
+DEFAULT_CONCURRENCY = {"register": 4, "login": 4, "profile-reads": 32, "track": 64}
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+# (operation, seconds from intended start to response, status code or exception name)
+Sample = Tuple[str, float, object]
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    # Nearest rank, so every reported value is an observed latency
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def summarize(samples: List[Sample], duration: float) -> dict:
+    latencies = sorted(latency for _, latency, _ in samples)
+    errors = sum(not (isinstance(outcome, int) and outcome < 400) for _, _, outcome in samples)
+    summary = {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput": round((len(samples) - errors) / duration, 2),
+        "latency_ms": {},
+        "outcomes": dict(Counter(str(outcome) for _, _, outcome in samples)),
+    }
+    if latencies:
+        summary["latency_ms"] = {
+            **{name: round(percentile(latencies, q) * 1000, 3) for name, q in PERCENTILES},
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        }
+    return summary
+
+
+async def run_scenario(scenario: Scenario, base_url: str, duration: float, warmup: float,
+                       concurrency: int, rate: Optional[float], seed: int, timeout: float) -> dict:
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    samples: List[Sample] = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        await scenario.setup(client)
+        started = loop.time()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+
+        async def issue(intended: float):
+            try:
+                operation, response = await scenario.step(client, rng)
+                outcome = response.status_code
+            except httpx.HTTPError as e:
+                operation, outcome = scenario.name, type(e).__name__
+            if intended >= measure_from:
+                samples.append((operation, loop.time() - intended, outcome))
+
+        if rate is None:
+            async def client_loop():
+                while loop.time() < stop_at:
+                    await issue(loop.time())
+
+            await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        else:
+            # Open loop: a request is due every 1/rate seconds whether or not
+            # earlier ones have returned, bounded by concurrency in flight
+            slots = asyncio.Semaphore(concurrency)
+            tasks = []
+            for n in range(int((stop_at - started) * rate)):
+                intended = started + n / rate
+                await asyncio.sleep(max(0.0, intended - loop.time()))
+                await slots.acquire()
+                task = loop.create_task(issue(intended))
+                task.add_done_callback(lambda _: slots.release())
+                tasks.append(task)
+            await asyncio.gather(*tasks)
+
+    by_operation = defaultdict(list)
+    for sample in samples:
+        by_operation[sample[0]].append(sample)
+    return {
+        "description": scenario.description,
+        "concurrency": concurrency,
+        "rate": rate,
+        **summarize(samples, duration),
+        "operations": {name: summarize(ops, duration) for name, ops in sorted(by_operation.items())},
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> List[str]:
+    """Return a description of every metric that regressed past tolerance."""
+    regressions = []
+    for name, base in baseline.get("scenarios", {}).items():
+        current = results["scenarios"].get(name)
+        if current is None:
+            continue
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput']}/s vs baseline {base['throughput']}/s")
+        for percentile_name, _ in PERCENTILES:
+            now = current["latency_ms"].get(percentile_name)
+            before = base["latency_ms"].get(percentile_name)
+            if now is None or before is None:
+                continue
+            if now > before * (1 + tolerance) and now - before > min_delta_ms:
+                regressions.append(f"{name}: {percentile_name} {now}ms vs baseline {before}ms")
+        # Any new class of failure is a regression, whatever the latency
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{name}: error rate {current['error_rate']} vs baseline {base['error_rate']}")
+    return regressions
+
+
+def print_report(results: dict):
+    header = f"{'scenario':<28}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+
+    def row(label: str, summary: dict):
+        latency = summary["latency_ms"]
+        print(
+            f"{label:<28}{summary['requests']:>10}{summary['errors']:>8}{summary['throughput']:>10.1f}"
+            + "".join(f"{latency.get(name, float('nan')):>10.2f}" for name in ("p50", "p95", "p99", "max"))
+        )
+
+    for name, scenario in results["scenarios"].items():
+        row(name, scenario)
+        if len(scenario["operations"]) > 1:
+            for operation, summary in scenario["operations"].items():
+                row(f"  {operation}", summary)
+
+
+async def run(args, base_url: str) -> dict:
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "target": args.gateway or "local",
+            "database": args.database_url or ("sqlite" if not args.gateway else None),
+        },
+        "config": {"duration": args.duration, "warmup": args.warmup, "users": args.users, "seed": args.seed},
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        concurrency = args.concurrency or DEFAULT_CONCURRENCY.get(name, 16)
+        print(f"Running {name} for {args.duration}s ({concurrency} clients"
+              + (f", {args.rate} req/s" if args.rate else "") + ")", file=sys.stderr)
+        results["scenarios"][name] = await run_scenario(
+            SCENARIOS[name](args.users), base_url, args.duration, args.warmup,
+            concurrency, args.rate, args.seed, args.timeout,
+        )
+    return results
+
+
+def parse_env(values: List[str]) -> Dict[str, str]:
+    env = {}
+    for value in values:
+        key, sep, setting = value.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--env expects KEY=VALUE, got {value!r}")
+        env[key] = setting
+    return env
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks through the API Gateway")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"one of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--gateway", help="benchmark a running stack at this gateway URL instead")
+    parser.add_argument("--database-url", help="MySQL-compatible database for the local cluster (default: SQLite)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment override for every local service, repeatable")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before each scenario")
+    parser.add_argument("--concurrency", type=int, help="clients (or max in flight with --rate)")
+    parser.add_argument("--rate", type=float, help="open-loop arrival rate in requests per second")
+    parser.add_argument("--users", type=int, default=50, help="accounts created by scenarios that need them")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline instead")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="ignore smaller latency regressions")
+    args = parser.parse_args(argv)
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline requires --baseline")
+
+    if args.gateway:
+        results = asyncio.run(run(args, args.gateway.rstrip("/")))
+    else:
+        with LocalCluster(database_url=args.database_url, env=parse_env(args.env)) as cluster:
+            print(f"Local cluster in {cluster.workdir}", file=sys.stderr)
+            results = asyncio.run(run(args, cluster.gateway_url))
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}", file=sys.stderr)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
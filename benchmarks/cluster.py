@@ -0,0 +1,126 @@
+"""Runs the four services on localhost for a benchmark.
+
+Each service runs under uvicorn in its own process, as it does in its
+container, with stand-ins for the infrastructure around it: SQLite files
+for MySQL (or any MySQL-compatible server passed as ``database_url``) and
+a temporary directory for the analytics event store. Service output goes
+to ``<workdir>/<service>.log``.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("auth-service", "user-service", "analytics-service", "api-gateway")
+# Endpoints that answer 200 once a service can take traffic
+READY_PATHS = {
+    "auth-service": "/ready",
+    "user-service": "/ready",
+    "analytics-service": "/",
+    "api-gateway": "/",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalCluster:
+    def __init__(self, database_url: Optional[str] = None, env: Optional[Dict[str, str]] = None,
+                 workdir: Optional[str] = None, startup_timeout: float = 60.0):
+        self.database_url = database_url
+        self.env = env or {}
+        self.workdir = workdir or tempfile.mkdtemp(prefix="bench-")
+        self.startup_timeout = startup_timeout
+        self.ports = {service: free_port() for service in SERVICES}
+        self._processes: List[subprocess.Popen] = []
+        self._logs = []
+
+    def url(self, service: str) -> str:
+        return f"http://127.0.0.1:{self.ports[service]}"
+
+    @property
+    def gateway_url(self) -> str:
+        return self.url("api-gateway")
+
+    def service_env(self, service: str) -> Dict[str, str]:
+        env = {
+            **os.environ,
+            "DATABASE_URL": self.database_url or f"sqlite:///{self.workdir}/{service}.db",
+            "ANALYTICS_DATA_DIR": os.path.join(self.workdir, "analytics"),
+            "AUTH_SERVICE_URL": self.url("auth-service"),
+            "USER_SERVICE_URL": self.url("user-service"),
+            "ANALYTICS_SERVICE_URL": self.url("analytics-service"),
+        }
+        env.update(self.env)
+        return env
+
+    def start(self):
+        for service in SERVICES:
+            log = open(os.path.join(self.workdir, f"{service}.log"), "ab")
+            self._logs.append(log)
+            self._processes.append(subprocess.Popen(
+                [
+                    sys.executable, "-m", "uvicorn", "main:app",
+                    "--host", "127.0.0.1", "--port", str(self.ports[service]),
+                    "--log-level", "warning", "--no-access-log",
+                ],
+                cwd=os.path.join(REPO_ROOT, service),
+                env=self.service_env(service),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            ))
+        try:
+            self.wait_ready()
+        except Exception:
+            self.stop()
+            raise
+
+    def wait_ready(self):
+        deadline = time.monotonic() + self.startup_timeout
+        pending = set(SERVICES)
+        while pending:
+            for process, service in zip(self._processes, SERVICES):
+                if process.poll() is not None:
+                    raise RuntimeError(
+                        f"{service} exited with {process.returncode}, "
+                        f"see {os.path.join(self.workdir, service + '.log')}"
+                    )
+            for service in list(pending):
+                try:
+                    if httpx.get(self.url(service) + READY_PATHS[service], timeout=1).status_code == 200:
+                        pending.discard(service)
+                except httpx.HTTPError:
+                    pass
+            if pending and time.monotonic() > deadline:
+                raise RuntimeError(f"Services not ready after {self.startup_timeout}s: {sorted(pending)}")
+            if pending:
+                time.sleep(0.2)
+
+    def stop(self):
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for log in self._logs:
+            log.close()
+        self._processes = []
+        self._logs = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
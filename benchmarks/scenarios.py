@@ -0,0 +1,152 @@
+"""Benchmark scenarios. Every request goes through the API Gateway, so the
+measured path is the full one a client sees: edge authentication,
+coalescing, upstream pools and the service behind them.
+
+A scenario prepares its data in ``setup`` and then issues exactly one
+request per ``step``, returning an operation name and the response so the
+runner can time and classify it.
+"""
+import asyncio
+import random
+import uuid
+from typing import Dict, List, Tuple
+
+import httpx
+
+PASSWORD = "bench-password"
+EVENT_TYPES = ["page_view"] * 6 + ["button_click"] * 3 + ["login", "logout", "profile_update"]
+
+
+async def gather_limited(coroutines, limit: int = 4) -> list:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(c) for c in coroutines))
+
+
+async def setup_request(client: httpx.AsyncClient, method: str, url: str, expected: int,
+                        attempts: int = 20, **kwargs) -> dict:
+    """Send a setup request, waiting out load shedding (503/429 with
+    Retry-After) so preparing data never fails a run."""
+    for _ in range(attempts):
+        response = await client.request(method, url, **kwargs)
+        if response.status_code not in (429, 503):
+            break
+        await asyncio.sleep(float(response.headers.get("retry-after", "1")))
+    if response.status_code != expected:
+        raise RuntimeError(f"Setup request {method} {url} returned {response.status_code}: {response.text[:200]}")
+    return response.json()
+
+
+async def create_user(client: httpx.AsyncClient, email: str, with_profile: bool) -> Dict:
+    user = await setup_request(client, "POST", "/auth/register", 201, json={"email": email, "password": PASSWORD})
+    token = (await setup_request(
+        client, "POST", "/auth/token", 200, data={"username": email, "password": PASSWORD}
+    ))["access_token"]
+    user = {"email": email, "user_id": user["id"], "headers": {"Authorization": f"Bearer {token}"}}
+    if with_profile:
+        profile = await setup_request(
+            client, "POST", "/users/profiles", 201,
+            json={"name": email.split("@")[0], "bio": "benchmark user"}, headers=user["headers"],
+        )
+        user["profile_id"] = profile["id"]
+    return user
+
+
+class Scenario:
+    name = ""
+    description = ""
+
+    def __init__(self, users: int):
+        self.users = users
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def email(self, n: int) -> str:
+        return f"bench-{self.name}-{self.run_id}-{n}@example.com"
+
+    async def setup(self, client: httpx.AsyncClient):
+        pass
+
+    async def step(self, client: httpx.AsyncClient, rng: random.Random) -> Tuple[str, httpx.Response]:
+        raise NotImplementedError
+
+
+class RegisterStorm(Scenario):
+    name = "register"
+    description = "New accounts via POST /auth/register (bcrypt hash per request)"
+
+    def __init__(self, users: int):
+        super().__init__(users)
+        self.count = 0
+
+    async def step(self, client, rng):
+        self.count += 1
+        return "register", await client.post(
+            "/auth/register", json={"email": self.email(self.count), "password": PASSWORD}
+        )
+
+
+class LoginStorm(Scenario):
+    name = "login"
+    description = "Password logins via POST /auth/token across existing accounts"
+
+    async def setup(self, client):
+        await gather_limited(
+            setup_request(client, "POST", "/auth/register", 201, json={"email": self.email(n), "password": PASSWORD})
+            for n in range(self.users)
+        )
+
+    async def step(self, client, rng):
+        email = self.email(rng.randrange(self.users))
+        return "token", await client.post("/auth/token", data={"username": email, "password": PASSWORD})
+
+
+class ProfileReads(Scenario):
+    name = "profile-reads"
+    description = "Read-heavy profile mix: own profile, by id, bulk lookup, occasional update"
+
+    # (operation, weight)
+    MIX = [("get_me", 80), ("get_by_id", 10), ("bulk_lookup", 5), ("update_me", 5)]
+
+    async def setup(self, client):
+        self.accounts: List[Dict] = await gather_limited(
+            create_user(client, self.email(n), with_profile=True) for n in range(self.users)
+        )
+        self.operations = [name for name, _ in self.MIX]
+        self.weights = [weight for _, weight in self.MIX]
+
+    async def step(self, client, rng):
+        operation = rng.choices(self.operations, self.weights)[0]
+        account = rng.choice(self.accounts)
+        if operation == "get_me":
+            response = await client.get("/users/profiles/me", headers=account["headers"])
+        elif operation == "get_by_id":
+            response = await client.get(f"/users/profiles/{rng.choice(self.accounts)['profile_id']}")
+        elif operation == "bulk_lookup":
+            ids = ",".join(str(a["profile_id"]) for a in rng.sample(self.accounts, min(10, len(self.accounts))))
+            response = await client.get("/users/profiles", params={"ids": ids})
+        else:
+            response = await client.put(
+                "/users/profiles/me",
+                json={"name": account["email"].split("@")[0], "bio": f"updated {rng.random():.6f}"},
+                headers=account["headers"],
+            )
+        return operation, response
+
+
+class TrackIngest(Scenario):
+    name = "track"
+    description = "Single-event ingest via POST /analytics/track"
+
+    async def step(self, client, rng):
+        return "track", await client.post("/analytics/track", json={
+            "event_type": rng.choice(EVENT_TYPES),
+            "user_id": rng.randrange(1, 10000),
+            "event_data": {"page": f"/page/{rng.randrange(50)}", "source": "bench"},
+        })
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (RegisterStorm, LoginStorm, ProfileReads, TrackIngest)}
@@ -40,15 +40,16 @@ kubectl apply -k k8s/
 # Function to wait for pod readiness with improved error handling
 wait_for_pod() {
   local app=$1
+  local kind=${2:-deployment}
   local timeout=300
   local start_time=$(date +%s)
   local end_time=$((start_time + timeout))
   local current_time=0
   
-  echo "Waiting for $app deployment to be ready (timeout: ${timeout}s)..."
+  echo "Waiting for $app $kind to be ready (timeout: ${timeout}s)..."
   
   while [ $(date +%s) -lt $end_time ]; do
-    if kubectl get deployment $app -o jsonpath='{.status.availableReplicas}' 2>/dev/null | grep -q "1"; then
+    if kubectl get $kind $app -o jsonpath='{.status.availableReplicas}' 2>/dev/null | grep -q "[1-9]"; then
       echo "✅ $app is ready"
       return 0
     fi
@@ -79,7 +80,7 @@ wait_for_pod() {
 wait_for_pod "mysql"
 wait_for_pod "auth-service"
 wait_for_pod "user-service"
-wait_for_pod "analytics-service"
+wait_for_pod "analytics-service" statefulset
 wait_for_pod "api-gateway"
 wait_for_pod "frontend"
 
@@ -38,7 +38,7 @@ echo "Waiting for pods to become ready..."
 kubectl wait --for=condition=available --timeout=300s deployment/mysql || echo "MySQL deployment timeout"
 kubectl wait --for=condition=available --timeout=300s deployment/auth-service || echo "Auth service deployment timeout"
 kubectl wait --for=condition=available --timeout=300s deployment/user-service || echo "User service deployment timeout"
-kubectl wait --for=condition=available --timeout=300s deployment/analytics-service || echo "Analytics service deployment timeout"
+kubectl rollout status --timeout=300s statefulset/analytics-service || echo "Analytics service statefulset timeout"
 kubectl wait --for=condition=available --timeout=300s deployment/api-gateway || echo "API gateway deployment timeout"
 kubectl wait --for=condition=available --timeout=300s deployment/frontend || echo "Frontend deployment timeout"
 
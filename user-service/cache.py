@@ -0,0 +1,299 @@
+"""Read-through profile cache for the User Service.
+
+Profiles are cached as their serialized JSON body together with an ETag,
+under two keys: one by profile id and one by user_id. Reads check the
+cache before opening a database session, writes go through to it after
+commit, and a matching ``If-None-Match`` can be answered from the cached
+ETag alone.
+
+Writes overwrite the cached entry, but a read only fills an empty one
+(``only_if_absent``). A read that loaded the row just before an update
+committed therefore cannot replace the updated entry with its stale copy.
+
+The storage backend is pluggable:
+
+* ``memory``: per-process LRU with a TTL (default). Each replica has its
+  own, so a write on one replica leaves the others serving the old
+  profile until their entry expires; use ``redis`` with several replicas
+* ``redis``: any Redis-compatible server, shared between replicas
+* ``fake-redis``: an in-process stand-in with the same client interface,
+  for local runs and tests without a server
+* ``none``: caching disabled
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    async def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        now = time.monotonic()
+        values = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            values.append(entry[1] if entry is not None else None)
+        return values
+
+    async def set_many(self, items: List[Tuple[str, str]], only_if_absent: bool = False):
+        if self.maxsize <= 0:
+            return
+        now = time.monotonic()
+        expires = now + self.ttl
+        for key, value in items:
+            if only_if_absent:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    continue
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "maxsize": self.maxsize, "evictions": self.evictions}
+
+
+class FakePipeline:
+    def __init__(self, client: "FakeRedis"):
+        self.client = client
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands.clear()
+
+    def set(self, name: str, value, ex: Optional[float] = None, nx: bool = False):
+        self._commands.append((name, value, ex, nx))
+        return self
+
+    async def execute(self) -> list:
+        results = [await self.client.set(*command) for command in self._commands]
+        self._commands.clear()
+        return results
+
+
+class FakeRedis:
+    """The subset of ``redis.asyncio.Redis`` used by ``RedisBackend``."""
+
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, name: str) -> Optional[bytes]:
+        entry = self._data.get(name)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._data[name]
+            return None
+        return value
+
+    async def mget(self, names: List[str]) -> List[Optional[bytes]]:
+        return [await self.get(name) for name in names]
+
+    async def set(self, name: str, value, ex: Optional[float] = None, nx: bool = False):
+        if nx and await self.get(name) is not None:
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        self._data[name] = (time.monotonic() + ex if ex else None, value)
+        return True
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def delete(self, *names: str) -> int:
+        return sum(self._data.pop(name, None) is not None for name in names)
+
+    async def aclose(self):
+        self._data.clear()
+
+
+class RedisBackend:
+    def __init__(self, client, ttl: float, prefix: str = "user-service:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        values = await self.client.mget([self.prefix + key for key in keys])
+        return [value.decode() if value is not None else None for value in values]
+
+    async def set_many(self, items: List[Tuple[str, str]], only_if_absent: bool = False):
+        # One round-trip however many profiles a bulk lookup loaded
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, value in items:
+                pipe.set(self.prefix + key, value, ex=max(int(self.ttl), 1), nx=only_if_absent)
+            await pipe.execute()
+
+    async def delete(self, *keys: str):
+        await self.client.delete(*(self.prefix + key for key in keys))
+
+    def stats(self) -> dict:
+        return {"client": type(self.client).__name__}
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_backend(name: str, maxsize: int, ttl: float, redis_url: Optional[str] = None):
+    if name == "none":
+        return None
+    if name == "memory":
+        return MemoryBackend(maxsize, ttl)
+    if name == "fake-redis":
+        return RedisBackend(FakeRedis(), ttl)
+    if name == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("PROFILE_CACHE_BACKEND=redis requires the redis package")
+        return RedisBackend(redis.Redis.from_url(redis_url), ttl)
+    raise ValueError(f"Unknown profile cache backend: {name}")
+
+
+def etag_for(body: str) -> str:
+    return '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class CachedProfile:
+    __slots__ = ("body", "_etag")
+
+    def __init__(self, body: str):
+        self.body = body
+        self._etag = None
+
+    @property
+    def etag(self) -> str:
+        # Bulk lookups never need one, so it is computed on first use
+        if self._etag is None:
+            self._etag = etag_for(self.body)
+        return self._etag
+
+
+class ProfileCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def id_key(profile_id: int) -> str:
+        return f"profile:id:{profile_id}"
+
+    @staticmethod
+    def user_key(user_id: int) -> str:
+        return f"profile:user:{user_id}"
+
+    async def _get_many(self, keys: List[str]) -> List[Optional[CachedProfile]]:
+        if self.backend is None or not keys:
+            return [None] * len(keys)
+        try:
+            bodies = await self.backend.get_many(keys)
+        except Exception as e:
+            # A cache outage degrades to database reads, never to errors
+            self.errors += 1
+            logger.warning("Profile cache read failed: %s", e)
+            return [None] * len(keys)
+        found = [CachedProfile(body) if body is not None else None for body in bodies]
+        hits = sum(entry is not None for entry in found)
+        self.hits += hits
+        self.misses += len(found) - hits
+        return found
+
+    async def get_by_id(self, profile_id: int) -> Optional[CachedProfile]:
+        return (await self._get_many([self.id_key(profile_id)]))[0]
+
+    async def get_by_user(self, user_id: int) -> Optional[CachedProfile]:
+        return (await self._get_many([self.user_key(user_id)]))[0]
+
+    async def get_many_by_id(self, profile_ids: List[int]) -> Dict[int, CachedProfile]:
+        found = await self._get_many([self.id_key(i) for i in profile_ids])
+        return {i: entry for i, entry in zip(profile_ids, found) if entry is not None}
+
+    async def get_many_by_user(self, user_ids: List[int]) -> Dict[int, CachedProfile]:
+        found = await self._get_many([self.user_key(i) for i in user_ids])
+        return {i: entry for i, entry in zip(user_ids, found) if entry is not None}
+
+    async def put_many(self, profiles: List[dict], only_if_absent: bool = False) -> List[CachedProfile]:
+        """Cache serialized profiles under both keys and return them.
+
+        Reads pass ``only_if_absent`` so they never overwrite an entry that
+        a concurrent write put there after they loaded the row.
+        """
+        entries = []
+        items = []
+        for profile in profiles:
+            body = orjson.dumps(profile, option=orjson.OPT_SORT_KEYS).decode()
+            entries.append(CachedProfile(body))
+            items.append((self.id_key(profile["id"]), body))
+            items.append((self.user_key(profile["user_id"]), body))
+        if self.backend is not None and items:
+            try:
+                await self.backend.set_many(items, only_if_absent)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Profile cache write failed: %s", e)
+                for profile in profiles:
+                    await self.invalidate(profile["id"], profile["user_id"])
+        return entries
+
+    async def put(self, profile: dict, only_if_absent: bool = False) -> CachedProfile:
+        return (await self.put_many([profile], only_if_absent))[0]
+
+    async def invalidate(self, profile_id: int, user_id: int):
+        if self.backend is None:
+            return
+        try:
+            await self.backend.delete(self.id_key(profile_id), self.user_key(user_id))
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Profile cache invalidation failed: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            **(self.backend.stats() if self.backend is not None else {}),
+        }
+
+    async def close(self):
+        if self.backend is not None and hasattr(self.backend, "close"):
+            await self.backend.close()
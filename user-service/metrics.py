@@ -0,0 +1,115 @@
+"""Prometheus instrumentation shared by the services.
+
+``instrument(app)`` adds an ASGI middleware that records request duration
+per route template and status, and serves every registered metric at
+``/metrics``. Components that already keep counters in a ``stats()`` dict
+are exported with ``register_stats`` instead of being instrumented twice.
+
+Each service carries a copy of this module since they are built from
+separate Docker contexts.
+"""
+import time
+from typing import Callable, Iterable, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Buckets tuned for API latencies, from sub-millisecond cache hits to slow scans
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last response byte",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "Requests currently being handled",
+    ["method"],
+)
+
+
+def route_template(scope) -> str:
+    # The template rather than the raw path keeps label cardinality bounded
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app, route_label: Callable[[dict], str] = route_template):
+        self.app = app
+        self.route_label = route_label
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = "500"
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+            REQUEST_DURATION.labels(method, self.route_label(scope), status).observe(time.perf_counter() - started)
+
+
+def flatten(stats: dict, prefix: str = "") -> Iterable:
+    for key, value in stats.items():
+        name = f"{prefix}_{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from flatten(value, name)
+        elif isinstance(value, (bool, int, float)):
+            yield name, float(value)
+
+
+class StatsCollector:
+    """Exposes the numeric leaves of a ``stats()`` dict as gauges, e.g.
+    ``{"pool": {"checked_out": 3}}`` under prefix ``db`` becomes
+    ``db_pool_checked_out 3``. With ``label`` set, ``stats()`` returns one
+    dict per label value instead."""
+
+    def __init__(self, prefix: str, stats: Callable[[], dict], label: Optional[str] = None):
+        self.prefix = prefix
+        self.stats = stats
+        self.label = label
+
+    def collect(self):
+        sources = self.stats() if self.label else {None: self.stats()}
+        labels = [self.label] if self.label else []
+        families = {}
+        for label_value, stats in sources.items():
+            for name, value in flatten(stats):
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = GaugeMetricFamily(
+                        f"{self.prefix}_{name}", f"{self.prefix} {name.replace('_', ' ')}", labels=labels
+                    )
+                family.add_metric([str(label_value)] if self.label else [], value)
+        return list(families.values())
+
+
+def register_stats(prefix: str, stats: Callable[[], dict], label: Optional[str] = None):
+    REGISTRY.register(StatsCollector(prefix, stats, label))
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+def instrument(app, route_label: Callable[[dict], str] = route_template):
+    app.add_middleware(MetricsMiddleware, route_label=route_label)
+    app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
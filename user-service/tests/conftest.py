@@ -0,0 +1,44 @@
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# Configuration is read at import time, so it is set before main is imported
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='user-service-')}/users.db")
+os.environ.setdefault("PROFILE_CACHE_BACKEND", "memory")
+
+# The service modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        deadline = time.monotonic() + 10
+        while client.get("/ready").status_code != 200:
+            assert time.monotonic() < deadline, "database did not become ready"
+            time.sleep(0.05)
+        yield client
+
+
+def identity(user_id):
+    """Identity headers as the API Gateway signs them for ``user_id``."""
+    import main
+
+    email = f"user{user_id}@example.com"
+    timestamp = str(int(time.time()))
+    message = f"{user_id}|{email}|{timestamp}".encode()
+    return {
+        "x-user-id": str(user_id),
+        "x-user-email": email,
+        "x-identity-timestamp": timestamp,
+        "x-identity-signature": hmac.new(main.INTERNAL_AUTH_SECRET.encode(), message, hashlib.sha256).hexdigest(),
+    }
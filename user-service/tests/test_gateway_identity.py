@@ -0,0 +1,40 @@
+import hashlib
+import hmac
+import time
+
+import pytest
+
+import main
+
+
+def identity_headers(user_id="2001", email="ada@example.com", timestamp=None, secret=None):
+    timestamp = str(int(time.time())) if timestamp is None else timestamp
+    message = f"{user_id}|{email}|{timestamp}".encode()
+    signature = hmac.new((secret or main.INTERNAL_AUTH_SECRET).encode(), message, hashlib.sha256).hexdigest()
+    return {
+        "x-user-id": user_id,
+        "x-user-email": email,
+        "x-identity-timestamp": timestamp,
+        "x-identity-signature": signature,
+    }
+
+
+def test_signed_identity_is_trusted(client, monkeypatch):
+    monkeypatch.setattr(main, "verify_token_remotely", pytest.fail)
+    response = client.post("/profiles", json={"name": "Ada"}, headers=identity_headers())
+    assert response.status_code == 201
+    assert response.json()["user_id"] == 2001
+    assert client.get("/profiles/me", headers=identity_headers()).json()["name"] == "Ada"
+
+
+@pytest.mark.parametrize("headers", [
+    identity_headers(secret="another secret"),
+    identity_headers(timestamp=str(int(time.time()) - 3600)),
+    identity_headers(timestamp="soon"),
+    identity_headers(user_id="abc"),
+    {**identity_headers(), "x-user-id": "2002"},
+    {key: value for key, value in identity_headers().items() if key != "x-identity-signature"},
+])
+def test_untrusted_identity_is_ignored(client, headers):
+    # Without a bearer token to fall back on, the request is unauthenticated
+    assert client.get("/profiles/me", headers=headers).status_code == 401
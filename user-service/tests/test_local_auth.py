@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from jose import jwt
+
+import main
+
+
+def make_token(secret=None, **claims):
+    claims.setdefault("exp", datetime.utcnow() + timedelta(minutes=5))
+    return jwt.encode(claims, secret or main.JWT_SECRET, algorithm="HS256")
+
+
+def test_token_with_uid_is_verified_locally():
+    token = make_token(sub="ada@example.com", uid=7)
+    assert main.verify_token_locally(token) == {"id": 7, "email": "ada@example.com"}
+
+
+def test_token_without_uid_needs_the_auth_service():
+    assert main.verify_token_locally(make_token(sub="ada@example.com")) is None
+
+
+@pytest.mark.parametrize("token", [
+    make_token(secret="another secret", sub="ada@example.com", uid=7),
+    make_token(sub="ada@example.com", uid=7, exp=datetime.utcnow() - timedelta(seconds=1)),
+    make_token(uid=7),
+    "not.a.token",
+])
+def test_invalid_tokens_are_rejected(token):
+    with pytest.raises(HTTPException) as excinfo:
+        main.verify_token_locally(token)
+    assert excinfo.value.status_code == 401
+
+
+@pytest.fixture
+def no_auth_service(monkeypatch):
+    calls = []
+
+    def verify_token_remotely(token):
+        calls.append(token)
+        return {"id": 99, "email": "remote@example.com"}
+
+    monkeypatch.setattr(main, "verify_token_remotely", verify_token_remotely)
+    return calls
+
+
+def test_reads_do_not_call_the_auth_service(client, no_auth_service):
+    token = make_token(sub="ada@example.com", uid=1001)
+    response = client.get("/profiles/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 404
+    assert no_auth_service == []
+
+
+def test_legacy_tokens_fall_back_to_the_auth_service(client, no_auth_service):
+    token = make_token(sub="ada@example.com")
+    client.get("/profiles/me", headers={"Authorization": f"Bearer {token}"})
+    assert no_auth_service == [token]
+
+
+def test_remote_mode_always_asks_the_auth_service(client, no_auth_service, monkeypatch):
+    monkeypatch.setattr(main, "AUTH_VERIFY_MODE", "remote")
+    token = make_token(sub="ada@example.com", uid=1001)
+    client.get("/profiles/me", headers={"Authorization": f"Bearer {token}"})
+    assert no_auth_service == [token]
+
+
+def test_writes_are_verified_by_the_auth_service(client, no_auth_service):
+    token = make_token(sub="ada@example.com", uid=1001)
+    response = client.post("/profiles", json={"name": "Ada"}, headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 201
+    # The identity confirmed by the Auth Service wins
+    assert response.json()["user_id"] == 99
+    assert no_auth_service == [token]
+
+
+def test_missing_token(client):
+    assert client.get("/profiles/me").status_code == 401
+    assert client.get("/profiles/me", headers={"Authorization": "Basic abc"}).status_code == 401
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import main
+from cache import FakeRedis, MemoryBackend, ProfileCache, RedisBackend, etag_matches
+from conftest import identity
+
+
+def profile(name, user_id=1):
+    return {"id": 10, "user_id": user_id, "name": name, "bio": None}
+
+
+@pytest.fixture(params=["memory", "fake-redis"])
+def cache(request):
+    if request.param == "memory":
+        return ProfileCache(MemoryBackend(maxsize=10, ttl=60))
+    return ProfileCache(RedisBackend(FakeRedis(), ttl=60))
+
+
+def test_reads_do_not_overwrite_a_newer_write(cache):
+    async def scenario():
+        # A read loaded the row, then an update committed and cached it
+        await cache.put(profile("new"))
+        stale = await cache.put(profile("old"), only_if_absent=True)
+
+        assert '"old"' in stale.body
+        assert '"new"' in (await cache.get_by_id(10)).body
+        assert '"new"' in (await cache.get_by_user(1)).body
+
+        await cache.put(profile("newer"))
+        assert '"newer"' in (await cache.get_by_id(10)).body
+
+    asyncio.run(scenario())
+
+
+def test_reads_fill_missing_and_expired_entries():
+    async def scenario():
+        cache = ProfileCache(MemoryBackend(maxsize=10, ttl=0))
+        await cache.put(profile("expired"))
+        cache.backend.ttl = 60
+        await cache.put(profile("loaded"), only_if_absent=True)
+        assert '"loaded"' in (await cache.get_by_id(10)).body
+
+    asyncio.run(scenario())
+
+
+def test_etag_matching():
+    etag = '"abc"'
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"xyz", "abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"xyz"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_conditional_gets(client):
+    created = client.post("/profiles", json={"name": "Ada"}, headers=identity(3001))
+    assert created.status_code == 201
+    etag = created.headers["etag"]
+    profile_id = created.json()["id"]
+
+    response = client.get("/profiles/me", headers={**identity(3001), "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert client.get(f"/profiles/{profile_id}", headers={"If-None-Match": f"W/{etag}"}).status_code == 304
+
+    updated = client.put("/profiles/me", json={"name": "Ada L."}, headers=identity(3001))
+    assert updated.headers["etag"] != etag
+    response = client.get(f"/profiles/{profile_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["name"] == "Ada L."
+    assert response.headers["etag"] == updated.headers["etag"]
+
+
+def test_cache_misses_are_loaded_from_the_database(client):
+    created = client.post("/profiles", json={"name": "Grace"}, headers=identity(3002)).json()
+    client.portal.call(main.profile_cache.invalidate, created["id"], created["user_id"])
+
+    misses = main.profile_cache.misses
+    assert client.get(f"/profiles/{created['id']}").json()["name"] == "Grace"
+    assert main.profile_cache.misses == misses + 1
+    assert client.get("/profiles/me", headers=identity(3002)).json()["name"] == "Grace"
+    assert main.profile_cache.misses == misses + 1
@@ -0,0 +1,50 @@
+import pytest
+
+import main
+from conftest import identity
+
+
+@pytest.fixture(scope="module")
+def profiles(client):
+    created = []
+    for user_id in (4001, 4002, 4003):
+        response = client.post("/profiles", json={"name": f"User {user_id}"}, headers=identity(user_id))
+        assert response.status_code == 201
+        created.append(response.json())
+    return created
+
+
+def names(response):
+    assert response.status_code == 200
+    return [profile["name"] for profile in response.json()]
+
+
+def test_lookup_follows_request_order(client, profiles):
+    ids = [profiles[2]["id"], 999999, profiles[0]["id"]]
+    response = client.get("/profiles", params={"ids": ",".join(map(str, ids))})
+    assert names(response) == ["User 4003", "User 4001"]
+
+
+def test_lookup_by_id_and_user_id(client, profiles):
+    first, second, _ = profiles
+    # Cold cache: the misses are loaded together
+    for profile in profiles:
+        client.portal.call(main.profile_cache.invalidate, profile["id"], profile["user_id"])
+
+    response = client.post("/profiles/lookup", json={
+        "ids": [first["id"]], "user_ids": [second["user_id"], first["user_id"]],
+    })
+    # A profile asked for both ways is returned once
+    assert names(response) == ["User 4001", "User 4002"]
+    response = client.get("/profiles", params={"user_ids": f"{second['user_id']}"})
+    assert names(response) == ["User 4002"]
+
+
+def test_lookup_limits(client, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_LOOKUP_MAX", 2)
+    assert client.get("/profiles", params={"ids": "1,2", "user_ids": "3"}).status_code == 413
+    # Duplicates do not count towards the limit
+    assert client.get("/profiles", params={"ids": "1,1,1,2"}).status_code == 200
+    assert client.post("/profiles/lookup", json={"ids": [1, 2, 3]}).status_code == 413
+    assert client.get("/profiles", params={"ids": "1,x"}).status_code == 422
+    assert client.get("/profiles").json() == []